@@ -1,13 +1,25 @@
 
 import logging
-from google.appengine.api import apiproxy_stub_map
-from google.appengine.api import memcache
-from google.pyglib.gexcept import AbstractMethod
-from google.appengine.api import urlfetch as urlfetch_builtin
-from google.appengine.api.datastore import datastore_pb, Query, MultiQuery
-from google.appengine.ext.db import GqlQuery
-#from asynctools import datastore
-import datastore
+import threading
+import time as _time
+import cPickle
+try:
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import memcache as memcache_builtin
+    from google.pyglib.gexcept import AbstractMethod
+    from google.appengine.api import urlfetch as urlfetch_builtin
+    from google.appengine.api.datastore import datastore_pb, Query, MultiQuery
+    from google.appengine.ext.db import GqlQuery
+    #from asynctools import datastore
+    import datastore
+except ImportError:
+    # outside App Engine only LocalTask and the runners are usable
+    apiproxy_stub_map = memcache_builtin = urlfetch_builtin = None
+    AbstractMethod = NotImplementedError
+
+class DeadlineExceededError(Exception):
+    """ raised by get_result of a task its runner gave up on """
+
 
 class RpcTask(object):
 
@@ -16,6 +28,7 @@ class RpcTask(object):
         self.__args = args
         self.__kwargs = kwargs
         self.__cache_result = None
+        self.__expired = False
         self.__client_state = kwargs.get('client_state')
 
     def __set_runner(self, runner):
@@ -44,6 +57,14 @@ class RpcTask(object):
 
     cache_result = property(__get_cache_result, __set_cache_result)
 
+    def expire(self):
+        """ give up on the rpc: get_result raises DeadlineExceededError from now on """
+        self.__expired = True
+
+    @property
+    def expired(self):
+        return self.__expired
+
     def make_call(self):
         """ common call to dispatch rpc
             access args and kwargs to call services make_call with arguments
@@ -56,6 +77,8 @@ class RpcTask(object):
     def get_result(self):
         if self.cache_result is not None:
             return self.cache_result
+        elif self.expired:
+            raise DeadlineExceededError(repr(self))
         else:
             return self.rpc.get_result()
 
@@ -119,6 +142,8 @@ class QueryTask(RpcTask):
     def get_result(self):
         if self.cache_result is not None:
             return self.cache_result
+        if self.expired:
+            raise DeadlineExceededError(repr(self))
         if len(self.exception) >= 1:
             raise self.exception[0]
         else:
@@ -154,6 +179,116 @@ class QueryTask(RpcTask):
         return self.__exception
 
 
+class LocalRPC(object):
+    """
+        Stand-in for a UserRPC that calls a function in process when waited on,
+        so that local backends can be run by the same task runners.
+    """
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.runner = None
+        self.__done = False
+        self.__result = None
+        self.__exception = None
+
+    def make_call(self):
+        pass
+
+    def wait(self):
+        if not self.__done:
+            self.__done = True
+            try:
+                self.__result = self.function(*self.args, **self.kwargs)
+            except Exception, exp:
+                self.__exception = exp
+
+    def get_result(self):
+        self.wait()
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+
+class ThreadRPC(LocalRPC):
+    """
+        LocalRPC that calls its function in a thread started by make_call, so
+        that several of them overlap the way real rpcs do.
+    """
+    # notified as each ThreadRPC finishes
+    finished = threading.Condition()
+
+    def __init__(self, function, *args, **kwargs):
+        super(ThreadRPC, self).__init__(function, *args, **kwargs)
+        self.thread = None
+        self.done = False
+
+    def make_call(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__call)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def __call(self):
+        LocalRPC.wait(self)
+        self.finished.acquire()
+        try:
+            self.done = True
+            self.finished.notifyAll()
+        finally:
+            self.finished.release()
+
+    def wait(self):
+        self.make_call()
+        self.thread.join()
+
+    def wait_any(cls, rpcs, timeout=None):
+        """ wait until one of rpcs is done, returns it, or None after timeout seconds """
+        if timeout is not None:
+            deadline = _time.time() + timeout
+        cls.finished.acquire()
+        try:
+            while True:
+                for rpc in rpcs:
+                    if rpc.done:
+                        return rpc
+                if timeout is None:
+                    cls.finished.wait()
+                else:
+                    remaining = deadline - _time.time()
+                    if remaining <= 0:
+                        return None
+                    cls.finished.wait(remaining)
+        finally:
+            cls.finished.release()
+    wait_any = classmethod(wait_any)
+
+
+class LocalTask(RpcTask):
+    """
+        Task calling function(*args) in process. threaded=True calls it in a
+        thread of its own from make_call, e.g. for backends that sleep to fake
+        the latency of a remote one.
+    """
+    def __init__(self, function, *args, **kw):
+        self.__cache_key = kw.pop('cache_key', None)
+        if kw.pop('threaded', False):
+            rpc = ThreadRPC(function, *args)
+        else:
+            rpc = LocalRPC(function, *args)
+        super(LocalTask, self).__init__(rpc, **kw)
+
+    @property
+    def cache_key(self):
+        if self.__cache_key is None:
+            raise AbstractMethod
+        return self.__cache_key
+
+    def make_call(self):
+        self.rpc.make_call()
+
+
 class AsyncMultiTask(list):
     """
         Context for running async tasks in.
@@ -168,32 +303,126 @@ class AsyncMultiTask(list):
 
         for task in self:
             task.runner = self
+        self.rpc_count = 0
 
     def run(self):
         """Runs the tasks, some tasks create additional rpc objects which are appended to self
            when all tasks and rpcs have been waited on the extra items are deleted from self
+           rpc_count is then the number of rpcs waited on, additional ones included
         """
         tasks = list(self)
         [ task.make_call() for task in self ]
         [ task.wait() for task in self ]
+        self.rpc_count = len(dict([(id(task), 1) for task in self]))
         self[:] = tasks
 
     def append(self, task):
         """Bind self to the task so the task, userrpc can append additional tasks to be run"""
         list.append(self, task)
-        if isinstance(task, (RpcTask, apiproxy_stub_map.UserRPC)):
+        if isinstance(task, (RpcTask, LocalRPC)) or (apiproxy_stub_map and isinstance(task, apiproxy_stub_map.UserRPC)):
             task.runner = self
 
     def __repr__(self):
         return "%s%s" % (type(self), list.__repr__(self))
 
 
+class TaskRpcs(list):
+    """
+        Runner one task's rpcs see under CompletionMultiTask: the rpcs they
+        append, e.g. datastore Next calls, are its rpcs still to be waited on.
+    """
+    def __init__(self, task):
+        super(TaskRpcs, self).__init__([task.rpc])
+        self.task = task
+
+    def append(self, rpc):
+        if rpc not in self:
+            list.append(self, rpc)
+            rpc.runner = self
+
+
+class CompletionMultiTask(list):
+    """
+        Runs at most concurrency tasks at a time (None for no bound), each
+        with its follow-up rpcs, and yields tasks from as_completed in the
+        order they finish, so that results can be used while slower tasks
+        are still running.
+
+        deadline: seconds from a task's make_call after which it is expired
+        and yielded anyway; its get_result raises DeadlineExceededError.
+        Deadlines are checked whenever a wait returns, so a UserRPC should
+        also carry a deadline of its own to bound a single wait.
+    """
+    def __init__(self, tasks=None, concurrency=4, deadline=None):
+        if tasks is None:
+            super(CompletionMultiTask, self).__init__()
+        else:
+            super(CompletionMultiTask, self).__init__(tasks)
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.rpc_count = 0
+
+    def run(self):
+        for task in self.as_completed():
+            pass
+
+    def as_completed(self):
+        tasks = list(self)
+        queue = list(tasks)
+        running = []
+        started = {}
+        while queue or running:
+            while queue and (not self.concurrency or len(running) < self.concurrency):
+                task = queue.pop(0)
+                task.runner = TaskRpcs(task)
+                started[id(task)] = _time.time()
+                task.make_call()
+                running.append(task)
+
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(0, min([started[id(task)] for task in running]) + self.deadline - _time.time())
+            rpc = self.wait_any([task.runner[0] for task in running], timeout)
+            if rpc is not None:
+                # waiting runs the callbacks that may append follow-up rpcs
+                rpc.wait()
+                rpc.runner.remove(rpc)
+                self.rpc_count += 1
+
+            now = _time.time()
+            for task in list(running):
+                if not task.runner:
+                    running.remove(task)
+                    yield task
+                elif self.deadline is not None and now >= started[id(task)] + self.deadline:
+                    logging.info("%r missed its deadline of %ss." % (task, self.deadline))
+                    task.expire()
+                    running.remove(task)
+                    yield task
+        self[:] = tasks
+
+    def wait_any(self, rpcs, timeout=None):
+        """ wait for one of rpcs, where their type can; otherwise the first of them """
+        rpc_type = type(rpcs[0])
+        if [1 for rpc in rpcs if type(rpc) is not rpc_type]:
+            return rpcs[0]
+        if rpc_type is ThreadRPC:
+            return ThreadRPC.wait_any(rpcs, timeout)
+        if hasattr(rpc_type, 'wait_any'):
+            return rpc_type.wait_any(rpcs)
+        return rpcs[0]
+
+    def __repr__(self):
+        return "%s%s" % (type(self), list.__repr__(self))
+
+
 def determine_cache_hits_misses(tasks, cache_results):
     have = []
     todo = []
     for task in tasks:
+        # an empty result is a hit too: only a key with nothing cached is a miss
         result = cache_results.get(task.cache_key)
-        if result:
+        if task.cache_key in cache_results and result is not None:
             have.append(task)
             task.cache_result = result
         else:
@@ -201,35 +430,285 @@ def determine_cache_hits_misses(tasks, cache_results):
     return (have, todo)
 
 
+class LocalCache(object):
+    """
+        Per-process LRU cache with the get_multi / set_multi interface of memcache.
+        Entries expire after time seconds (0 = only as set_multi asks), and the
+        least recently used are evicted once the pickled size of all entries
+        passes max_bytes. Values are shared, not copied: don't mutate them.
+        With add and delete it also stands in for memcache in local runs.
+    """
+    def __init__(self, max_bytes=4 << 20, time=0):
+        self.max_bytes = max_bytes
+        self.time = time
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        # circular list, most recently used first, of [prev, next, key, value, size, expires]
+        self.__head = [None, None, None, None, 0, 0]
+        self.__head[0] = self.__head[1] = self.__head
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def __push(self, entry):
+        head = self.__head
+        entry[0] = head
+        entry[1] = head[1]
+        head[1][0] = entry
+        head[1] = entry
+
+    def __remove(self, entry):
+        self.__unlink(entry)
+        del self.__entries[entry[2]]
+        self.bytes -= entry[4]
+
+    def get_multi(self, keys, namespace=None):
+        results = {}
+        now = _time.time()
+        self.__lock.acquire()
+        try:
+            for key in keys:
+                entry = self.__entries.get((namespace, key))
+                if entry is not None and entry[5] and entry[5] < now:
+                    self.__remove(entry)
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self.__unlink(entry)
+                self.__push(entry)
+                results[key] = entry[3]
+        finally:
+            self.__lock.release()
+        return results
+
+    def add(self, key, value, time=0, namespace=None):
+        """ set value unless key is already cached, returns True if it was set """
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get((namespace, key))
+            if entry is not None and not (entry[5] and entry[5] < _time.time()):
+                return False
+            return not self.__set({key: value}, time, namespace)
+        finally:
+            self.__lock.release()
+
+    def delete(self, key, namespace=None):
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get((namespace, key))
+            if entry is not None:
+                self.__remove(entry)
+        finally:
+            self.__lock.release()
+
+    def set_multi(self, mapping, time=0, namespace=None):
+        """ set values, returns the keys that were too big to keep """
+        self.__lock.acquire()
+        try:
+            return self.__set(mapping, time, namespace)
+        finally:
+            self.__lock.release()
+
+    def __set(self, mapping, time, namespace):
+        failed = []
+        if time and self.time:
+            time = min(time, self.time)
+        else:
+            time = time or self.time
+        expires = time and _time.time() + time or 0
+        for key, value in mapping.items():
+            size = len(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+            if size > self.max_bytes:
+                failed.append(key)
+                continue
+            entry = self.__entries.get((namespace, key))
+            if entry is not None:
+                self.__remove(entry)
+            entry = [None, None, (namespace, key), value, size, expires]
+            self.__entries[entry[2]] = entry
+            self.__push(entry)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.__remove(self.__head[0])
+                self.evictions += 1
+        return failed
+
+
 class CachedMultiTask(list):
-    def __init__(self, tasks=None, time=0, namespace=None, memcache=memcache.Client(), runner_type=AsyncMultiTask):
+    """
+        Runs tasks through memcache, and optionally through a per-process
+        LocalCache in front of it. Hits and misses of each tier are counted
+        in stats after run, lookup_time is the seconds spent reading the
+        cache tiers and rpc_count the rpcs run on misses.
+
+        single_flight: on a miss, only the runner that wins a memcache add()
+        lock on the cache_key fetches it; the others poll memcache for its
+        result for up to wait seconds, then fetch it themselves.
+
+        stale_time: entries are kept stale_time seconds past time. A stale hit
+        is served as is while the runner that wins the lock refreshes it.
+
+        codec: object with encode(result) and decode(data) methods applied to
+        memcache values, e.g. to pack results smaller than their pickle.
+        decode returns None for data it can't read, which counts as a miss.
+        The local cache keeps decoded results.
+    """
+    lock_prefix = 'lock:'
+    stale_marker = '__stale__'
+
+    def __init__(self, tasks=None, time=0, namespace=None, memcache=None, runner_type=AsyncMultiTask, local_cache=None,
+                 single_flight=False, stale_time=0, lock_time=10, wait=2.0, poll=0.05, codec=None):
         if tasks is None:
             super(CachedMultiTask,self).__init__()
         else:
             super(CachedMultiTask,self).__init__(tasks)
         self.time = time
         self.namespace = namespace
+        if memcache is None:
+            memcache = memcache_builtin.Client()
         self.memcache = memcache
         self.runner_type = runner_type
+        self.local_cache = local_cache
+        self.single_flight = single_flight
+        self.stale_time = stale_time
+        self.lock_time = lock_time
+        self.wait = wait
+        self.poll = poll
+        self.codec = codec
+        self.stats = {}
+        self.lookup_time = 0.0
+        self.rpc_count = 0
 
     def run(self):
         """
         run tasks asyncronously, tasks may create additional UserRPC objects that are also inturn waited on.
 
-        1. Fetch from memcache
-        2. Filter into hits and misses (have, todo)
-        3. Async run todo
-        4. Set todo results into memcache
+        1. Fetch from the local cache, then memcache for what it misses
+        2. Filter into hits, stale hits and misses (have, stale, todo)
+        3. Lock the misses when coalescing, serve stale hits someone else refreshes, and read
+           memcache again for the locks won, as another runner may have set them since
+        4. Async run what this runner holds
+        5. Set results into memcache and the local cache, and memcache hits into the local cache
+        6. Wait for the misses other runners hold
         """
-        cache_keys = [t.cache_key for t in self]
+        tasks = list(self)
+        self.stats = {'local_hits': 0, 'local_misses': 0, 'memcache_hits': 0, 'memcache_misses': 0,
+                      'stale_hits': 0, 'coalesced': 0}
+        self.rpc_count = 0
+        started = _time.time()
+
+        if self.local_cache is not None:
+            local_results = self.local_cache.get_multi([t.cache_key for t in tasks], namespace=self.namespace)
+            have, tasks = determine_cache_hits_misses(tasks, local_results)
+            self.stats['local_hits'] = len(have)
+            self.stats['local_misses'] = len(tasks)
 
-        cache_results = self.memcache.get_multi(cache_keys, namespace=self.namespace)
+        cache_keys = [t.cache_key for t in tasks]
+
+        if cache_keys:
+            cache_results = self.memcache.get_multi(cache_keys, namespace=self.namespace)
+        else:
+            cache_results = {}
+        cache_results, stale = self.split_stale(cache_results)
+        cache_results, stale = self.decode(cache_results), self.decode(stale)
+        self.lookup_time = _time.time() - started
+
+        have, todo = determine_cache_hits_misses(tasks, cache_results)
+        self.stats['memcache_hits'] = len(have)
+        self.stats['memcache_misses'] = len(todo)
+
+        if have and self.local_cache is not None:
+            self.local_cache.set_multi(dict([(t.cache_key, t.cache_result) for t in have]), time=self.time, namespace=self.namespace)
+
+        run, won, waiting, locked = [], [], [], []
+        for task in todo:
+            if task.cache_key in stale or self.single_flight:
+                if self.lock(task.cache_key):
+                    locked.append(task.cache_key)
+                    won.append(task)
+                elif task.cache_key in stale:
+                    task.cache_result = stale[task.cache_key]
+                    self.stats['stale_hits'] += 1
+                else:
+                    waiting.append(task)
+            else:
+                run.append(task)
+
+        try:
+            self.fetch(run + self.recheck(won))
+        finally:
+            for key in locked:
+                self.memcache.delete(self.lock_prefix + key, namespace=self.namespace)
+
+        if waiting:
+            self.fetch(self.wait_for(waiting))
+
+    def lock(self, cache_key):
+        return self.memcache.add(self.lock_prefix + cache_key, 1, time=self.lock_time, namespace=self.namespace)
+
+    def recheck(self, tasks):
+        """ fresh results of locked tasks set since the first read, by a runner that has let go of its lock; returns the tasks still to fetch """
+        if not tasks:
+            return tasks
+        cache_results = self.memcache.get_multi([t.cache_key for t in tasks], namespace=self.namespace)
+        have, tasks = determine_cache_hits_misses(tasks, self.decode(self.split_stale(cache_results)[0]))
+        self.stats['coalesced'] += len(have)
+        if have and self.local_cache is not None:
+            self.local_cache.set_multi(dict([(t.cache_key, t.cache_result) for t in have]), time=self.time, namespace=self.namespace)
+        return tasks
+
+    def split_stale(self, cache_results):
+        """ unwrap stale_time entries into (fresh, stale) dicts of results """
+        if not self.stale_time:
+            return cache_results, {}
+        now = _time.time()
+        fresh, stale = {}, {}
+        for key, value in cache_results.items():
+            if isinstance(value, tuple) and len(value) == 3 and value[0] == self.stale_marker:
+                if value[1] < now:
+                    stale[key] = value[2]
+                    continue
+                value = value[2]
+            fresh[key] = value
+        return fresh, stale
+
+    def decode(self, cache_results):
+        if self.codec is None:
+            return cache_results
+        results = {}
+        for key, data in cache_results.items():
+            result = self.codec.decode(data)
+            if result is not None:
+                results[key] = result
+        return results
+
+    def encode(self, set_dict):
+        if self.codec is None:
+            return set_dict
+        mapping = {}
+        for key, result in set_dict.items():
+            try:
+                mapping[key] = self.codec.encode(result)
+            except Exception:
+                logging.info("Exception encoding %s for the cache. Not cached." % key, exc_info=True)
+        return mapping
 
-        have, todo = determine_cache_hits_misses(self, cache_results)
-        # determine cached tasks
+    def fetch(self, todo):
+        """ run todo and set the results into the cache tiers """
         if len(todo) > 0:
             task_runner = self.runner_type(todo)
             task_runner.run()
+            self.rpc_count += getattr(task_runner, 'rpc_count', len(todo))
         set_dict = {}
         for task in todo:
             try:
@@ -237,11 +716,41 @@ class CachedMultiTask(list):
             except Exception:
                 logging.info("Exception retrieving items after cache miss. Continuing.", exc_info=True)
         if set_dict:
-            failed = self.memcache.set_multi(set_dict, time=self.time, namespace=self.namespace)
+            mapping = self.encode(set_dict)
+            if self.stale_time:
+                fresh_until = _time.time() + self.time
+                mapping = dict([(key, (self.stale_marker, fresh_until, value)) for key, value in mapping.items()])
+                failed = self.memcache.set_multi(mapping, time=self.time + self.stale_time, namespace=self.namespace)
+            else:
+                failed = self.memcache.set_multi(mapping, time=self.time, namespace=self.namespace)
             if failed:
-                logging.info("Memcache set_multi failed. %d items failed: %s" (len(failed), failed))
+                logging.info("Memcache set_multi failed. %d items failed: %s" % (len(failed), failed))
             if len(failed) == len(todo):
                 logging.error("Memcache set_multi failed entirely.")
+            if self.local_cache is not None:
+                self.local_cache.set_multi(set_dict, time=self.time, namespace=self.namespace)
+
+    def wait_for(self, tasks):
+        """ poll memcache for results other runners are fetching, returns the tasks still missing """
+        deadline = _time.time() + self.wait
+        while tasks and _time.time() < deadline:
+            _time.sleep(self.poll)
+            cache_results = self.memcache.get_multi([t.cache_key for t in tasks], namespace=self.namespace)
+            cache_results = self.decode(self.split_stale(cache_results)[0])
+            missing = []
+            for task in tasks:
+                if task.cache_key in cache_results:
+                    task.cache_result = cache_results[task.cache_key]
+                    self.stats['coalesced'] += 1
+                else:
+                    missing.append(task)
+            if self.local_cache is not None and len(missing) < len(tasks):
+                found = dict([(t.cache_key, t.cache_result) for t in tasks if t not in missing])
+                self.local_cache.set_multi(found, time=self.time, namespace=self.namespace)
+            tasks = missing
+        if tasks:
+            logging.info("Gave up waiting on %d coalesced tasks." % len(tasks))
+        return tasks
 
     def __repr__(self):
         return "%s%s" % (type(self), list.__repr__(self))
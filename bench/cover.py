@@ -0,0 +1,78 @@
+"""
+Rows scanned and recall of faultline correction vs. geohash covering
+
+Plans random viewports with ffGeoSearch using correction=0/1/2 and
+cover=4/8/16, then answers every planned geohash range against a sorted
+list of random markers.  Limits are left unbounded so the numbers show
+what each plan can reach at all:
+
+rows/hit - rows in the queried ranges per marker inside the viewport
+recall   - share of the markers inside the viewport that any range returns
+
+Usage: python bench/cover.py [markers] [viewports]
+"""
+
+import os, sys, random, bisect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geohash
+from ffGeoSearch import ffGeoSearch
+
+MODES = [
+	('correction=0', {'correction' : 0}),
+	('correction=1', {'correction' : 1}),
+	('correction=2', {'correction' : 2}),
+	('cover=4', {'cover' : 4}),
+	('cover=8', {'cover' : 8}),
+	('cover=16', {'cover' : 16}),
+]
+
+# random viewport, spanning anything from a city block to the world
+def viewport():
+	span = 10 ** random.uniform(-2, 2.5)
+	west = random.uniform(-180, 180)
+	south = random.uniform(-90, 90 - min(span / 2, 170))
+	east = west + span
+	if east > 180: east -= 360
+	return (west, south, east, min(90, south + span / 2))
+
+def inside(bbox, lng, lat):
+	west, south, east, north = bbox
+	if not south <= lat <= north:
+		return False
+	if west > east:
+		return lng >= west or lng <= east
+	return west <= lng <= east
+
+def main():
+	count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+	trials = len(sys.argv) > 2 and int(sys.argv[2]) or 200
+
+	points = [(random.uniform(-180, 180), random.uniform(-90, 90)) for i in range(count)]
+	hashes, strings = geohash.encode_many([p[0] for p in points], [p[1] for p in points])
+	rows = zip([str(h) for h in hashes], points)
+	rows.sort()
+	keys = [row[0] for row in rows]
+
+	viewports = [viewport() for i in range(trials)]
+	
+	print "%-14s %8s %10s %8s" % ('mode', 'queries', 'rows/hit', 'recall')
+
+	for name, kwargs in MODES:
+		queries = scanned = found = wanted = 0
+		for bbox in viewports:
+			geo = ffGeoSearch(bbox=','.join(map(str, bbox)), limit=10 ** 9, **kwargs)
+			queries += len(geo.boxes)
+			wanted += len([p for p in points if inside(bbox, p[0], p[1])])
+			for box in geo.boxes:
+				# geohash > :sw_geohash AND geohash < :ne_geohash
+				first = bisect.bisect_right(keys, box['sw_geohash'])
+				last = bisect.bisect_left(keys, box['ne_geohash'])
+				scanned += max(0, last - first)
+				found += len([1 for key, p in rows[first:last] if inside(bbox, p[0], p[1])])
+
+		print "%-14s %8.2f %10.2f %8.3f" % (name, queries / float(trials),
+			scanned / float(max(1, found)), found / float(max(1, wanted)))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,209 @@
+"""
+Recall, over-fetch, query count and latency of ffGeoSearch
+
+Searches random viewports, from zoom 0 to 18 and some across the dateline,
+over uniform and clustered in-memory point sets, with each search mode, and
+compares every result set with brute force:
+
+recall      - markers returned inside the viewport, per marker the limit
+              allowed for (the lesser of limit and markers in the viewport)
+precision   - share of returned markers inside the viewport
+rows/result - rows the backend returned per marker in the results
+queries     - range scans per search
+p50/p99     - ms for ffGeoSearch(...) plus search()
+
+Usage: python bench/ffgeosearch.py [options]
+  -n 100000       markers per dataset
+  -v 200          viewports per dataset
+  -l 100          limit
+  -m correction=0 modes, comma separated name=value arguments, repeatable
+  --by-zoom       one row per mode and band of zoom levels
+  --json FILE     also write one JSON object per row to FILE ('-' for stdout)
+  --seed 1        random seed
+  --codes         scan a column of integer Morton codes rather than geohashes
+"""
+
+import os, sys, time, random, bisect
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ffBackend import MemoryBackend
+from ffGeoSearch import ffGeoSearch
+
+try:
+	import json
+except ImportError:
+	import simplejson as json
+
+MODES = [
+	'correction=0',
+	'correction=1',
+	'correction=2',
+	'correction=1,border=0.05',
+	'correction=1,border=0.3',
+	'cover=8',
+	'cover=8,filter=1',
+	'cover=8,filter=1,merge=1',
+]
+
+ZOOM_BANDS = [(0, 4), (5, 9), (10, 14), (15, 18)]
+
+# counts the rows and queries served
+class CountingBackend(MemoryBackend):
+
+	def __init__(self, points, codes=False):
+		MemoryBackend.__init__(self, points, codes=codes)
+		self.rows = 0
+		self.queries = 0
+
+	def scan(self, lo, hi, limit):
+		rows = MemoryBackend.scan(self, lo, hi, limit)
+		self.rows += len(rows)
+		self.queries += 1
+		return rows
+
+def uniform(count):
+	return [(random.uniform(-180, 180), random.uniform(-90, 90)) for i in range(count)]
+
+# markers around a few hundred centres, each as dense as a city or as loose as a country
+def clustered(count):
+	centres = [(random.uniform(-180, 180), random.uniform(-60, 70), 10 ** random.uniform(-2.5, 0.5)) for i in range(300)]
+	points = []
+	for i in range(count):
+		lng, lat, sigma = random.choice(centres)
+		lng = random.gauss(lng, sigma)
+		lng = (lng + 180) % 360 - 180
+		lat = max(-90, min(90, random.gauss(lat, sigma / 2)))
+		points.append((lng, lat))
+	return points
+
+# (zoom, bbox) at a random zoom level, centred on a marker half the time, crossing the dateline a tenth of the time
+def viewport(points):
+	zoom = random.randint(0, 18)
+	width = min(359.0, 360.0 / 2 ** zoom * 1.5)
+	height = min(170.0, 180.0 / 2 ** zoom)
+
+	if random.random() < 0.1:
+		lng = random.choice([-180, 180]) + random.uniform(-width / 4, width / 4)
+		lat = random.uniform(-80, 80)
+	elif random.random() < 0.5:
+		lng, lat = random.choice(points)
+	else:
+		lng, lat = random.uniform(-180, 180), random.uniform(-80, 80)
+
+	west = (lng - width / 2 + 180) % 360 - 180
+	east = (lng + width / 2 + 180) % 360 - 180
+	south = max(-90, lat - height / 2)
+	north = min(90, lat + height / 2)
+	return zoom, (west, south, east, north)
+
+def inside(bbox, lng, lat):
+	west, south, east, north = bbox
+	if not south <= lat <= north:
+		return False
+	if west > east:
+		return lng >= west or lng <= east
+	return west <= lng <= east
+
+# markers inside bbox, from points sorted by latitude
+def truth(by_lat, lats, bbox):
+	first = bisect.bisect_left(lats, bbox[1])
+	last = bisect.bisect_right(lats, bbox[3])
+	return [point for point in by_lat[first:last] if inside(bbox, point[0], point[1])]
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def parse_mode(mode):
+	kwargs = {}
+	for pair in mode.split(','):
+		name, value = pair.split('=')
+		if name in ('filter', 'merge', 'density'):
+			kwargs[name] = value not in ('0', 'off', 'False')
+		elif '.' in value:
+			kwargs[name] = float(value)
+		else:
+			kwargs[name] = int(value)
+	return kwargs
+
+def measure(backend, by_lat, lats, viewports, mode, limit):
+	kwargs = parse_mode(mode)
+	times = []
+	wanted = found = returned = 0
+	backend.rows = backend.queries = 0
+
+	for zoom, bbox in viewports:
+		start = time.time()
+		geo = ffGeoSearch(bbox='%r,%r,%r,%r' % bbox, limit=limit, backend=backend, **kwargs)
+		geo.search()
+		times.append(1000 * (time.time() - start))
+
+		wanted += min(limit, len(truth(by_lat, lats, bbox)))
+		found += len([1 for result in geo.results if inside(bbox, result['lng'], result['lat'])])
+		returned += len(geo.results)
+
+	return {
+		'viewports' : len(viewports),
+		'recall' : found / float(max(1, wanted)),
+		'precision' : found / float(max(1, returned)),
+		'rows_per_result' : backend.rows / float(max(1, returned)),
+		'queries' : backend.queries / float(max(1, len(viewports))),
+		'p50_ms' : percentile(times, 0.5),
+		'p99_ms' : percentile(times, 0.99)
+	}
+
+def main():
+	parser = OptionParser(usage='python bench/ffgeosearch.py [options]')
+	parser.add_option('-n', '--markers', type='int', default=100000)
+	parser.add_option('-v', '--viewports', type='int', default=200)
+	parser.add_option('-l', '--limit', type='int', default=100)
+	parser.add_option('-m', '--mode', action='append', dest='modes')
+	parser.add_option('--by-zoom', action='store_true', default=False)
+	parser.add_option('--json', dest='json_file')
+	parser.add_option('--seed', type='int', default=1)
+	parser.add_option('--codes', action='store_true', default=False)
+	options, args = parser.parse_args()
+
+	random.seed(options.seed)
+
+	# the table goes to stderr when stdout is for json
+	out = None
+	table = sys.stdout
+	if options.json_file == '-':
+		out = sys.stdout
+		table = sys.stderr
+	elif options.json_file:
+		out = open(options.json_file, 'w')
+
+	print >>table, "%-10s %-26s %-6s %7s %9s %11s %8s %8s %8s" % ('dataset', 'mode', 'zoom', 'recall', 'precision', 'rows/result', 'queries', 'p50', 'p99')
+
+	for name, generate in [('uniform', uniform), ('clustered', clustered)]:
+		points = generate(options.markers)
+		backend = CountingBackend(points, options.codes)
+		by_lat = sorted(points, key=lambda point: point[1])
+		lats = [point[1] for point in by_lat]
+		viewports = [viewport(points) for i in range(options.viewports)]
+
+		if options.by_zoom:
+			bands = [(band, [v for v in viewports if band[0] <= v[0] <= band[1]]) for band in ZOOM_BANDS]
+		else:
+			bands = [((0, 18), viewports)]
+
+		for mode in options.modes or MODES:
+			for band, selected in bands:
+				if not selected:
+					continue
+				row = measure(backend, by_lat, lats, selected, mode, options.limit)
+				row.update({'dataset' : name, 'mode' : mode, 'zoom' : '%d-%d' % band, 'markers' : options.markers, 'limit' : options.limit})
+
+				print >>table, "%-10s %-26s %-6s %7.3f %9.3f %11.2f %8.2f %8.1f %8.1f" % (name, mode, row['zoom'], row['recall'], row['precision'],
+					row['rows_per_result'], row['queries'], row['p50_ms'], row['p99_ms'])
+				if out:
+					out.write(json.dumps(row, sort_keys=True) + '\n')
+
+	if out and out is not sys.stdout:
+		out.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,109 @@
+"""
+Microbenchmark for the integer geohash codec
+
+Compares geohash.Geostring / geohash.Geohash encoding and Geohash.bbox()
+decoding against the list-based implementation they replaced, after
+checking that both give identical strings and bounding boxes.
+
+Usage: python bench/geohash_codec.py [points]
+"""
+
+import os, sys, random, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geohash
+
+# the list-based codec as it was before the integer fast path
+class LegacyGeostring (geohash.Geostring):
+	def _to_bits (cls,f,depth=32):
+		f *= (1L << depth)
+		return [(long(f) >> (depth-i)) & 1 for i in range(1,depth+1)]
+	_to_bits = classmethod(_to_bits)
+
+	def bitstring (cls,(x,y),bound=(-180,-90,180,90),depth=32):
+		x = cls._to_bits((x-bound[0])/float(bound[2]-bound[0]),depth)
+		y = cls._to_bits((y-bound[1])/float(bound[3]-bound[1]),depth)
+		bits = reduce(lambda x,y:x+list(y), zip(x,y), [])
+		return "".join(map(str,bits))
+	bitstring = classmethod(bitstring)
+
+	def _to_bbox (self, bits):
+		depth = len(bits)/2
+		minx = miny = 0.0
+		maxx = maxy = 1.0
+		for i in range(depth+1):
+			try:
+				minx += float(bits[i*2])/(2L<<i)
+				miny += float(bits[i*2+1])/(2L<<i)
+			except IndexError:
+				pass
+		if depth:
+			maxx = minx + 1.0/(2L<<(depth-1))
+			maxy = miny + 1.0/(2L<<(depth-1))
+		elif len(bits) == 1:
+			maxx = min(minx + .5, 1.0)
+		minx, maxx = [self.origin[0]+x*self.size[0] for x in (minx,maxx)]
+		miny, maxy = [self.origin[1]+y*self.size[1] for y in (miny,maxy)]
+		return tuple([round(x,6) for x in minx, miny, maxx, maxy])
+
+	def bbox (self, prefix=None):
+		if not prefix: prefix=len(self.hash)
+		return self._to_bbox(self.hash[:prefix])
+
+class LegacyGeohash (LegacyGeostring):
+	BASE_32 = geohash.Geohash.BASE_32
+
+	def bitstring (cls,coord,bound=(-180,-90,180,90),depth=32):
+		bits = LegacyGeostring.bitstring(coord,bound,depth)
+		hash = ""
+		for i in range(0,len(bits),5):
+			m = sum([int(n)<<(4-j) for j,n in enumerate(bits[i:i+5])])
+			hash += cls.BASE_32[m]
+		return hash
+	bitstring = classmethod(bitstring)
+
+	def bbox (self,prefix=None):
+		if not prefix: prefix=len(self.hash)
+		bits = [[n>>(4-i)&1 for i in range(5)]
+					for n in map(self.BASE_32.find, self.hash[:prefix])]
+		bits = reduce(lambda x,y:x+y, bits, [])
+		return self._to_bbox(bits)
+
+# seconds per call of fn over every item
+def timed(fn, items):
+	start = time.time()
+	for item in items:
+		fn(item)
+	return (time.time() - start) / len(items)
+
+def main():
+	count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+	points = [(random.uniform(-180, 180), random.uniform(-90, 90)) for i in range(count)]
+
+	print "%5s  %-16s %12s %12s %8s" % ('depth', 'operation', 'legacy us', 'integer us', 'speedup')
+
+	for depth in (8, 16, 24, 32):
+		hashes = [str(geohash.Geohash(p, depth=depth)) for p in points]
+
+		# same answers first, then timings
+		for p, h in zip(points, hashes):
+			assert h == str(LegacyGeohash(p, depth=depth)), p
+			assert str(geohash.Geostring(p, depth=depth)) == str(LegacyGeostring(p, depth=depth)), p
+			assert geohash.Geohash(h).bbox() == LegacyGeohash(h).bbox(), h
+
+		cases = [
+			('Geostring encode', points,
+				lambda p: LegacyGeostring(p, depth=depth), lambda p: geohash.Geostring(p, depth=depth)),
+			('Geohash encode', points,
+				lambda p: LegacyGeohash(p, depth=depth), lambda p: geohash.Geohash(p, depth=depth)),
+			('Geohash bbox', hashes,
+				lambda h: LegacyGeohash(h).bbox(), lambda h: geohash.Geohash(h).bbox()),
+		]
+
+		for name, items, legacy, fast in cases:
+			before = timed(legacy, items)
+			after = timed(fast, items)
+			print "%5d  %-16s %12.2f %12.2f %7.1fx" % (depth, name, before * 1e6, after * 1e6, before / after)
+
+if __name__ == "__main__":
+	main()
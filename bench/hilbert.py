@@ -0,0 +1,120 @@
+"""
+Key ranges and over-fetch of Hilbert vs. Z-order (geohash) covering
+
+Covers random viewports, from a city block to the world, with
+geohash.cover and geohash.hilbert_cover at a few range budgets, and answers
+every range against the same random markers keyed both ways.  Limits are
+left unbounded so the numbers show what each covering costs at all:
+
+ranges   - key ranges per viewport, after merging down to the budget
+rows/hit - rows in the ranges per marker inside the viewport
+recall   - share of the markers inside the viewport that any range returns
+plan     - ms to work out the ranges
+
+Then runs filtered searches with limit 100 through ffGeoSearch on a
+MemoryBackend of each curve, counting the rows fetched per marker returned.
+
+Usage: python bench/hilbert.py [markers] [viewports]
+"""
+
+import os, sys, time, random, bisect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geohash
+from ffBackend import MemoryBackend
+from ffGeoSearch import ffGeoSearch
+
+BUDGETS = [1, 4, 8, 16]
+
+# counts the rows and queries served
+class CountingBackend(MemoryBackend):
+
+	def __init__(self, points, curve):
+		MemoryBackend.__init__(self, points, curve=curve)
+		self.rows = 0
+		self.queries = 0
+
+	def scan(self, lo, hi, limit):
+		rows = MemoryBackend.scan(self, lo, hi, limit)
+		self.rows += len(rows)
+		self.queries += 1
+		return rows
+
+# random viewport, spanning anything from a city block to the world
+def viewport():
+	span = 10 ** random.uniform(-2, 2.5)
+	west = random.uniform(-180, 180)
+	south = random.uniform(-90, 90 - min(span / 2, 170))
+	east = west + span
+	if east > 180: east -= 360
+	return (west, south, east, min(90, south + span / 2))
+
+def inside(bbox, lng, lat):
+	west, south, east, north = bbox
+	if not south <= lat <= north:
+		return False
+	if west > east:
+		return lng >= west or lng <= east
+	return west <= lng <= east
+
+def main():
+	count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+	trials = len(sys.argv) > 2 and int(sys.argv[2]) or 200
+
+	random.seed(1)
+	points = [(random.uniform(-180, 180), random.uniform(-90, 90)) for i in range(count)]
+	hashes = geohash.encode_many([p[0] for p in points], [p[1] for p in points])[0]
+	curves = [
+		('z', geohash.cover, [str(h) for h in hashes]),
+		('hilbert', geohash.hilbert_cover, [str(geohash.Hilbert(p)) for p in points])
+	]
+
+	viewports = [viewport() for i in range(trials)]
+	wanted = [len([p for p in points if inside(bbox, p[0], p[1])]) for bbox in viewports]
+
+	print "%-8s %7s %8s %10s %8s %8s" % ('curve', 'budget', 'ranges', 'rows/hit', 'recall', 'plan')
+
+	for budget in BUDGETS:
+		for name, cover, keys in curves:
+			rows = zip(keys, points)
+			rows.sort()
+			keys = [row[0] for row in rows]
+
+			ranges = scanned = found = 0
+			planning = 0.0
+			for bbox in viewports:
+				started = time.time()
+				covered = cover(bbox, budget)
+				planning += time.time() - started
+				ranges += len(covered)
+				for lo, hi in covered:
+					first = bisect.bisect_left(keys, lo)
+					last = bisect.bisect_left(keys, hi)
+					scanned += last - first
+					found += len([1 for key, p in rows[first:last] if inside(bbox, p[0], p[1])])
+
+			print "%-8s %7d %8.2f %10.2f %8.3f %8.2f" % (name, budget, ranges / float(trials),
+				scanned / float(max(1, found)), found / float(max(1, sum(wanted))), 1000 * planning / trials)
+
+	print
+	print "%-8s %7s %8s %13s %8s" % ('curve', 'cover', 'queries', 'rows/result', 'p50')
+
+	for name, cover, keys in curves:
+		backend = CountingBackend(points, name)
+		for budget in BUDGETS[1:]:
+			backend.rows = backend.queries = 0
+			returned = 0
+			times = []
+			for bbox in viewports:
+				started = time.time()
+				geo = ffGeoSearch(bbox='%r,%r,%r,%r' % bbox, limit=100, backend=backend, cover=budget, filter=True, curve=name)
+				geo.search()
+				times.append(1000 * (time.time() - started))
+				returned += len(geo.results)
+			times.sort()
+
+			print "%-8s %7d %8.2f %13.2f %8.1f" % (name, budget, backend.queries / float(trials),
+				backend.rows / float(max(1, returned)), times[len(times) / 2])
+
+if __name__ == "__main__":
+	main()
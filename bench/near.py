@@ -0,0 +1,79 @@
+"""
+Rows read and exactness of ffNearSearch
+
+Searches around random points, half of them near a marker and half
+anywhere, over uniform and clustered in-memory point sets, for a few limits
+with and without a radius, and compares every result list with brute force:
+
+exact       - share of searches whose distances match brute force's nearest
+rows/result - rows the backend returned per marker in the results
+rings       - rings of cells scanned per search
+p50/p99     - ms for ffNearSearch(...) plus search()
+
+Usage: python bench/near.py [markers] [points]
+"""
+
+import os, sys, time, random
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ffBackend import MemoryBackend
+from ffNearSearch import ffNearSearch, haversine
+from ffTrace import Trace
+from ffgeosearch import clustered
+
+LIMITS = [1, 10, 100, 1000]
+RADII = [None, 1000.0, 50000.0]
+
+# a point near a marker half the time, anywhere the rest
+def point(points):
+	if random.random() < 0.5:
+		lng, lat = random.choice(points)
+		lng = (random.gauss(lng, 0.01) + 180) % 360 - 180
+		return lng, max(-90, min(90, random.gauss(lat, 0.01)))
+	return random.uniform(-180, 180), random.uniform(-90, 90)
+
+def main():
+	count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+	trials = len(sys.argv) > 2 and int(sys.argv[2]) or 100
+
+	random.seed(1)
+	datasets = [
+		('uniform', [(random.uniform(-180, 180), random.uniform(-90, 90)) for i in range(count)]),
+		('clustered', clustered(count))
+	]
+
+	print "%-10s %6s %8s %7s %13s %7s %7s %7s" % ('dataset', 'limit', 'radius', 'exact', 'rows/result', 'rings', 'p50', 'p99')
+
+	for name, points in datasets:
+		backend = MemoryBackend(points)
+		centres = [point(points) for i in range(trials)]
+
+		# brute force distances from every point, nearest first
+		nearest = [sorted([haversine(lng, lat, p[0], p[1]) for p in points])[:max(LIMITS)] for lng, lat in centres]
+
+		for limit in LIMITS:
+			for radius in RADII:
+				exact = rows = returned = rings = 0
+				times = []
+				for (lng, lat), distances in zip(centres, nearest):
+					trace = Trace()
+					started = time.time()
+					near = ffNearSearch(point='%r,%r' % (lng, lat), limit=limit, radius=radius, backend=backend, trace=trace)
+					near.search()
+					times.append(1000 * (time.time() - started))
+
+					wanted = [distance for distance in distances[:limit] if radius is None or distance <= radius]
+					if [round(distance, 3) for distance in wanted] == [round(result['distance'], 3) for result in near.results]:
+						exact += 1
+					rows += trace.counters.get('rows_fetched', 0)
+					rings += trace.counters.get('rings', 0)
+					returned += len(near.results)
+				times.sort()
+
+				print "%-10s %6d %8s %7.3f %13.2f %7.2f %7.1f %7.1f" % (name, limit, radius is None and '-' or '%d' % radius,
+					exact / float(trials), rows / float(max(1, returned)), rings / float(trials),
+					times[len(times) / 2], times[min(len(times) - 1, int(len(times) * 0.99))])
+
+if __name__ == "__main__":
+	main()
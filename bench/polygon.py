@@ -0,0 +1,116 @@
+"""
+Polygon covering and point-in-polygon filtering of ffPolygon
+
+Covers random star shaped polygons, from a few edges to a country's worth,
+and sets of boxes, with ffPolygon's cells and with geohash.cover of their
+bbox at the same range budget, and answers the ranges against random
+markers keyed by geohash:
+
+ranges    - key ranges per polygon
+rows/hit  - rows in the ranges per marker inside the polygon
+recall    - share of the markers inside the polygon that any range returns
+plan      - ms to work out the ranges
+
+Then times contains() on the candidates of each polygon against a ray cast
+over every edge, in microseconds per candidate.
+
+Usage: python bench/polygon.py [markers] [polygons]
+"""
+
+import os, sys, time, random, bisect
+from math import pi, sin, cos
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geohash
+from ffPolygon import Polygon
+
+EDGES = [4, 32, 256, 2048]
+BUDGETS = [4, 16]
+
+# a star shaped ring of edges points around (lng, lat), up to radius degrees out
+def star(lng, lat, radius, edges):
+	points = []
+	for index in range(edges):
+		angle = 2 * pi * index / edges
+		reach = radius * random.uniform(0.3, 1)
+		points.append((max(-180, min(180, lng + reach * cos(angle))), max(-90, min(90, lat + reach * sin(angle) / 2))))
+	return points
+
+def polygon(edges):
+	lng, lat = random.uniform(-150, 150), random.uniform(-60, 60)
+	radius = 10 ** random.uniform(-1, 1.5)
+	if edges == 4:
+		# boxes rather than a star, some across the dateline
+		wrap = lambda lng: (lng + 180) % 360 - 180
+		return Polygon.from_boxes([(wrap(lng + dx * radius), lat, wrap(lng + (dx + 1) * radius), lat + radius / 2) for dx in (-3, 0, 2)])
+	return Polygon([[star(lng, lat, radius, edges)]])
+
+# ray cast over every edge, as without the index
+def contains(shape, lng, lat):
+	crossed = [False] * len(shape.parts)
+	for south, north, x, slope, part, x1, y1, x2, y2, west, east in shape.edges:
+		if south <= lat < north and lng < x + (lat - south) * slope:
+			crossed[part] = not crossed[part]
+	return True in crossed
+
+def main():
+	count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+	trials = len(sys.argv) > 2 and int(sys.argv[2]) or 50
+
+	random.seed(1)
+	points = [(random.uniform(-180, 180), random.uniform(-90, 90)) for i in range(count)]
+	rows = zip([str(hash) for hash in geohash.encode_many([p[0] for p in points], [p[1] for p in points])[0]], points)
+	rows.sort()
+	keys = [row[0] for row in rows]
+
+	print "%-6s %-8s %7s %8s %10s %8s %8s" % ('edges', 'planner', 'budget', 'ranges', 'rows/hit', 'recall', 'plan')
+
+	shapes = {}
+	for edges in EDGES:
+		shapes[edges] = [polygon(edges) for i in range(trials)]
+		wanted = [len([1 for p in points if shape.contains(p[0], p[1])]) for shape in shapes[edges]]
+
+		for budget in BUDGETS:
+			for name in ('bbox', 'polygon'):
+				ranges = scanned = found = 0
+				planning = 0.0
+				for shape in shapes[edges]:
+					started = time.time()
+					if name == 'bbox':
+						covered = geohash.cover(shape.bbox(), budget)
+					else:
+						covered = shape.cover(budget)
+					planning += time.time() - started
+					ranges += len(covered)
+					for lo, hi in covered:
+						first = bisect.bisect_left(keys, lo)
+						last = bisect.bisect_left(keys, hi)
+						scanned += last - first
+						found += len([1 for key, p in rows[first:last] if shape.contains(p[0], p[1])])
+
+				print "%-6d %-8s %7d %8.2f %10.2f %8.3f %8.2f" % (edges, name, budget, ranges / float(trials),
+					scanned / float(max(1, found)), found / float(max(1, sum(wanted))), 1000 * planning / trials)
+
+	print
+	print "%-6s %12s %12s" % ('edges', 'indexed us', 'all edges us')
+
+	for edges in EDGES:
+		indexed = brute = 0.0
+		tested = 0
+		for shape in shapes[edges]:
+			west, south, east, north = shape.bbox()
+			candidates = [p for p in points if west <= p[0] <= east and south <= p[1] <= north] or [(west, south)]
+			started = time.time()
+			for lng, lat in candidates:
+				shape.contains(lng, lat)
+			indexed += time.time() - started
+			started = time.time()
+			for lng, lat in candidates:
+				contains(shape, lng, lat)
+			brute += time.time() - started
+			tested += len(candidates)
+
+		print "%-6d %12.2f %12.2f" % (edges, 1e6 * indexed / tested, 1e6 * brute / tested)
+
+if __name__ == "__main__":
+	main()
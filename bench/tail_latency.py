@@ -0,0 +1,66 @@
+"""
+Tail latency of 1, 2 and 4 box searches by task runner
+
+Runs filtered searches against a MemoryBackend whose scans sleep for a
+lognormal latency (median 20ms by default, with a long tail), as a remote
+store would, under:
+
+async      - AsyncMultiTask: every query at once, results used in order
+completion - CompletionMultiTask: results filtered as each query completes
+deadline   - the same, giving up on queries still running after the deadline
+
+p50/p90/p99 - search time in ms
+rows        - markers returned per search
+
+Usage: python bench/tail_latency.py [searches] [median ms] [deadline ms]
+"""
+
+import os, sys, time, random, math
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ffBackend import MemoryBackend
+from ffGeoSearch import ffGeoSearch
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def main():
+	trials = len(sys.argv) > 1 and int(sys.argv[1]) or 50
+	median = (len(sys.argv) > 2 and float(sys.argv[2]) or 20.0) / 1000
+	deadline = (len(sys.argv) > 3 and float(sys.argv[3]) or 60.0) / 1000
+
+	points = [(random.uniform(-180, 180), random.uniform(-90, 90)) for i in range(100000)]
+	latency = lambda: random.lognormvariate(math.log(median), 0.8)
+	backend = MemoryBackend(points, latency=latency)
+
+	runners = [
+		('async', {}),
+		('completion', {'concurrency' : 4}),
+		('deadline', {'concurrency' : 4, 'deadline' : deadline}),
+	]
+	
+	print "%-6s %-11s %8s %8s %8s %8s" % ('boxes', 'runner', 'p50', 'p90', 'p99', 'rows')
+
+	for boxes in (1, 2, 4):
+		viewports = []
+		for i in range(trials):
+			west = random.uniform(-180, 150)
+			south = random.uniform(-80, 50)
+			viewports.append('%f,%f,%f,%f' % (west, south, west + 30, south + 30))
+			
+		for name, kwargs in runners:
+			times = []
+			rows = 0
+			for bbox in viewports:
+				geo = ffGeoSearch(bbox=bbox, limit=200, cover=boxes, filter=True, backend=backend, **kwargs)
+				start = time.time()
+				geo.search()
+				times.append(1000 * (time.time() - start))
+				rows += len(geo.results)
+				
+			print "%-6d %-11s %8.1f %8.1f %8.1f %8.1f" % (boxes, name, percentile(times, 0.5),
+				percentile(times, 0.9), percentile(times, 0.99), rows / float(trials))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,539 @@
+"""
+Storage backends for ffGeoSearch
+
+A backend answers one kind of question: the markers whose geohash lies in
+[lo, hi), in geohash order, at most limit of them.  Each answer comes back
+as an asynctools task so that every backend runs through the same
+AsyncMultiTask / CachedMultiTask runners.
+
+Backends also keep prefix counts: for every geohash prefix up to
+count_depth characters, the number of markers under it and the sums of
+their latitudes and longitudes.  These are maintained as markers are
+written, so counts and centroids for a set of cells cost one lookup per
+cell rather than a scan of the markers.
+
+DatastoreBackend - the App Engine datastore, via a GQL query
+MemoryBackend - markers held in process in a sorted geohash column, for
+benchmarks and load tests outside App Engine
+
+Backends have a codec for CachedMultiTask, by default a ProjectionCodec that
+caches only lat, lng and geohash.  Cache hits are then dicts of those three
+fields rather than entities: give codec=None to cache whole entities.
+
+For two phase searches a backend also answers with candidates, the geohash
+and key of each marker without the marker, and gets markers by key.  In the
+datastore this is a keys-only query, and needs key names made by
+marker_key_name, which start with the geohash.
+
+Either backend can instead keep the Morton code of each marker in an
+integer column, see geohash.hash_code: one 64 bit integer in place of the
+geohash and geostring strings.  Scans still take geohash keys, and turn them
+into exact integer ranges with geohash.code_range; rows get their geohash
+back from the code, so searches, paging and caching work unchanged.
+
+Either backend can also be keyed by a Hilbert curve rather than geohash,
+see geohash.Hilbert: markers then carry a 'hilbert' key, scans take ranges of
+Hilbert keys such as geohash.hilbert_cover gives, and rows come back with
+their hilbert key, and the geohash of their lat and lng worked out on the
+way, for the writers in ffOutput.  Prefix counts stay by geohash.
+
+Markers are written with put_task, a batch of them per task, and their prefix
+counts with add_prefix_counts, so that a loader such as ffIngest can run
+puts in parallel and fold the counts of many batches into one update.  A
+marker put under a key name already stored replaces the marker there, and
+named_task finds those, so that a loader can take back their counts.
+
+Usage outside App Engine:
+>>> backend = MemoryBackend([(-0.25, 51.5), (0.25, 52.5)])
+>>> geo = ffGeoSearch(bbox='-1,51,1,53', backend=backend)
+>>> geo.search()
+"""
+
+import re
+import struct
+import time
+import threading
+from array import array
+from bisect import bisect_left
+
+# geohash from http://mappinghacks.com/code/geohash.py.txt
+import geohash
+
+# asynctools from http://code.google.com/p/asynctools/
+from asynctools import QueryTask, LocalTask, AbstractMethod
+
+try:
+	# datastore
+	from google.appengine.ext import db
+	from google.appengine.api import datastore
+except ImportError:
+	db = datastore = None
+
+# prefix counts are kept to this many geohash characters
+PREFIX_COUNT_DEPTH = 6
+
+# datastore kind of the prefix counts; key names are 'p' + prefix, as names may not start with a digit
+PREFIX_COUNT_KIND = 'ffPrefixCount'
+
+# key name of a marker, the geohash then anything unique; names may not start with a digit
+def marker_key_name(hash, unique):
+	return 'g%s:%s' % (hash, unique)
+
+# geohash of a marker from its key, see marker_key_name
+def key_geohash(key):
+	name = key.name()
+	if not name or not name.startswith('g') or ':' not in name:
+		raise ValueError('key %r has no geohash in its name' % key)
+	return name[1:name.index(':')]
+
+# give rows without one the geohash of their lat and lng, as rows keyed by Hilbert curve have none
+def add_geohashes(rows):
+	missing = [row for row in rows if 'geohash' not in row]
+	if missing:
+		hashes = geohash.encode_many([row['lng'] for row in missing], [row['lat'] for row in missing])[0]
+		for row, hash in zip(missing, hashes):
+			row['geohash'] = str(hash)
+	return rows
+
+# (count, lat_sum, lng_sum) deltas for every prefix of the given (geohash, lat, lng) markers
+def prefix_deltas(markers, depth=PREFIX_COUNT_DEPTH):
+	deltas = {}
+	for hash, lat, lng in markers:
+		for chars in range(1, depth + 1):
+			delta = deltas.setdefault(hash[:chars], [0, 0.0, 0.0])
+			delta[0] += 1
+			delta[1] += lat
+			delta[2] += lng
+	return deltas
+
+# add (geohash, lat, lng) markers to the datastore prefix counts
+# a batch get and put, not a transaction: concurrent writers may lose increments
+def update_prefix_counts(markers, depth=PREFIX_COUNT_DEPTH):
+	add_prefix_deltas(prefix_deltas(markers, depth))
+
+# add deltas, as from prefix_deltas, to the datastore prefix counts, batch_size prefixes per get and put
+def add_prefix_deltas(deltas, batch_size=500):
+	prefixes = deltas.keys()
+	prefixes.sort()
+	for first in range(0, len(prefixes), batch_size):
+		put_prefix_deltas(deltas, prefixes[first:first + batch_size])
+		
+def put_prefix_deltas(deltas, prefixes):
+	entities = datastore.Get([datastore.Key.from_path(PREFIX_COUNT_KIND, 'p' + prefix) for prefix in prefixes])
+	
+	for key in range(len(prefixes)):
+		entity = entities[key]
+		if entity is None:
+			entity = entities[key] = datastore.Entity(PREFIX_COUNT_KIND, name='p' + prefixes[key])
+			entity['count'] = 0
+			entity['lat_sum'] = entity['lng_sum'] = 0.0
+		delta = deltas[prefixes[key]]
+		entity['count'] += delta[0]
+		entity['lat_sum'] += delta[1]
+		entity['lng_sum'] += delta[2]
+		
+	datastore.Put(entities)
+
+# packs a list of records into one column per field, and unpacks it into dicts of those fields
+# floats are arrays of doubles in native byte order, fine for a cache read back by the same app
+# strings are joined with NULs; both are a fraction of the size and decode time of pickled entities
+class ProjectionCodec(object):
+
+	magic = 'FFP1'
+	
+	def __init__(self, floats=('lat', 'lng'), strings=('geohash',)):
+		self.floats = tuple(floats)
+		self.strings = tuple(strings)
+		self.fields = self.floats + self.strings
+		
+	def encode(self, records):
+		out = [self.magic, struct.pack('<I', len(records))]
+		for field in self.floats:
+			out.append(array('d', [float(record[field]) for record in records]).tostring())
+		for field in self.strings:
+			column = '\0'.join([str(record[field]) for record in records])
+			out.append(struct.pack('<I', len(column)))
+			out.append(column)
+		return ''.join(out)
+		
+	# list of dicts, or None for data this codec didn't write
+	def decode(self, data):
+		if not isinstance(data, str) or not data.startswith(self.magic):
+			return None
+		[count] = struct.unpack_from('<I', data, 4)
+		if not count:
+			return []
+		offset = 8
+		columns = []
+		for field in self.floats:
+			column = array('d')
+			column.fromstring(data[offset:offset + count * column.itemsize])
+			offset += count * column.itemsize
+			columns.append(column)
+		for field in self.strings:
+			[size] = struct.unpack_from('<I', data, offset)
+			offset += 4
+			columns.append(data[offset:offset + size].split('\0'))
+			offset += size
+		fields = self.fields
+		return [dict(zip(fields, values)) for values in zip(*columns)]
+
+
+# range scans on the geohash column
+class GeoBackend(object):
+
+	count_depth = PREFIX_COUNT_DEPTH
+	
+	# the curve markers are ordered by, 'z' for geohash or 'hilbert', and the field of a row holding its key
+	curve = 'z'
+	key = 'geohash'
+	
+	# how CachedMultiTask packs scan results for memcache
+	codec = ProjectionCodec()
+	
+	# and candidates; keys come back from the cache as strings
+	keys_codec = ProjectionCodec(floats=(), strings=('geohash', 'key'))
+	
+	# and rows keyed by a Hilbert curve
+	hilbert_codec = ProjectionCodec(strings=('hilbert',))
+	
+	# task whose result is a {'geohash', 'key'} candidate for each marker scan_task would give
+	def keys_task(self, lo, hi, limit):
+		raise AbstractMethod
+		
+	# task whose result is the marker of each key, or None where there is none
+	def get_task(self, keys):
+		raise AbstractMethod
+
+	# task whose result is the markers with lo <= geohash < hi in geohash order, at most limit of them
+	def scan_task(self, lo, hi, limit):
+		raise AbstractMethod
+		
+	# task that writes markers, dicts of key_name, lat, lng, geohash and geostring, over any of the same key names
+	# threaded=True calls it in a thread of its own, so that several puts overlap
+	def put_task(self, markers, threaded=False):
+		raise AbstractMethod
+		
+	# task whose result is the {'geohash', 'lat', 'lng'} of the marker of each key name, or None where there is none
+	def named_task(self, names):
+		raise AbstractMethod
+		
+	# dict of prefix to (count, lat_sum, lng_sum) for the prefixes that have markers
+	def prefix_counts(self, prefixes):
+		raise AbstractMethod
+		
+	# add deltas, as from prefix_deltas, to the prefix counts
+	def add_prefix_counts(self, deltas):
+		raise AbstractMethod
+
+
+# range scans with a GQL query, e.g. 'SELECT * FROM ffMarker'
+# code_column names an integer property of Morton codes to scan and put instead of geohash and geostring
+# curve='hilbert' scans and puts a hilbert property instead
+class DatastoreBackend(GeoBackend):
+
+	def __init__(self, gql, codec=GeoBackend.codec, code_column=None, curve='z'):
+		if curve == 'hilbert':
+			if code_column:
+				raise ValueError('code_column needs geohash keys')
+			if codec is GeoBackend.codec:
+				codec = self.hilbert_codec
+			self.curve = self.key = 'hilbert'
+		self.codec = codec
+		self.code_column = code_column
+		self.kind = re.search(r'\bFROM\s+(\w+)', gql, re.I).group(1)
+		column = code_column or self.key
+		gql += (' AND' if 'WHERE' in gql else ' WHERE') + ' %s >= :sw_geohash AND %s < :ne_geohash ORDER BY %s' % (column, column, column)
+		self.query = db.GqlQuery(gql)
+		self.keys_query = db.GqlQuery(re.compile(r'^\s*SELECT\s+\*', re.I).sub('SELECT __key__', gql))
+		
+	def scan_task(self, lo, hi, limit):
+		if self.code_column:
+			lo, hi = geohash.code_range(lo, hi)
+			self.query.bind(sw_geohash=lo, ne_geohash=hi)
+			return CodeQueryTask(self.query, self.code_column, limit=limit)
+		self.query.bind(sw_geohash=lo, ne_geohash=hi)
+		if self.curve == 'hilbert':
+			return HilbertQueryTask(self.query, limit=limit)
+		return QueryTask(self.query, limit=limit)
+		
+	def keys_task(self, lo, hi, limit):
+		if self.code_column:
+			lo, hi = geohash.code_range(lo, hi)
+		self.keys_query.bind(sw_geohash=lo, ne_geohash=hi)
+		return KeysQueryTask(self.keys_query, limit=limit)
+		
+	def get_task(self, keys):
+		return LocalTask(datastore.Get, list(keys))
+		
+	def put(self, markers):
+		entities = []
+		for marker in markers:
+			entity = datastore.Entity(self.kind, name=marker['key_name'])
+			entity['lat'] = marker['lat']
+			entity['lng'] = marker['lng']
+			if self.code_column:
+				entity[self.code_column] = geohash.hash_code(marker['geohash'])
+			elif self.curve == 'hilbert':
+				entity['hilbert'] = marker['hilbert']
+			else:
+				entity['geohash'] = marker['geohash']
+				entity['geostring'] = marker['geostring']
+			entities.append(entity)
+		datastore.Put(entities)
+		
+	def put_task(self, markers, threaded=False):
+		return LocalTask(self.put, list(markers), threaded=threaded)
+		
+	# stored markers have no geohash with code_column or curve='hilbert', so every one gets it from its lat and lng
+	def get_named(self, names):
+		entities = datastore.Get([datastore.Key.from_path(self.kind, name) for name in names])
+		markers = [entity is not None and {'lat' : entity['lat'], 'lng' : entity['lng']} or None for entity in entities]
+		add_geohashes([marker for marker in markers if marker is not None])
+		return markers
+		
+	def named_task(self, names):
+		return LocalTask(self.get_named, list(names))
+		
+	def add_prefix_counts(self, deltas):
+		add_prefix_deltas(deltas)
+		
+	# batch_size prefixes per get, as a get takes at most 1000 keys
+	def prefix_counts(self, prefixes, batch_size=1000):
+		prefixes = list(prefixes)
+		counts = {}
+		for first in range(0, len(prefixes), batch_size):
+			for entity in datastore.Get([datastore.Key.from_path(PREFIX_COUNT_KIND, 'p' + prefix) for prefix in prefixes[first:first + batch_size]]):
+				if entity is not None and entity['count'] > 0:
+					counts[entity.key().name()[1:]] = (entity['count'], entity['lat_sum'], entity['lng_sum'])
+		return counts
+
+
+# markers held in process: a sorted geohash column with parallel lat and lng arrays, scanned with bisect
+# latency is None, or a function returning the seconds a scan or put sleeps first, to fake a remote store;
+# such scans run in threads of their own so that they overlap
+# puts are kept aside and sorted in before the next read, so that loading in batches stays linear;
+# like the datastore, a put replaces the marker of the same key name, where loaded points have none
+# codes=True also keeps a column of Morton codes, and scans that rather than the geohashes
+# curve='hilbert' keeps a column of Hilbert keys in place of the geohashes
+class MemoryBackend(GeoBackend):
+
+	def __init__(self, points=(), count_depth=PREFIX_COUNT_DEPTH, latency=None, codes=False, curve='z'):
+		if curve == 'hilbert':
+			if codes:
+				raise ValueError('codes need geohash keys')
+			self.curve = self.key = 'hilbert'
+		self.latency = latency
+		self.codes = codes and [] or None
+		self.hashes = []
+		self.names = []
+		self.named = {}
+		self.lats = array('d')
+		self.lngs = array('d')
+		self.count_depth = count_depth
+		self.counts = {}
+		self.pending = []
+		self.lock = threading.Lock()
+		self.load(points)
+		
+	def __len__(self):
+		self.flush()
+		return len(self.hashes)
+		
+	# add (lng, lat) points, keeping the columns sorted by key
+	def load(self, points):
+		lngs = array('d', [point[0] for point in points])
+		lats = array('d', [point[1] for point in points])
+		if not len(lngs):
+			return
+			
+		new_hashes = map(str, geohash.encode_many(lngs, lats)[0])
+		
+		self.add_prefix_counts(prefix_deltas(zip(new_hashes, lats, lngs), self.count_depth))
+		
+		if self.curve == 'hilbert':
+			new_hashes = [str(geohash.Hilbert(point)) for point in zip(lngs, lats)]
+		
+		self.lock.acquire()
+		try:
+			self.insert(new_hashes, lats, lngs)
+		finally:
+			self.lock.release()
+		
+	# sort markers into the columns, named ones over those of the same key names; call holding the lock
+	def insert(self, new_hashes, lats, lngs, new_names=None):
+		# as in the datastore, only the codes are kept, and geohashes come back from them
+		if self.codes is not None:
+			new_codes = map(geohash.hash_code, new_hashes)
+			new_hashes = map(geohash.code_hash, new_codes)
+			
+		hashes = self.hashes + new_hashes
+		lats = self.lats + lats
+		lngs = self.lngs + lngs
+		names = self.names + (new_names or [None] * len(new_hashes))
+		
+		# the last marker of each key name replaces those before it
+		last = {}
+		for i, name in enumerate(names):
+			if name is not None:
+				last[name] = i
+		order = [i for i in range(len(hashes)) if names[i] is None or last[names[i]] == i]
+		order.sort(key=hashes.__getitem__)
+		
+		# codes sort in the same order as geohashes
+		if self.codes is not None:
+			codes = self.codes + new_codes
+			self.codes = [codes[i] for i in order]
+		
+		self.hashes = [hashes[i] for i in order]
+		self.names = [names[i] for i in order]
+		self.lats = array('d', [lats[i] for i in order])
+		self.lngs = array('d', [lngs[i] for i in order])
+		
+	# sort in the markers put since the last read
+	def flush(self):
+		if not self.pending:
+			return
+		self.lock.acquire()
+		try:
+			pending = self.pending
+			self.pending = []
+			self.insert([marker[self.key] for marker in pending], array('d', [marker['lat'] for marker in pending]), array('d', [marker['lng'] for marker in pending]),
+				[marker['key_name'] for marker in pending])
+		finally:
+			self.lock.release()
+			
+	# markers as for DatastoreBackend.put; their prefix counts are left to add_prefix_counts
+	def put(self, markers):
+		if self.latency is not None:
+			time.sleep(self.latency())
+		self.lock.acquire()
+		try:
+			self.pending.extend(markers)
+			for marker in markers:
+				self.named[marker['key_name']] = marker
+		finally:
+			self.lock.release()
+		
+	# first and last positions of markers in [lo, hi), at most limit of them
+	def span(self, lo, hi, limit):
+		self.flush()
+		if self.codes is not None:
+			lo, hi = geohash.code_range(lo, hi)
+			first = bisect_left(self.codes, lo)
+			return first, min(bisect_left(self.codes, hi), first + limit)
+			
+		first = bisect_left(self.hashes, lo)
+		return first, min(bisect_left(self.hashes, hi), first + limit)
+		
+	def scan(self, lo, hi, limit):
+		first, last = self.span(lo, hi, limit)
+		
+		rows = [{
+			self.key : self.hashes[i],
+			'lat' : self.lats[i],
+			'lng' : self.lngs[i]
+		} for i in xrange(first, last)]
+		if self.curve == 'hilbert':
+			add_geohashes(rows)
+		return rows
+		
+	def slow_scan(self, lo, hi, limit):
+		time.sleep(self.latency())
+		return self.scan(lo, hi, limit)
+		
+	# candidates are keyed by position, good until the next load or put
+	def scan_keys(self, lo, hi, limit):
+		first, last = self.span(lo, hi, limit)
+		
+		return [{
+			self.key : self.hashes[i],
+			'key' : i
+		} for i in xrange(first, last)]
+		
+	def get(self, keys):
+		self.flush()
+		markers = []
+		for key in map(int, keys):
+			markers.append({
+				self.key : self.hashes[key],
+				'lat' : self.lats[key],
+				'lng' : self.lngs[key]
+			})
+		return markers
+		
+	def get_named(self, names):
+		self.lock.acquire()
+		try:
+			markers = [self.named.get(name) for name in names]
+		finally:
+			self.lock.release()
+		return [marker is not None and {'geohash' : marker['geohash'], 'lat' : marker['lat'], 'lng' : marker['lng']} or None for marker in markers]
+		
+	def prefix_counts(self, prefixes):
+		counts = {}
+		for prefix in prefixes:
+			if self.counts.get(prefix, (0,))[0] > 0:
+				counts[prefix] = self.counts[prefix]
+		return counts
+		
+	def add_prefix_counts(self, deltas):
+		self.lock.acquire()
+		try:
+			for prefix, delta in deltas.items():
+				count = self.counts.get(prefix, (0, 0.0, 0.0))
+				self.counts[prefix] = (count[0] + delta[0], count[1] + delta[1], count[2] + delta[2])
+		finally:
+			self.lock.release()
+		
+	def scan_task(self, lo, hi, limit):
+		if self.latency is not None:
+			return LocalTask(self.slow_scan, lo, hi, limit, threaded=True, cache_key='memory=%x,lo=%s,hi=%s,limit=%s' % (id(self), lo, hi, limit))
+		return LocalTask(self.scan, lo, hi, limit, cache_key='memory=%x,lo=%s,hi=%s,limit=%s' % (id(self), lo, hi, limit))
+		
+	def keys_task(self, lo, hi, limit):
+		return LocalTask(self.scan_keys, lo, hi, limit, cache_key='memory-keys=%x,lo=%s,hi=%s,limit=%s' % (id(self), lo, hi, limit))
+		
+	def get_task(self, keys):
+		return LocalTask(self.get, list(keys))
+		
+	def put_task(self, markers, threaded=False):
+		return LocalTask(self.put, list(markers), threaded=threaded)
+		
+	def named_task(self, names):
+		return LocalTask(self.get_named, list(names))
+
+
+# query on an integer column of Morton codes, whose rows get their geohash back from the code
+class CodeQueryTask(QueryTask):
+
+	def __init__(self, query, column, **kw):
+		self.column = column
+		QueryTask.__init__(self, query, **kw)
+		
+	def get_result(self):
+		rows = QueryTask.get_result(self)
+		for row in rows:
+			if 'geohash' not in row:
+				row['geohash'] = geohash.code_hash(row[self.column])
+		return rows
+
+
+# query on Hilbert keys, whose rows get the geohash of their lat and lng
+class HilbertQueryTask(QueryTask):
+	
+	def get_result(self):
+		return add_geohashes(QueryTask.get_result(self))
+
+
+# keys-only query whose result is a candidate for each key, see marker_key_name
+class KeysQueryTask(QueryTask):
+
+	@property
+	def cache_key(self):
+		return 'keys,' + QueryTask.cache_key.fget(self)
+		
+	def get_result(self):
+		if self.cache_result is not None:
+			return self.cache_result
+		return [{'geohash' : key_geohash(key), 'key' : key} for key in QueryTask.get_result(self)]
@@ -13,43 +13,147 @@ Usage in three easy steps:
 	
 where kwargs contains:
 bbox - bounding box "west, south, east, north"
+polygon - instead of bbox, a GeoJSON Polygon or MultiPolygon geometry as a string, or an ffPolygon.Polygon: only markers inside it, filtered.  covered by geohash cells, coarse inside and fine along its edges, merged into at most cover key ranges (16 unless given)
+boxes - instead of bbox, several bounding boxes "west, south, east, north; west, south, east, north", searched as a polygon
 limit - number of markers to fetch
 correction - 0 = off, 1 = on, 2 = double, increment further at your own CPU risk!
 border - if a sub-query will be less than this mix (default value = 0.15), do not split.  instead, nudge a single query to safety
+cover - instead of correction, cover the bbox with at most this many geohash key ranges, one query each.  nothing is nudged away
+filter - set to True to drop results outside the bbox, fetching further pages until each box has its limit
+pages - with filter, the most pages fetched per box (default value = 3).  merged or tiled, a search short of limit keeps topping up until it has limit markers or every box is exhausted
+aggregate - instead of markers, return counts and centroids for about this many geohash cells covering the bbox, from the backend's prefix counts
+density - set to True to share the limit between boxes by the rows the backend's prefix counts expect in each, skipping boxes expected to be empty
+backend - where markers are fetched from, see ffBackend.  default is the datastore, queried with the gql given to search
+code_column - for that default, the integer property of Morton codes to scan instead of geohash, see ffBackend
+curve - 'z' (default) for a backend keyed by geohash, or 'hilbert' for one keyed by Hilbert curve, see geohash.Hilbert.  hilbert plans with cover ranges (cover=8 unless given) and doesn't take density, two_phase or tiles
 cache_ttl - memcache ttl. non zero will also trigger precision rounding of bounding box to increase cache hit rate
+local_cache - an asynctools.LocalCache kept for the life of the process, consulted before memcache
+memcache - the memcache client to cache in, by default App Engine's; an asynctools.LocalCache stands in for it elsewhere
+single_flight - set to True so that concurrent searches missing the same cache key wait for one fetch of it
+stale_ttl - seconds a cached query stays usable past cache_ttl, served while one search refreshes it
+concurrency - run at most this many queries at a time, filtering each as it completes rather than after the slowest (default value = 0, all at once in order)
+deadline - with concurrency, seconds after which a query is given up on and its box left short
+merge - set to True to treat the limit as shared by all boxes: limit that sparse boxes leave unused goes to boxes with more to fetch, through further pages, and fetching stops as soon as limit markers are in hand
+cursor - geo.next_cursor of an earlier search with the same arguments, to fetch the markers after the ones it returned
+previous - bounding box "west, south, east, north" the client already has markers for: only the area of bbox outside it is searched, filtered
+trace - an ffTrace.Trace to record timings and counters in, see ffTrace.start.  the caller finishes it
+two_phase - set to True to scan for keys only, drop candidates whose geohash cell is outside the bbox, and get only the markers returned, see ffBackend.  filtered, whether or not filter is given
+entity_cache - with two_phase, a memcache client or asynctools.LocalCache of markers by key, consulted before getting them
+quantize - 'round' (default) for that precision rounding, or 'tiles' to snap the bbox to a grid of geohash tiles, each fetched and cached on its own
+tiles - with quantize='tiles', the most tiles per search (default value = 16)
 logging - set to True to also generate geo.log for debugging
 
 2. execute search
 >>> geo.search('SELECT * FROM ffMarker')
 
+or with a backend other than the datastore
+>>> geo.search()
+
 3. scan results
 >>> for result in geo.results: logging.info(result)
+
+geo.next_cursor is then an opaque token for the next page of markers, or None when there are no more
 	
 See http://geohash-fcdemo.appspot.com/ for the demo
 """
 
-# datastore
-from google.appengine.ext import db
-
 # geohash from http://mappinghacks.com/code/geohash.py.txt
 import geohash
 
 # asynctools from http://code.google.com/p/asynctools/
-from asynctools import CachedMultiTask, AsyncMultiTask, QueryTask
+from asynctools import CachedMultiTask, AsyncMultiTask, CompletionMultiTask, DeadlineExceededError, LocalCache
+
+# range scans on the datastore or elsewhere
+from ffBackend import DatastoreBackend
+
+# polygons and sets of boxes
+import ffPolygon
 
 # needed for precision rounding which is used to increase cache hits
-from math import log10
+from math import log10, log, ceil, floor
+
+# continuation tokens
+import base64, zlib
+
+# timings and counters
+from ffTrace import NULL_TRACE
+
+# a box as boxes that don't cross the dateline
+def unwrap(box, precision):
+	if box['west'] <= box['east']:
+		return [box]
+	return [dict(box, east=180.0 - precision), dict(box, west=-180.0)]
+
+# value rounded down, or up, to places decimal places, as round() rounds to the nearest
+def round_down(value, places):
+	return round(floor(value * 10 ** places) / 10 ** places, places)
+	
+def round_up(value, places):
+	return round(ceil(value * 10 ** places) / 10 ** places, places)
+
+# parts of a box outside a previous [west, south, east, north], as boxes of their own
+# edges shared with the previous bbox belong to it, so parts stop a precision short
+def exposed(box, previous, precision):
+	parts = unwrap(box, precision)
+	for old in unwrap(dict(zip(('west', 'south', 'east', 'north'), previous)), 0):
+		strips = []
+		for part in parts:
+			if part['east'] < old['west'] or part['west'] > old['east'] or part['north'] < old['south'] or part['south'] > old['north']:
+				strips.append(part)
+				continue
+				
+			south = max(part['south'], old['south'])
+			north = min(part['north'], old['north'])
+			strips += [
+				dict(part, north=old['south'] - precision),
+				dict(part, south=old['north'] + precision),
+				dict(part, south=south, north=north, east=old['west'] - precision),
+				dict(part, south=south, north=north, west=old['east'] + precision)
+			]
+		parts = [part for part in strips if part['west'] <= part['east'] and part['south'] <= part['north']]
+	return parts
 
 # splits a bbox spatial query into 1, 2 or 4 geohash queries
 class ffGeoSearch(object):
 
 	# the width of a split hair
 	precision = 1e-8
+	
+	# the most rows requested by a single filtered page
+	page_max = 1000
+	
+	# the most prefix counts looked up to estimate rows per box
+	density_cells = 256
+	
+	# key ranges covering a polygon unless cover is given, and the most cells merged into them
+	polygon_ranges = 16
+	polygon_cells = 256
+	
+	# query plans by whole box and planning arguments, shared by every search in the process; None to plan every time
+	plans = LocalCache(max_bytes=1 << 20)
 
 	# initialize a search
 	def __init__(self, **kwargs):
 
-		if 'bbox' in kwargs:
+		if 'trace' in kwargs and kwargs['trace'] is not None:
+			self.trace = kwargs['trace']
+		else:
+			self.trace = NULL_TRACE
+		started = self.trace.begin()
+
+		if 'polygon' in kwargs and kwargs['polygon']:
+			self.polygon = kwargs['polygon']
+			if not isinstance(self.polygon, ffPolygon.Polygon):
+				self.polygon = ffPolygon.parse(self.polygon)
+		elif 'boxes' in kwargs and kwargs['boxes']:
+			self.polygon = ffPolygon.parse_boxes(kwargs['boxes'])
+		else:
+			self.polygon = None
+
+		if self.polygon is not None:
+			# the bbox of the polygon, and then only the markers inside it
+			[self.west, self.south, self.east, self.north] = self.polygon.bbox()
+		elif 'bbox' in kwargs:
 			# bbox standard is west, south, east, north
 			[self.west, self.south, self.east, self.north] = map(float, kwargs['bbox'].split(','))
 		else:
@@ -74,13 +178,136 @@ class ffGeoSearch(object):
 		else:
 			self.border = 0.15
 			
+		if 'cover' in kwargs:
+			self.cover = int(kwargs['cover'])
+		else:
+			self.cover = 0
+			
+		if 'filter' in kwargs and kwargs['filter'] == True:
+			self.filter = True
+		else:
+			self.filter = False
+			
+		if 'pages' in kwargs:
+			self.pages = int(kwargs['pages'])
+		else:
+			self.pages = 3
+			
+		if 'aggregate' in kwargs:
+			self.aggregate = int(kwargs['aggregate'])
+		else:
+			self.aggregate = 0
+			
+		if 'density' in kwargs and kwargs['density'] == True:
+			self.density = True
+		else:
+			self.density = False
+			
+		if 'backend' in kwargs:
+			self.backend = kwargs['backend']
+		else:
+			self.backend = None
+			
+		if 'code_column' in kwargs:
+			self.code_column = kwargs['code_column']
+		else:
+			self.code_column = None
+			
+		if 'curve' in kwargs:
+			self.curve = kwargs['curve']
+		else:
+			self.curve = 'z'
+			
+		if 'local_cache' in kwargs:
+			self.local_cache = kwargs['local_cache']
+		else:
+			self.local_cache = None
+			
+		if 'memcache' in kwargs:
+			self.memcache = kwargs['memcache']
+		else:
+			self.memcache = None
+			
+		if 'quantize' in kwargs:
+			self.quantize = kwargs['quantize']
+		else:
+			self.quantize = 'round'
+			
+		if 'tiles' in kwargs:
+			self.tiles = int(kwargs['tiles'])
+		else:
+			self.tiles = 16
+			
 		# cached or not?
 		if 'cache_ttl' in kwargs and kwargs['cache_ttl'] > 0:
 			self.cache = True
-			self.task_runner = CachedMultiTask(time=kwargs['cache_ttl'])
+			self.cache_ttl = kwargs['cache_ttl']
 		else:
 			self.cache = False
-			self.task_runner = AsyncMultiTask()
+			
+		# coalesce identical cache misses, serve stale entries while they are refreshed
+		if 'single_flight' in kwargs:
+			self.single_flight = kwargs['single_flight']
+		else:
+			self.single_flight = False
+			
+		if 'stale_ttl' in kwargs:
+			self.stale_ttl = kwargs['stale_ttl']
+		else:
+			self.stale_ttl = 0
+			
+		if 'concurrency' in kwargs:
+			self.concurrency = int(kwargs['concurrency'])
+		else:
+			self.concurrency = 0
+			
+		if 'deadline' in kwargs:
+			self.deadline = kwargs['deadline']
+		else:
+			self.deadline = None
+			
+		if 'merge' in kwargs:
+			self.merge = kwargs['merge']
+		else:
+			self.merge = False
+			
+		if 'two_phase' in kwargs:
+			self.two_phase = kwargs['two_phase']
+		else:
+			self.two_phase = False
+			
+		if 'entity_cache' in kwargs:
+			self.entity_cache = kwargs['entity_cache']
+		else:
+			self.entity_cache = None
+			
+		# no faultlines to correct, and prefix counts, key names and tiles are by geohash
+		if self.curve == 'hilbert':
+			if self.density or self.two_phase or self.quantize == 'tiles':
+				raise ValueError('density, two_phase and tiles need geohash keys')
+			if self.cover <= 0:
+				self.cover = 8
+		elif self.curve != 'z':
+			raise ValueError('curve is z or hilbert')
+			
+		# the polygon plans its own cells, and markers in its bbox aren't in it until filtered
+		if self.polygon is not None:
+			if self.curve != 'z' or self.quantize == 'tiles' or ('previous' in kwargs and kwargs['previous']):
+				raise ValueError('polygons need geohash keys, and take neither tiles nor previous')
+			self.filter = True
+			
+		# dropping candidates outside the bbox is what two phase is for
+		if self.two_phase:
+			self.filter = True
+			
+		# delta mode only makes sense for markers that are inside the bbox
+		if 'previous' in kwargs and kwargs['previous']:
+			self.previous = map(float, kwargs['previous'].split(','))
+			self.filter = True
+		else:
+			self.previous = None
+			
+		self.next_cursor = None
 			
 		# keep some logging
 		self.log = []
@@ -97,15 +324,30 @@ class ffGeoSearch(object):
 		# special special case of 180 to -180 lng span
 		if span == 0: span = 360
 		
+		# filtered, results are kept to the bbox asked for, whatever box is planned and cached
+		self.requested = {
+			'south' : self.south,
+			'west' : self.west,
+			'north' : self.north,
+			'east' : self.east
+		}
+		
 		# if caching, use precision rounding to increase chance of a hit
-		if self.cache:
+		# filtered, round outwards so that the queries still reach every marker asked for
+		# a polygon's bbox is left as it is, as rounding could cut markers off
+		if self.cache and self.quantize == 'round' and self.polygon is None:
+			if self.filter:
+				down, up = round_down, round_up
+			else:
+				down = up = round
+				
 			lng_prec = int(1-round(log10(span)))
-			self.west = round(self.west, lng_prec)
-			self.east = round(self.east, lng_prec)
+			self.west = down(self.west, lng_prec)
+			self.east = up(self.east, lng_prec)
 			
 			lat_prec = int(1-round(log10(self.north - self.south)))
-			self.south = round(self.south, lat_prec)
-			self.north = round(self.north, lat_prec)
+			self.south = down(self.south, lat_prec)
+			self.north = up(self.north, lat_prec)
 
 		# make sure the precision rounding or the client isn't on some other planet
 		self.west = max([-180,min([180-self.precision, self.west])])
@@ -113,33 +355,45 @@ class ffGeoSearch(object):
 		self.east = max([-180,min([180-self.precision, self.east])])
 		self.north = max([-90,min([90-self.precision, self.north])])
 		
-		# array of bounds
-		self.boxes = []
-
+		planned = self.trace.begin()
+		
 		# whole box
-		self.boxes.append({
+		whole = {
 			'south' : self.south,
 			'west' : self.west,
 			'north' : self.north,
 			'east' : self.east,
 			'limit' : self.limit
-		});
-
-		# 0, 1, 2 (double)
-		for count in range(self.correction):
-			split_boxes = []
-			for box in self.boxes:
-				split_boxes += self.split(box)
+		}
 		
-			self.boxes = split_boxes
-		
-		# nudge final boxes without splitting further
-		if self.correction > 0:
-			for box in self.boxes:
-				box = self.split(box, False)[0]
-	
+		# array of bounds
+		if self.previous is None:
+			self.boxes = self.planned(whole)
+		else:
+			# only the newly exposed strips, sharing the limit by area
+			self.boxes = []
+			strips = exposed(whole, self.previous, self.precision)
+			areas = [(box['east'] - box['west']) * (box['north'] - box['south']) for box in strips]
+			for box, area in zip(strips, areas):
+				box['limit'] = int(self.limit * area / sum(areas))
+			if strips:
+				strips[0]['limit'] += self.limit - sum([box['limit'] for box in strips])
+			for box in strips:
+				self.boxes += self.planned(box)
+				
+		self.trace.end('plan', planned)
+		self.trace.count('boxes', len(self.boxes))
+
 		#logging.info(self.boxes)
 
+		# resume from an earlier page
+		if 'cursor' in kwargs and kwargs['cursor']:
+			self.resume = self.parse_cursor(kwargs['cursor'])
+		else:
+			self.resume = None
+			
+		self.trace.end('init', started)
+
 		if self.logging:
 			for box in self.boxes:
 				self.log.append({
@@ -151,6 +405,102 @@ class ffGeoSearch(object):
 				})
 		
 		
+	# plan for a whole box, with the geohash bounds of each query, from self.plans when planned before
+	# a plan depends on nothing but the box and the planning arguments; boxes returned are copies to change at will
+	# each box has the whole box as its bounds, to filter against, as correction nudges and splits the boxes inside it
+	def planned(self, whole):
+		bounds = dict([(side, whole[side]) for side in ('west', 'south', 'east', 'north')])
+		
+		key = repr((whole['west'], whole['south'], whole['east'], whole['north'], whole['limit'],
+			self.correction, self.border, self.cover, self.quantize, self.tiles, self.precision, self.curve,
+			self.polygon is not None and self.polygon.key or None))
+			
+		if self.plans is not None:
+			plan = self.plans.get_multi([key]).get(key)
+			if plan is not None:
+				self.trace.count('plans_cached')
+				return [dict(box, bounds=bounds) for box in plan]
+				
+		boxes = self.plan(dict(whole))
+		encoded = self.trace.begin()
+	
+		# geohash bounds of each query
+		for box in boxes:
+			if 'sw_geohash' not in box:
+				box['sw_geohash'] = str(geohash.Geohash((box['west'], box['south'])))
+				box['ne_geohash'] = str(geohash.Geohash((box['east'], box['north'])))
+				
+		self.trace.end('encode', encoded)
+		
+		if self.plans is not None:
+			self.plans.set_multi({key : boxes})
+			
+		return [dict(box, bounds=bounds) for box in boxes]
+		
+		
+	# geohash queries for the whole of a box
+	def plan(self, box):
+		if self.polygon is not None:
+			# cells of the polygon replace faultline correction
+			return self.polygon_boxes(box)
+			
+		if self.quantize == 'tiles':
+			# tiles replace faultline correction
+			return self.tile_boxes(box)
+			
+		if self.cover > 0:
+			# geohash ranges replace faultline correction
+			return self.cover_boxes(box)
+			
+		boxes = [box]
+		
+		# 0, 1, 2 (double)
+		for count in range(self.correction):
+			split_boxes = []
+			for box in boxes:
+				split_boxes += self.split(box)
+		
+			boxes = split_boxes
+		
+		# nudge final boxes without splitting further
+		if self.correction > 0:
+			for box in boxes:
+				box = self.split(box, False)[0]
+				
+		return boxes
+		
+		
+	# checksum of the planned queries, so that a cursor is only taken by the search that made it
+	def plan_signature(self):
+		return zlib.crc32(';'.join(['%s,%s' % (box['sw_geohash'], box['ne_geohash']) for box in self.boxes])) & 0xffffffff
+		
+		
+	# opaque continuation token: the plan signature, then box:geohash:seen for each box with more to fetch
+	def make_cursor(self, positions):
+		if not positions:
+			return None
+		token = '%x;' % self.plan_signature() + ';'.join(['%d:%s:%d' % (key, positions[key][0], positions[key][1]) for key in sorted(positions)])
+		return base64.urlsafe_b64encode(token)
+		
+		
+	# dict of box to (geohash, rows at that geohash already seen) from make_cursor
+	def parse_cursor(self, cursor):
+		try:
+			fields = base64.urlsafe_b64decode(str(cursor)).split(';')
+			signature = int(fields[0], 16)
+			positions = {}
+			for field in fields[1:]:
+				key, last, seen = field.split(':')
+				positions[int(key)] = (last, int(seen))
+		except (TypeError, ValueError):
+			raise ValueError('malformed cursor')
+			
+		if signature != self.plan_signature() or [key for key in positions if key >= len(self.boxes)]:
+			raise ValueError('cursor is from another search')
+			
+		return positions
+		
+		
 	# split box to avoid faultlines
 	def split(self, box, split=True):
 
@@ -230,33 +580,529 @@ class ffGeoSearch(object):
 		return boxes
 	
 	
+	# cover box with geohash key ranges; each range becomes a box with the same bounds and its own query
+	def cover_boxes(self, box):
+		bbox = (box['west'], box['south'], box['east'], box['north'])
+		
+		if self.curve == 'hilbert':
+			ranges = geohash.hilbert_cover(bbox, self.cover)
+			sizes = [geohash.hilbert_range_size(lo, hi) for (lo, hi) in ranges]
+		else:
+			ranges = geohash.cover(bbox, self.cover)
+			sizes = [geohash.range_size(lo, hi) for (lo, hi) in ranges]
+			
+		return self.range_boxes(box, ranges, sizes)
+	
+	
+	# cover the polygon with geohash cells, coarse inside it and fine along its edges, merged into key ranges
+	# each range becomes a box with the polygon's bounds and its own query
+	def polygon_boxes(self, box):
+		ranges = self.polygon.cover(self.cover > 0 and self.cover or self.polygon_ranges, self.polygon_cells)
+		sizes = [geohash.range_size(lo, hi) for (lo, hi) in ranges]
+		return self.range_boxes(box, ranges, sizes)
+	
+	
+	# a box for each key range, sharing the limit by the size of each
+	def range_boxes(self, box, ranges, sizes):
+		total = float(sum(sizes))
+		
+		boxes = []
+		for (lo, hi), size in zip(ranges, sizes):
+			boxes.append({
+				'south' : box['south'],
+				'west' : box['west'],
+				'north' : box['north'],
+				'east' : box['east'],
+				'limit' : int(box['limit'] * size / total),
+				'sw_geohash' : lo,
+				'ne_geohash' : hi
+			})
+			
+		boxes[0]['limit'] += box['limit'] - sum([b['limit'] for b in boxes])
+		
+		return boxes
+	
+	
+	# true if a result lies inside the box
+	def inside(self, box, result):
+		if result['lat'] < box['south'] or result['lat'] > box['north']:
+			return False
+		
+		# within the bbox of a polygon, by its edges
+		if self.polygon is not None:
+			return self.polygon.contains(result['lng'], result['lat'])
+		
+		# special cases apply for crossing the dateline
+		if box['west'] > box['east']:
+			return result['lng'] >= box['west'] or result['lng'] <= box['east']
+			
+		return result['lng'] >= box['west'] and result['lng'] <= box['east']
+	
+	
+	# filtered, true if box key keeps a result: one inside the bbox asked for and its bounds, once
+	# boxes are nudged and split away from faultlines, so a result in the gaps left is inside none of them
+	# but may be fetched by several: the first box whose key range holds it keeps it
+	def keeps(self, key, result):
+		box = self.boxes[key]
+		if not self.inside(box['bounds'], result) or not self.inside(self.requested, result):
+			return False
+		if self.inside(box, result):
+			return True
+			
+		others = [other for other in self.boxes if other['bounds'] == box['bounds']]
+		if [other for other in others if self.inside(other, result)]:
+			return False
+		hash = str(result['geohash'])
+		holding = [other for other in others if other['sw_geohash'] <= hash < other['ne_geohash']]
+		return bool(holding) and holding[0] is box
+		
+		
+	# two phase, true if a geohash cell (west, south, east, north) reaches into the box
+	def reaches(self, box, cell):
+		# cells are rounded to 6 places, so grow them by as much before they are tested against edges
+		if self.polygon is not None:
+			return self.polygon.classify(cell[0] - 1e-6, cell[1] - 1e-6, cell[2] + 1e-6, cell[3] + 1e-6) != ffPolygon.OUTSIDE
+			
+		if cell[3] < box['south'] or cell[1] > box['north']:
+			return False
+			
+		# special cases apply for crossing the dateline
+		if box['west'] > box['east']:
+			return cell[2] >= box['west'] or cell[0] <= box['east']
+			
+		return cell[2] >= box['west'] and cell[0] <= box['east']
+		
+		
+	# two phase, the markers of the candidates kept, from the entity cache or one batch get
+	# filtered, markers of cells reaching into their box from outside it are dropped
+	def get_markers(self, backend, candidates, owners):
+		keys = [str(candidate['key']) for candidate in candidates]
+		
+		markers = {}
+		if self.entity_cache is not None and keys:
+			markers = self.entity_cache.get_multi(keys, namespace='ffGeoSearch.markers')
+			self.trace.count('entity_cache_hits', len(markers))
+			
+		missing = [key for key in keys if key not in markers]
+		if missing:
+			task = backend.get_task([candidate['key'] for candidate in candidates if str(candidate['key']) not in markers])
+			AsyncMultiTask([task]).run()
+			found = dict([(key, marker) for key, marker in zip(missing, task.get_result()) if marker is not None])
+			self.trace.count('markers_got', len(found))
+			
+			if self.entity_cache is not None and found:
+				self.entity_cache.set_multi(found, time=self.cache and self.cache_ttl or 0, namespace='ffGeoSearch.markers')
+			markers.update(found)
+			
+		results = []
+		for key, owner in zip(keys, owners):
+			if key in markers and (not self.filter or self.keeps(owner, markers[key])):
+				results.append(markers[key])
+		return results
+		
+		
+	# resumed, share the limit between the boxes the cursor resumes, by their planned limits but at least 1 each
+	def reshare(self):
+		resumed = [key for key in self.resume if self.boxes[key].get('expected') != 0]
+		weights = dict([(key, max(1, self.boxes[key]['limit'])) for key in resumed])
+		total = float(sum(weights.values()))
+		
+		for key in range(len(self.boxes)):
+			if key in weights:
+				self.boxes[key]['limit'] = max(1, int(self.limit * weights[key] / total))
+			else:
+				self.boxes[key]['limit'] = 0
+				
+				
+	# merged or tiled, share the limit not yet in hand between the boxes that may have more, returning those given some of it
+	def share(self, kept, exhausted):
+		remaining = self.limit - sum(map(len, kept))
+		hungry = [key for key in range(len(self.boxes)) if not exhausted[key]]
+		if remaining <= 0 or not hungry:
+			return []
+			
+		for index in range(len(hungry)):
+			box = self.boxes[hungry[index]]
+			box['limit'] = len(kept[hungry[index]]) + remaining / len(hungry) + (index < remaining % len(hungry))
+			
+		# with fewer markers to go than boxes, a page of nothing would pass for a full one
+		hungry = hungry[:remaining]
+			
+		if self.logging:
+			self.log.append({
+				'type' : 'message',
+				'content' : 'merge: %d markers to go, shared by boxes %s' % (remaining, ', '.join(map(str, hungry)))
+			})
+			
+		return hungry
+	
+	
+	# rows to request on the next page of a box, allowing for the false positives seen so far
+	def page_size(self, box, kept):
+		wanted = box['limit'] - kept
+		
+		if box['fetched'] > box['false_positives']:
+			wanted = wanted * box['fetched'] / (box['fetched'] - box['false_positives'])
+		elif box['fetched']:
+			# nothing kept yet, so pages grow with the rows fetched
+			wanted = max(wanted * 4, box['fetched'] * 2)
+			
+		return min(wanted, self.page_max)
+	
+	
+	# counts and centroids of the geohash cells covering the bbox, at the finest precision giving no more than self.aggregate cells
+	# costs one prefix count lookup per cell, however many markers there are
+	def clusters(self, backend):
+		prefixes = geohash.finest_cells((self.west, self.south, self.east, self.north), self.aggregate, backend.count_depth)
+			
+		# cells of the bbox outside the polygon hold none of its markers
+		if self.polygon is not None:
+			prefixes = [prefix for prefix in prefixes if self.polygon.classify(*geohash.cell_bbox(prefix)) != ffPolygon.OUTSIDE] or prefixes[:1]
+			
+		counts = backend.prefix_counts(prefixes)
+		
+		results = []
+		for prefix in prefixes:
+			if prefix in counts:
+				count, lat_sum, lng_sum = counts[prefix]
+				results.append({
+					'geohash' : prefix,
+					'count' : count,
+					'lat' : lat_sum / count,
+					'lng' : lng_sum / count
+				})
+				
+		if self.logging:
+			self.log.append({
+				'type' : 'message',
+				'content' : '%d cells of %d characters, %d with markers' % (len(prefixes), len(prefixes[0]), len(results))
+			})
+			
+		return results
+	
+	
+	# share the limit between boxes by expected rows, from the backend's prefix counts
+	# a box expected to be empty gets no limit, and so no query
+	def allocate(self, backend):
+		# the finest cells that can be looked up in one go
+		prefixes = geohash.finest_cells((self.west, self.south, self.east, self.north), self.density_cells, backend.count_depth)
+		counts = backend.prefix_counts(prefixes)
+		chars = len(prefixes[0])
+		
+		# every marker inside a box is in a cell touching the box whose keys overlap the box's range
+		for box in self.boxes:
+			box['expected'] = 0
+			for prefix in geohash.cells((box['west'], box['south'], box['east'], box['north']), chars, max_cells=len(prefixes)) or prefixes:
+				if prefix in counts and prefix < box['ne_geohash'] and prefix + '~' > box['sw_geohash']:
+					box['expected'] += counts[prefix][0]
+		
+		# hand out the limit smallest box first, so that what a small box can't use goes to the bigger ones
+		remaining = sum([box['limit'] for box in self.boxes])
+		expected = sum([box['expected'] for box in self.boxes])
+		
+		for box in sorted(self.boxes, key=lambda box: box['expected']):
+			if expected == 0:
+				box['limit'] = 0
+				continue
+				
+			share = int(remaining * box['expected'] / float(expected))
+			if box['expected'] == expected:
+				# the last box takes what is left
+				share = remaining
+				
+			# filtered, a box can't keep more rows than it is expected to hold
+			if self.filter:
+				share = min(share, box['expected'])
+				
+			box['limit'] = share
+			remaining -= share
+			expected -= box['expected']
+			
+		if self.logging:
+			for key in range(len(self.boxes)):
+				self.log.append({
+					'type' : 'message',
+					'content' : 'box %d expects %d rows, limit %d' % (key, self.boxes[key]['expected'], self.boxes[key]['limit'])
+				})
+	
+	
+	# snap box to the geohash tiles covering it, the finest giving no more than self.tiles
+	# every tile is queried with the same limit, so viewports that share a tile share its cache entry
+	def tile_boxes(self, box):
+		prefixes = geohash.finest_cells((box['west'], box['south'], box['east'], box['north']), self.tiles)
+			
+		# the limit per tile follows from the tiles a viewport of this span can expect to touch, rounded up to a power of two,
+		# so it doesn't change as the viewport pans across tile edges
+		chars = len(prefixes[0])
+		tile_lng = 360.0 / (1 << (chars * 5 - chars * 5 / 2))
+		tile_lat = 180.0 / (1 << (chars * 5 / 2))
+		span = box['east'] - box['west']
+		if span < 0: span += 360
+		expected = (span / tile_lng + 1) * ((box['north'] - box['south']) / tile_lat + 1)
+		limit = max(1, box['limit'] / (1 << int(ceil(log(expected, 2)))))
+		
+		boxes = []
+		for prefix in prefixes:
+			boxes.append({
+				'south' : box['south'],
+				'west' : box['west'],
+				'north' : box['north'],
+				'east' : box['east'],
+				'limit' : limit,
+				'sw_geohash' : prefix,
+				'ne_geohash' : prefix + '~'
+			})
+			
+		return boxes
+	
+	
 	# args is additional parameters to bind to the gql, e.g. :query
 	# using asynctools to fetch queries in parallel	
-	def search(self, gql):
+	def search(self, gql=None):
 		# bounded search
-		gql += (' AND' if 'WHERE' in gql else ' WHERE') + ' geohash > :sw_geohash AND geohash < :ne_geohash ORDER BY geohash'
-		query = db.GqlQuery(gql)
+		backend = self.backend
+		if backend is None:
+			backend = DatastoreBackend(gql, code_column=self.code_column, curve=self.curve)
+		if backend.curve != self.curve:
+			raise ValueError('the backend is keyed by the %s curve, not %s' % (backend.curve, self.curve))
+			
+		# the field rows are ordered by
+		key_field = backend.key
+		
+		if self.aggregate > 0:
+			started = self.trace.begin()
+			self.results = self.clusters(backend)
+			self.trace.end('aggregate', started)
+			return
+			
+		if self.density:
+			started = self.trace.begin()
+			self.allocate(backend)
+			self.trace.end('density', started)
+			
+		if self.resume is not None:
+			self.reshare()
 
 		kwargs = {}
 		
+		# per box: rows kept, and where the next page starts as (geohash, rows at that geohash already seen)
+		kept = [[] for box in self.boxes]
+		cursors = [(box['sw_geohash'], 0) for box in self.boxes]
+		limits = [0 for box in self.boxes]
+		
+		if self.resume is not None:
+			for key, position in self.resume.items():
+				cursors[key] = position
+				
+		# where each box started, and where each kept row was, for the next cursor
+		starts = list(cursors)
+		marks = [[] for box in self.boxes]
+		
 		for box in self.boxes:
-			kwargs['sw_geohash'] = str(geohash.Geohash((box['west'], box['south'])))
-			kwargs['ne_geohash'] = str(geohash.Geohash((box['east'], box['north'])))
-			query.bind(**kwargs)
-			self.task_runner.append(QueryTask(query, limit=box['limit']))
+			box['fetched'] = 0
+			box['false_positives'] = 0
 			
-			if self.logging:
-				self.log.append({
-					'type' : 'message',
-					'content' : 'SELECT * FROM myMarkers WHERE geohash > ' + kwargs['sw_geohash'] + ' AND geohash < ' + kwargs['ne_geohash'] + ' LIMIT ' + str(box['limit'])
-				})	
+		# hits and misses per cache tier, over all pages
+		self.cache_stats = {}
+		
+		todo = [key for key in range(len(self.boxes)) if self.boxes[key]['limit'] > 0 and (self.resume is None or key in self.resume)]
+		
+		# boxes known to hold nothing more: done with by the cursor, expected empty, or whose last page came back short
+		exhausted = [(self.resume is not None and key not in self.resume) or self.boxes[key].get('expected') == 0 for key in range(len(self.boxes))]
+		
+		# boxes given up on
+		late = []
+		
+		# merged or tiled, limit that boxes leave unused goes to boxes with more to fetch
+		top_up = self.merge or self.quantize == 'tiles'
+		
+		# unfiltered and unmerged, the first page is all there is
+		# topping up, pages go on until the limit is in hand or every box is exhausted: each page moves a box on or exhausts it
+		if top_up:
+			pages = None
+		elif self.filter:
+			pages = self.pages
+		else:
+			pages = 1
+			
+		page = 0
+		while todo and (pages is None or page < pages):
+			page += 1
 			
-		#logging.info(kwargs)
+			# cached or not?
+			if self.cache:
+				if self.concurrency:
+					runner_type = lambda tasks: CompletionMultiTask(tasks, self.concurrency, self.deadline)
+				else:
+					runner_type = AsyncMultiTask
+				codec = self.two_phase and backend.keys_codec or backend.codec
+				self.task_runner = CachedMultiTask(time=self.cache_ttl, memcache=self.memcache, local_cache=self.local_cache, single_flight=self.single_flight, stale_time=self.stale_ttl,
+					codec=codec, runner_type=runner_type)
+			elif self.concurrency:
+				self.task_runner = CompletionMultiTask(concurrency=self.concurrency, deadline=self.deadline)
+			else:
+				self.task_runner = AsyncMultiTask()
+			
+			# box of each task, as tasks may complete in any order
+			task_keys = {}
+			
+			for key in todo:
+				box = self.boxes[key]
+				kwargs['sw_geohash'] = cursors[key][0]
+				kwargs['ne_geohash'] = box['ne_geohash']
+				limits[key] = self.page_size(box, len(kept[key])) + cursors[key][1]
+				if self.two_phase:
+					task = backend.keys_task(kwargs['sw_geohash'], kwargs['ne_geohash'], limits[key])
+				else:
+					task = backend.scan_task(kwargs['sw_geohash'], kwargs['ne_geohash'], limits[key])
+				task_keys[id(task)] = key
+				self.task_runner.append(task)
+			
+				if self.logging:
+					self.log.append({
+						'type' : 'message',
+						'content' : 'SELECT * FROM myMarkers WHERE geohash >= ' + kwargs['sw_geohash'] + ' AND geohash < ' + kwargs['ne_geohash'] + ' LIMIT ' + str(limits[key])
+					})	
+			
+			#logging.info(kwargs)
+			
+			self.trace.count('pages')
+			self.trace.count('queries', len(todo))
+			started = self.trace.begin()
 
-		self.task_runner.run()
+			if isinstance(self.task_runner, CompletionMultiTask):
+				completed = self.task_runner.as_completed()
+			else:
+				self.task_runner.run()
+				completed = list(self.task_runner)
+			
+			more = []
+			
+			for task in completed:
+				# time until each query's rows are in hand
+				self.trace.end('rpc', started)
+				filtered = self.trace.begin()
+				
+				key = task_keys[id(task)]
+				box = self.boxes[key]
+				try:
+					rows = task.get_result()
+				except DeadlineExceededError:
+					self.trace.count('deadline_missed')
+					if self.logging:
+						self.log.append({
+							'type' : 'message',
+							'content' : 'box %d missed its deadline' % key
+						})
+					exhausted[key] = True
+					late.append(key)
+					continue
+				
+				# two phase, the geohash cell of each candidate is all there is to go by
+				if self.two_phase:
+					cells = zip(*geohash.decode_many([str(result['geohash']) for result in rows[cursors[key][1]:]]))
+				
+				position = cursors[key]
+				for index, result in enumerate(rows[cursors[key][1]:]):
+					if result[key_field] == position[0]:
+						position = (position[0], position[1] + 1)
+					else:
+						position = (result[key_field], 1)
+						
+					if not self.filter:
+						keep = True
+					elif self.two_phase:
+						keep = self.reaches(box['bounds'], cells[index])
+					else:
+						keep = self.keeps(key, result)
+						
+					if keep:
+						kept[key].append(result)
+						marks[key].append(position)
+					else:
+						box['false_positives'] += 1
+						
+				box['fetched'] += max(0, len(rows) - cursors[key][1])
+				
+				# a full page means there may be more to come
+				if len(rows) == limits[key]:
+					last = rows[-1][key_field]
+					cursors[key] = (last, len([1 for result in rows if result[key_field] == last]))
+					if len(kept[key]) < box['limit']:
+						more.append(key)
+				else:
+					exhausted[key] = True
+					
+				self.trace.end('filter', filtered)
+					
+				# merged, any box's markers will do
+				if self.merge and sum(map(len, kept)) >= self.limit:
+					break
+					
+			if top_up:
+				more = self.share(kept, exhausted)
+				
+			if self.cache:
+				for tier, count in self.task_runner.stats.items():
+					self.cache_stats[tier] = self.cache_stats.get(tier, 0) + count
+				self.trace.timing('cache', self.task_runner.lookup_time)
+				
+			self.trace.count('rpcs', self.task_runner.rpc_count)
+			
+			todo = more
+			
+		if self.logging and self.cache:
+			self.log.append({
+				'type' : 'message',
+				'content' : 'cache ' + ', '.join(['%s %d' % (tier, self.cache_stats[tier]) for tier in sorted(self.cache_stats)])
+			})
+			
+		if self.logging and self.filter:
+			for key in range(len(self.boxes)):
+				box = self.boxes[key]
+				self.log.append({
+					'type' : 'message',
+					'content' : 'box %d fetched %d, kept %d, false positives %d' % (key, box['fetched'], min(len(kept[key]), box['limit']), box['false_positives'])
+				})
+		
+		for tier, count in self.cache_stats.items():
+			self.trace.count(tier, count)
+		self.trace.count('rows_fetched', sum([box['fetched'] for box in self.boxes]))
+		self.trace.count('false_positives', sum([box['false_positives'] for box in self.boxes]))
+		
+		merged = self.trace.begin()
 		
 		# dict of resultSet arrays
 		self.results = []
 		
-		for key in range(len(self.task_runner)):
-			self.results += self.task_runner[key].get_result()
+		# box of each result
+		owners = []
+		
+		# where the next page of each box that may have more starts
+		positions = {}
+		
+		for key in range(len(self.boxes)):
+			if top_up:
+				rows = kept[key]
+			else:
+				rows = kept[key][:self.boxes[key]['limit']]
+				
+			# tile limits can add up to more than asked for
+			rows = rows[:max(0, self.limit - len(self.results))]
+			self.results += rows
+			owners += [key] * len(rows)
+			
+			if len(rows) < len(kept[key]):
+				positions[key] = rows and marks[key][len(rows) - 1] or starts[key]
+			elif not exhausted[key] or key in late:
+				positions[key] = cursors[key]
+				
+		self.next_cursor = self.make_cursor(positions)
+		
+		if self.two_phase:
+			started = self.trace.begin()
+			self.results = self.get_markers(backend, self.results, owners)
+			self.trace.end('get', started)
+		
+		self.trace.end('merge', merged)
+		self.trace.count('rows_kept', len(self.results))
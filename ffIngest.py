@@ -0,0 +1,340 @@
+"""
+Bulk loading of markers for ffGeoSearch
+
+Streams (lng, lat) points from CSV or newline delimited JSON, encodes the
+geohash and geostring of a batch at a time with geohash.encode_many, and
+writes the batches with the backend's put_task, concurrency of them at a
+time through a CompletionMultiTask.  Prefix counts are summed in process
+and added with the backend's add_prefix_counts every counts_every markers
+and at the end, so that parallel puts never race on the same count.
+Markers with an id replace those already stored under their key names,
+which are looked up first and their counts taken back.  Key names start
+with the geohash, so only a marker that hasn't moved has the same one.
+
+>>> ingest = Ingester(DatastoreBackend('SELECT * FROM ffMarker'), batch_size=100, concurrency=4)
+>>> ingest.run(read_csv(open('points.csv')))
+>>> print ingest.report()
+
+CSV needs a header row naming the lat and lng columns.  JSON lines are
+objects with lat and lng, or GeoJSON point features.  An id field, if given,
+makes the key names with the geohash, so that loading the same file twice
+overwrites rather than duplicates, markers and counts alike.  A marker whose
+id is loaded at a new position is a new marker, and the old one stays until
+it is deleted and the counts rebuilt.  Without an id key names are random.
+Rows without a valid lat and lng are counted as skipped.
+
+From the command line, against MemoryBackend as a local stand-in for the
+datastore, or the datastore of an app through remote_api:
+
+Usage: python ffIngest.py [options] FILE...   ('-' for stdin)
+  -f csv|ndjson    format, by default from each file's extension
+  --lat lat        field of the latitude
+  --lng lng        field of the longitude
+  --id FIELD       field of a unique id for key names, replacing markers that haven't moved
+  -b 100           markers per put, comma separated to compare several
+  -c 4             puts at a time
+  --counts-every   markers between prefix count updates
+  --latency 0      ms each put sleeps on the stand-in, to fake a remote store
+  --remote HOST    load into the app at HOST, e.g. myapp.appspot.com
+  --app-id ID      and its application id
+  --kind ffMarker  datastore kind of the markers
+  --code-column    integer property of Morton codes to store instead of geohash and geostring
+  --curve z        or hilbert, to key markers by Hilbert curve instead of geohash
+  -q               no progress lines
+"""
+
+import os, sys, csv, time, random, logging
+from optparse import OptionParser
+
+# geohash from http://mappinghacks.com/code/geohash.py.txt
+import geohash
+
+# asynctools from http://code.google.com/p/asynctools/
+from asynctools import CompletionMultiTask
+
+import ffBackend
+import ffTrace
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+# 500 entities is the most a datastore put takes
+MAX_BATCH_SIZE = 500
+
+# records from a CSV file with a header row
+def read_csv(lines):
+	return csv.DictReader(lines)
+
+# records from a file of JSON objects, one per line; None for lines that aren't JSON
+def read_ndjson(lines):
+	for line in lines:
+		line = line.strip()
+		if not line:
+			continue
+		try:
+			yield json.loads(line)
+		except ValueError:
+			yield None
+
+READERS = {
+	'csv' : read_csv,
+	'ndjson' : read_ndjson,
+}
+
+# format of a file name by its extension
+def file_format(name):
+	extension = os.path.splitext(name)[1].lower()
+	if extension in ('.json', '.ndjson', '.jsonl', '.geojson'):
+		return 'ndjson'
+	return 'csv'
+
+
+# writes points to a backend in batches, updating its prefix counts as it goes
+class Ingester(object):
+
+	def __init__(self, backend, batch_size=100, concurrency=4, counts_every=10000, lat='lat', lng='lng', id=None, trace=None, progress=None):
+		if not 0 < batch_size <= MAX_BATCH_SIZE:
+			raise ValueError('batch_size must be between 1 and %d' % MAX_BATCH_SIZE)
+		self.backend = backend
+		self.batch_size = batch_size
+		self.concurrency = max(1, concurrency)
+		self.counts_every = counts_every
+		self.lat = lat
+		self.lng = lng
+		self.id = id
+		self.progress = progress
+		if trace is None:
+			trace = ffTrace.Trace(name='ingest')
+		self.trace = trace
+		self.rows = 0
+		self.skipped = 0
+		self.replaced = 0
+		self.batches = 0
+		self.deltas = {}
+		self.counted = 0
+
+	# (lng, lat, id) of a record, or None if it has no valid position
+	def point(self, record):
+		if not isinstance(record, dict):
+			return None
+		unique = self.id and record.get(self.id)
+		if record.get('type') == 'Feature':
+			unique = unique or record.get('id')
+			try:
+				lng, lat = record['geometry']['coordinates'][:2]
+			except (KeyError, TypeError, ValueError):
+				return None
+		else:
+			lng, lat = record.get(self.lng), record.get(self.lat)
+		try:
+			lng, lat = float(lng), float(lat)
+		except (TypeError, ValueError):
+			return None
+		if not (-180 <= lng <= 180 and -90 <= lat <= 90):
+			return None
+		return lng, lat, unique
+
+	# markers for a batch of (lng, lat, id) points
+	def encode(self, points):
+		started = self.trace.begin()
+		lngs = [point[0] for point in points]
+		lats = [point[1] for point in points]
+		hashes, strings = geohash.encode_many(lngs, lats)
+		hilbert = self.backend.curve == 'hilbert'
+
+		markers = []
+		for (lng, lat, unique), hash, string in zip(points, hashes, strings):
+			hash = str(hash)
+			if unique is None:
+				unique = '%016x' % random.getrandbits(64)
+			markers.append({
+				'key_name' : ffBackend.marker_key_name(hash, unique),
+				'lat' : lat,
+				'lng' : lng,
+				'geohash' : hash,
+				'geostring' : str(string)
+			})
+			if hilbert:
+				markers[-1]['hilbert'] = str(geohash.Hilbert((lng, lat)))
+
+		for prefix, delta in ffBackend.prefix_deltas([(marker['geohash'], marker['lat'], marker['lng']) for marker in markers], self.backend.count_depth).items():
+			total = self.deltas.setdefault(prefix, [0, 0.0, 0.0])
+			total[0] += delta[0]
+			total[1] += delta[1]
+			total[2] += delta[2]
+
+		self.trace.end('encode', started)
+		return markers
+
+	# of named markers, put only the last of each key name, and take back the counts of the others and of those already stored,
+	# so that no key name is put twice at once, and its marker is counted once
+	def replace(self, batches, named):
+		started = self.trace.begin()
+		last = dict([(marker['key_name'], marker) for marker in named])
+		batches = [[marker for marker in batch if last.get(marker['key_name'], marker) is marker] for batch in batches]
+		replaced = [marker for marker in named if last[marker['key_name']] is not marker]
+		
+		names = last.keys()
+		tasks = [self.backend.named_task(names[first:first + self.batch_size]) for first in range(0, len(names), self.batch_size)]
+		for task in CompletionMultiTask(tasks, concurrency=self.concurrency).as_completed():
+			replaced += [marker for marker in task.get_result() if marker is not None]
+			
+		for prefix, delta in ffBackend.prefix_deltas([(marker['geohash'], marker['lat'], marker['lng']) for marker in replaced], self.backend.count_depth).items():
+			total = self.deltas.setdefault(prefix, [0, 0.0, 0.0])
+			total[0] -= delta[0]
+			total[1] -= delta[1]
+			total[2] -= delta[2]
+			
+		self.trace.end('replace', started)
+		self.replaced += len(replaced)
+		self.trace.count('replaced', len(replaced))
+		return [batch for batch in batches if batch]
+		
+	# put batches, concurrency at a time
+	def put(self, batches):
+		started = self.trace.begin()
+		tasks = [self.backend.put_task(markers, threaded=self.concurrency > 1) for markers in batches]
+		for task in CompletionMultiTask(tasks, concurrency=self.concurrency).as_completed():
+			task.get_result()
+		self.trace.end('put', started)
+		self.batches += len(batches)
+		self.trace.count('batches', len(batches))
+
+	# add the prefix counts summed since the last call
+	def flush_counts(self):
+		if not self.deltas:
+			return
+		started = self.trace.begin()
+		self.backend.add_prefix_counts(self.deltas)
+		self.trace.end('counts', started)
+		self.trace.count('prefixes', len(self.deltas))
+		self.deltas = {}
+		self.counted = self.rows
+
+	# load every record, a window of concurrency batches at a time; returns the markers written
+	def run(self, records):
+		window = self.batch_size * self.concurrency
+		points = []
+		for record in records:
+			point = self.point(record)
+			if point is None:
+				self.skipped += 1
+				continue
+			points.append(point)
+			if len(points) >= window:
+				self.write(points)
+				points = []
+		if points:
+			self.write(points)
+		self.flush_counts()
+		self.trace.count('skipped', self.skipped)
+		self.trace.finish()
+		return self.rows
+
+	def write(self, points):
+		batches = [self.encode(points[first:first + self.batch_size]) for first in range(0, len(points), self.batch_size)]
+		named = [marker for marker, point in zip([marker for batch in batches for marker in batch], points) if point[2] is not None]
+		if named:
+			batches = self.replace(batches, named)
+		self.put(batches)
+		self.rows += len(points)
+		self.trace.count('rows', len(points))
+
+		if self.rows - self.counted >= self.counts_every:
+			self.flush_counts()
+		if self.progress:
+			self.progress(self)
+
+	def seconds(self):
+		if self.trace.total is not None:
+			return self.trace.total
+		return time.time() - self.trace.started
+
+	def rate(self):
+		return self.rows / max(self.seconds(), 1e-6)
+
+	# markers, seconds and markers per second so far, then where the time went
+	def report(self):
+		return '%d markers in %.1fs, %.0f/s, %d batches of up to %d, %d skipped, %d replaced; %s' % (self.rows, self.seconds(), self.rate(), self.batches, self.batch_size,
+			self.skipped, self.replaced, self.trace)
+
+
+# the datastore of an app through remote_api, which has to be mapped in its app.yaml
+def connect_remote(host, app_id):
+	import getpass
+	from google.appengine.ext.remote_api import remote_api_stub
+
+	def auth():
+		return raw_input('Email: '), getpass.getpass('Password: ')
+
+	remote_api_stub.ConfigureRemoteDatastore(app_id, '/remote_api', auth, host)
+
+# records of every file in turn
+def read_files(names, format=None):
+	for name in names:
+		if name == '-':
+			lines = sys.stdin
+		else:
+			lines = open(name, 'rb')
+		try:
+			for record in READERS[format or file_format(name)](lines):
+				yield record
+		finally:
+			if lines is not sys.stdin:
+				lines.close()
+
+def main():
+	parser = OptionParser(usage='python ffIngest.py [options] FILE...')
+	parser.add_option('-f', '--format', choices=READERS.keys())
+	parser.add_option('--lat', default='lat')
+	parser.add_option('--lng', default='lng')
+	parser.add_option('--id')
+	parser.add_option('-b', '--batch-size', default='100')
+	parser.add_option('-c', '--concurrency', type='int', default=4)
+	parser.add_option('--counts-every', type='int', default=10000)
+	parser.add_option('--latency', type='float', default=0)
+	parser.add_option('--remote')
+	parser.add_option('--app-id')
+	parser.add_option('--kind', default='ffMarker')
+	parser.add_option('--code-column')
+	parser.add_option('--curve', choices=['z', 'hilbert'], default='z')
+	parser.add_option('-q', '--quiet', action='store_true', default=False)
+	options, args = parser.parse_args()
+
+	if not args:
+		parser.error('no files to load')
+	if options.remote and not options.app_id:
+		parser.error('--remote needs --app-id')
+
+	sizes = [int(size) for size in options.batch_size.split(',')]
+	if options.remote and len(sizes) > 1:
+		parser.error('compare batch sizes on the local stand-in only')
+	if '-' in args and len(sizes) > 1:
+		parser.error('stdin can only be read once')
+
+	if options.remote:
+		connect_remote(options.remote, options.app_id)
+
+	def progress(ingester):
+		if ingester.rows // 10000 > (ingester.rows - ingester.batch_size * ingester.concurrency) // 10000:
+			print >>sys.stderr, '%d markers, %.0f/s' % (ingester.rows, ingester.rate())
+
+	for size in sizes:
+		if options.remote:
+			backend = ffBackend.DatastoreBackend('SELECT * FROM %s' % options.kind, code_column=options.code_column, curve=options.curve)
+		else:
+			latency = None
+			if options.latency:
+				latency = lambda: options.latency / 1000.0
+			backend = ffBackend.MemoryBackend(latency=latency, codes=bool(options.code_column), curve=options.curve)
+
+		ingester = Ingester(backend, batch_size=size, concurrency=options.concurrency, counts_every=options.counts_every,
+			lat=options.lat, lng=options.lng, id=options.id, progress=not options.quiet and progress or None)
+		ingester.run(read_files(args, options.format))
+		print ingester.report()
+
+if __name__ == "__main__":
+	logging.basicConfig(level=logging.WARNING)
+	main()
@@ -0,0 +1,322 @@
+"""
+Nearest neighbour and radius search over geohash cells
+
+Instead of a bbox, a point: the markers nearest to it, by great circle
+distance, and optionally no further than a radius.  Cells around the point
+are scanned ring by ring, see geohash.ring, keeping the nearest limit
+markers in a heap, and the search stops as soon as the cells not yet
+scanned are all further away than the limit-th marker, or the radius.  The
+first cells are sized from the backend's prefix counts, so that the point's
+cell and the ring around it hold about limit markers, and rows read grow
+with limit rather than with the area searched.  After a few rings without
+an answer, as around a point far from any marker, the search starts again
+with cells a character shorter.
+
+Usage:
+>>> near = ffNearSearch(point='-0.1275,51.5072', limit=10, radius=5000, backend=backend)
+>>> near.search()
+>>> for result in near.results: logging.info('%s is %dm away' % (result['geohash'], result['distance']))
+
+where kwargs contains:
+point - "lng, lat" to search around
+limit - number of markers to find, at least 1 (default value = 10, at most 1000)
+radius - if given, only markers within this many metres
+chars - characters of geohash of the first cells, instead of sizing them from the prefix counts
+backend - where markers are fetched from, see ffBackend, keyed by geohash.  default is the datastore, queried with the gql given to search
+code_column - for that default, the integer property of Morton codes to scan instead of geohash, see ffBackend
+trace - an ffTrace.Trace to record timings and counters in.  the caller finishes it
+logging - set to True to also generate near.log for debugging
+
+Results are the markers found, nearest first, each with its distance in
+metres as result['distance'].
+"""
+
+import heapq
+from math import radians, sin, cos, asin, sqrt, log, pi
+
+# geohash from http://mappinghacks.com/code/geohash.py.txt
+import geohash
+
+# asynctools from http://code.google.com/p/asynctools/
+from asynctools import AsyncMultiTask
+
+# range scans on the datastore or elsewhere
+from ffBackend import DatastoreBackend
+
+# timings and counters
+from ffTrace import NULL_TRACE
+
+# mean radius of the earth in metres
+EARTH_RADIUS = 6371009.0
+
+# great circle distance in metres
+def haversine(lng1, lat1, lng2, lat2):
+	dlat = radians(lat2 - lat1)
+	dlng = radians(lng2 - lng1)
+	a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlng / 2) ** 2
+	return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+# metres from a point to the nearest point of a meridian, pole to pole
+def meridian_distance(lng, lat, meridian):
+	dlng = radians(abs((meridian - lng + 180) % 360 - 180))
+	if dlng >= pi / 2:
+		# nearest at a pole
+		return EARTH_RADIUS * (pi / 2 - radians(abs(lat)))
+	return EARTH_RADIUS * asin(min(1.0, sin(dlng) * cos(radians(lat))))
+
+# (width, height) in degrees of a geohash cell of chars characters
+# from the bits, as Geohash.bbox() is twice as wide for an odd number of bits
+def cell_size(chars):
+	nbits = chars * 5
+	return 360.0 / (1 << (nbits - nbits / 2)), 180.0 / (1 << (nbits / 2))
+
+# finds the markers nearest a point, ring by ring of geohash cells
+class ffNearSearch(object):
+
+	# the most rows requested by a single page
+	page_max = 1000
+	
+	# the most markers a search returns
+	limit_max = 1000
+
+	# rings scanned at one precision before falling back to cells a character shorter
+	rings_per_precision = 4
+
+	def __init__(self, **kwargs):
+
+		if 'trace' in kwargs and kwargs['trace'] is not None:
+			self.trace = kwargs['trace']
+		else:
+			self.trace = NULL_TRACE
+
+		if 'point' not in kwargs:
+			raise ValueError('point is required')
+		try:
+			[self.lng, self.lat] = map(float, kwargs['point'].split(','))
+		except ValueError:
+			raise ValueError('point is "lng, lat"')
+		if not (-180 <= self.lng <= 180 and -90 <= self.lat <= 90):
+			raise ValueError('point is off the map')
+
+		if 'limit' in kwargs:
+			self.limit = min(self.limit_max, int(kwargs['limit']))
+		else:
+			self.limit = 10
+		if self.limit < 1:
+			raise ValueError('limit is at least 1')
+
+		if 'radius' in kwargs and kwargs['radius'] is not None:
+			self.radius = float(kwargs['radius'])
+		else:
+			self.radius = None
+
+		if 'chars' in kwargs and kwargs['chars']:
+			self.chars = max(1, min(12, int(kwargs['chars'])))
+		else:
+			self.chars = None
+
+		if 'backend' in kwargs:
+			self.backend = kwargs['backend']
+		else:
+			self.backend = None
+
+		if 'code_column' in kwargs:
+			self.code_column = kwargs['code_column']
+		else:
+			self.code_column = None
+
+		self.hash = str(geohash.Geohash((self.lng, self.lat)))
+		self.results = []
+
+		# keep some logging
+		self.log = []
+		if 'logging' in kwargs and kwargs['logging'] == True:
+			self.logging = True
+		else:
+			self.logging = False
+
+
+	# characters of the first cells: the finest whose block of nine cells around the point holds limit markers,
+	# and with a radius, none much smaller than it
+	def precision(self, backend):
+		if self.chars:
+			return self.chars
+
+		blocks = [geohash.ring(self.hash[:chars], 0) + geohash.ring(self.hash[:chars], 1) for chars in range(1, backend.count_depth + 1)]
+		counts = backend.prefix_counts([prefix for block in blocks for prefix in block])
+		totals = [sum([counts[prefix][0] for prefix in block if prefix in counts]) for block in blocks]
+
+		chars = 1
+		for depth, total in enumerate(totals):
+			if total >= self.limit:
+				chars = depth + 1
+
+		# denser than the prefix counts go: a character more for every 32 times limit
+		if chars == len(blocks) and totals[-1]:
+			chars += int(log(totals[-1] / float(max(1, self.limit)), 32))
+
+		if self.radius is not None:
+			while chars < 12:
+				width, height = cell_size(chars + 1)
+				if radians(height) * EARTH_RADIUS < self.radius:
+					break
+				chars += 1
+
+		return min(12, chars)
+
+
+	# metres from the point to the nearest point outside the block of cells
+	# (west, south, east, north) around it, or None when the block is the whole world
+	def reach(self, west, south, east, north):
+		edges = []
+		if south > -90:
+			edges.append(EARTH_RADIUS * radians(self.lat - south))
+		if north < 90:
+			edges.append(EARTH_RADIUS * radians(north - self.lat))
+		if east - west < 360:
+			edges.append(meridian_distance(self.lng, self.lat, west))
+			edges.append(meridian_distance(self.lng, self.lat, east))
+		if not edges:
+			return None
+		return max(0.0, min(edges))
+
+
+	# [lo, hi) key ranges of cells in key order, runs of consecutive cells as one range
+	def ranges(self, cells):
+		ranges = []
+		last = None
+		for cell in cells:
+			code = geohash.Geohash(cell).code()
+			if last is not None and code == last + 1:
+				ranges[-1][1] = code + 1
+			else:
+				ranges.append([code, code + 1])
+			last = code
+
+		chars = cells and len(cells[0]) or 0
+		keys = []
+		for lo, hi in ranges:
+			if hi >> (chars * 5):
+				keys.append((str(geohash.Geohash.from_code(lo, chars)), '~'))
+			else:
+				keys.append((str(geohash.Geohash.from_code(lo, chars)), str(geohash.Geohash.from_code(hi, chars))))
+		return keys
+
+
+	# every marker in the key ranges, a page of each range at a time
+	def scan(self, backend, ranges):
+		rows = []
+
+		# where the next page of each range starts, as (geohash, rows at that geohash already seen)
+		cursors = dict([(key, (ranges[key][0], 0)) for key in range(len(ranges))])
+
+		while cursors:
+			runner = AsyncMultiTask()
+			task_keys = {}
+			for key, (lo, seen) in cursors.items():
+				task = backend.scan_task(lo, ranges[key][1], self.page_max + seen)
+				task_keys[id(task)] = key
+				runner.append(task)
+
+			self.trace.count('queries', len(cursors))
+			started = self.trace.begin()
+			runner.run()
+			self.trace.end('rpc', started)
+
+			more = {}
+			for task in runner:
+				key = task_keys[id(task)]
+				page = task.get_result()
+				rows += page[cursors[key][1]:]
+
+				# a full page means there may be more to come
+				if len(page) == self.page_max + cursors[key][1]:
+					last = page[-1]['geohash']
+					more[key] = (last, len([1 for row in page if row['geohash'] == last]))
+			cursors = more
+
+		self.trace.count('rows_fetched', len(rows))
+		return rows
+
+
+	def search(self, gql=None):
+		backend = self.backend
+		if backend is None:
+			backend = DatastoreBackend(gql, code_column=self.code_column)
+		if backend.curve != 'z':
+			raise ValueError('near searches need a backend keyed by geohash')
+
+		started = self.trace.begin()
+		chars = self.precision(backend)
+		self.trace.end('precision', started)
+
+		# the nearest limit markers so far, as (-distance, order found, row), furthest on top
+		heap = []
+		found = 0
+
+		while True:
+			center = self.hash[:chars]
+			width, height = cell_size(chars)
+			west, south = geohash.Geohash(center).bbox()[:2]
+			east, north = west + width, south + height
+
+			# rings wrap around the world and come back to cells already scanned
+			scanned = {}
+			radius = 0
+			while True:
+				ring = geohash.ring(center, radius)
+				if not ring:
+					reach = None
+					break
+				cells = [cell for cell in ring if cell not in scanned]
+				for cell in cells:
+					scanned[cell] = True
+
+				rows = self.scan(backend, self.ranges(cells))
+				self.trace.count('rings')
+				self.trace.count('cells', len(cells))
+
+				filtered = self.trace.begin()
+				for row in rows:
+					distance = haversine(self.lng, self.lat, row['lng'], row['lat'])
+					if self.radius is not None and distance > self.radius:
+						continue
+					found += 1
+					if len(heap) < self.limit:
+						heapq.heappush(heap, (-distance, found, row))
+					elif distance < -heap[0][0]:
+						heapq.heapreplace(heap, (-distance, found, row))
+				self.trace.end('filter', filtered)
+
+				# nearest point not yet scanned
+				reach = self.reach(west - radius * width, south - radius * height, east + radius * width, north + radius * height)
+
+				if self.logging:
+					self.log.append({
+						'type' : 'message',
+						'content' : 'ring %d of %d character cells: %d cells, %d rows, %d kept, unscanned from %s metres' % (radius, chars, len(cells), len(rows), len(heap), reach is None and '-' or '%d' % reach)
+					})
+
+				if reach is None:
+					break
+				if self.radius is not None and reach > self.radius:
+					break
+				if len(heap) == self.limit and reach >= -heap[0][0]:
+					break
+				if radius + 1 >= self.rings_per_precision and chars > 1:
+					break
+				radius += 1
+
+			# stopped with more to search: start again with bigger cells
+			if reach is None or (self.radius is not None and reach > self.radius) or (len(heap) == self.limit and reach >= -heap[0][0]):
+				break
+			chars -= 1
+			heap = []
+			self.trace.count('coarsened')
+
+		results = []
+		for distance, order, row in sorted(heap, reverse=True):
+			row['distance'] = -distance
+			results.append(row)
+		self.results = results
+		self.trace.count('rows_kept', len(results))
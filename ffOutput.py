@@ -0,0 +1,144 @@
+"""
+Response writers for ffGeoSearch results
+
+write_geojson serialises a GeoJSON FeatureCollection into a file-like
+object one feature at a time, from pre-encoded fragments for the constant
+parts, instead of building dicts for every feature and dumping them in one
+go.  It writes results once the search is done with them: it saves the
+copies of the result set, but doesn't stream markers out as queries
+complete, and webapp buffers the response until the handler returns.
+Aggregated cells are written as point features at their centroid with a
+count property, and markers of a near search with a distance property.
+
+>>> write_geojson(self.response.out, geo.results, geo.log, callback, geo.next_cursor)
+
+A cursor, when there are more markers to fetch, is written as a "cursor"
+member of the collection.
+
+write_columnar packs the same markers into a compact binary layout,
+little endian throughout:
+
+4 bytes  - 'FFC1'
+uint32   - number of markers, n
+uint8    - characters per geohash
+n varints - geohash integers in ascending order, each as the difference
+            from the one before (unsigned LEB128)
+n float32 - latitudes, in the same order
+n float32 - longitudes, in the same order
+
+read_columnar is the reference decoder, giving back geohash, lat and lng
+for each marker.  Coordinates lose precision to float32, about a metre.
+"""
+
+import struct
+
+# geohash from http://mappinghacks.com/code/geohash.py.txt
+import geohash
+
+try:
+	from django.utils import simplejson
+except ImportError:
+	try:
+		import simplejson
+	except ImportError:
+		import json as simplejson
+
+# constant parts of a feature collection
+GEOJSON_START = '{"type": "FeatureCollection", "features": ['
+GEOJSON_FEATURE = '{"type": "Feature", "geometry": {"type": "Point", "coordinates": [%r, %r]}, "properties": {"geohash": %s}}'
+GEOJSON_NEAR = '{"type": "Feature", "geometry": {"type": "Point", "coordinates": [%r, %r]}, "properties": {"geohash": %s, "distance": %.1f}}'
+GEOJSON_CLUSTER = '{"type": "Feature", "geometry": {"type": "Point", "coordinates": [%r, %r]}, "properties": {"geohash": %s, "count": %d}}'
+GEOJSON_LOG = '], "log": ['
+GEOJSON_CURSOR = '], "cursor": %s}'
+GEOJSON_END = ']}'
+
+# write results as geojson, wrapped in parentheses and optionally a jsonp callback
+def write_geojson(out, results, log=None, callback=None, cursor=None):
+	if callback:
+		out.write(callback + ' && ' + callback)
+		
+	out.write('(' + GEOJSON_START)
+	
+	separator = ''
+	for result in results:
+		if 'count' in result:
+			# aggregated cell
+			out.write(separator + GEOJSON_CLUSTER % (float(result['lng']), float(result['lat']), simplejson.dumps(result['geohash']), result['count']))
+		elif 'distance' in result:
+			# near search, metres from the point
+			out.write(separator + GEOJSON_NEAR % (float(result['lng']), float(result['lat']), simplejson.dumps(result['geohash']), result['distance']))
+		else:
+			out.write(separator + GEOJSON_FEATURE % (float(result['lng']), float(result['lat']), simplejson.dumps(result['geohash'])))
+		separator = ', '
+		
+	if log:
+		out.write(GEOJSON_LOG)
+		
+		separator = ''
+		for entry in log:
+			out.write(separator + simplejson.dumps(entry))
+			separator = ', '
+			
+	if cursor:
+		out.write(GEOJSON_CURSOR % simplejson.dumps(cursor) + ')')
+	else:
+		out.write(GEOJSON_END + ')')
+
+
+COLUMNAR_MAGIC = 'FFC1'
+
+# unsigned LEB128
+def _varint(n):
+	bytes = []
+	while n > 0x7F:
+		bytes.append(chr(0x80 | (n & 0x7F)))
+		n >>= 7
+	bytes.append(chr(n))
+	return ''.join(bytes)
+	
+# write results in the compact columnar layout
+def write_columnar(out, results):
+	rows = [(geohash.Geohash(str(result['geohash'])).code(), float(result['lat']), float(result['lng'])) for result in results]
+	rows.sort()
+	
+	chars = rows and len(str(results[0]['geohash'])) or 0
+	out.write(COLUMNAR_MAGIC + struct.pack('<IB', len(rows), chars))
+	
+	previous = 0
+	for code, lat, lng in rows:
+		out.write(_varint(code - previous))
+		previous = code
+		
+	out.write(struct.pack('<%df' % len(rows), *[row[1] for row in rows]))
+	out.write(struct.pack('<%df' % len(rows), *[row[2] for row in rows]))
+
+# decode the compact columnar layout into a list of geohash, lat and lng dicts
+def read_columnar(data):
+	if data[:4] != COLUMNAR_MAGIC:
+		raise ValueError('not a columnar marker response')
+		
+	count, chars = struct.unpack('<IB', data[4:9])
+	offset = 9
+	
+	hashes = []
+	code = 0
+	for i in range(count):
+		delta = shift = 0
+		while True:
+			byte = ord(data[offset])
+			offset += 1
+			delta |= (byte & 0x7F) << shift
+			shift += 7
+			if byte < 0x80:
+				break
+		code += delta
+		hashes.append(str(geohash.Geohash.from_code(code, chars)))
+		
+	lats = struct.unpack('<%df' % count, data[offset:offset + 4 * count])
+	lngs = struct.unpack('<%df' % count, data[offset + 4 * count:offset + 8 * count])
+	
+	return [{
+		'geohash' : hashes[i],
+		'lat' : lats[i],
+		'lng' : lngs[i]
+	} for i in range(count)]
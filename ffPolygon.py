@@ -0,0 +1,266 @@
+"""
+Polygons and sets of boxes for ffGeoSearch
+
+A Polygon is one part or several, each an outer ring and any holes in it,
+as in GeoJSON Polygon and MultiPolygon coordinates, or a list of bounding
+boxes.  A point is inside if it is inside any part, by ray casting: inside a
+part if a ray from it crosses the part's rings an odd number of times.
+
+Edges are indexed by latitude band, so that a point is only cast against
+the edges crossing its band, and filtering thousands of candidates costs a
+few edges each rather than every edge of a country's outline.
+
+cover() plans the key ranges to query.  The cells over the bbox are sorted
+into inside, outside and boundary, and boundary cells split into their 32
+children while the cell budget allows, so the interior is covered by a few
+coarse cells and the edges by fine ones.  The cells are then merged into
+contiguous key ranges, see geohash.merge_cells.
+
+>>> zone = parse('{"type": "Polygon", "coordinates": [[[-0.5, 51.3], [0.3, 51.3], [-0.1, 51.7], [-0.5, 51.3]]]}')
+>>> zone.contains(-0.1, 51.5)
+True
+>>> ranges = zone.cover(max_ranges=16)
+
+or from boxes "west, south, east, north; west, south, east, north"
+>>> zones = parse_boxes('-0.5,51.3,0.3,51.7;2.2,48.8,2.5,48.9')
+
+Longitudes are -180 to 180 and rings don't cross the dateline: split those
+that would in two.  A box with west > east is split for you.  Points on an
+edge may fall either side of it.
+"""
+
+import hashlib
+
+# geohash from http://mappinghacks.com/code/geohash.py.txt
+import geohash
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+# how a cell lies with respect to a polygon
+OUTSIDE = 0
+BOUNDARY = 1
+INSIDE = 2
+
+# a polygon of one or more parts, each a list of rings of [lng, lat]
+class Polygon(object):
+
+	# the most latitude bands in the edge index
+	max_bands = 1024
+
+	def __init__(self, parts):
+		self.parts = []
+
+		# (south end, north end, lng at the south end, lng per degree of lat, part, x1, y1, x2, y2, west end, east end)
+		self.edges = []
+
+		for part in parts:
+			rings = []
+			for ring in part:
+				try:
+					points = [(float(point[0]), float(point[1])) for point in ring]
+				except (TypeError, ValueError, IndexError):
+					raise ValueError('rings are lists of [lng, lat]')
+
+				# closed or not, the last point joins the first
+				if len(points) > 1 and points[0] == points[-1]:
+					points = points[:-1]
+				if len(points) < 3:
+					raise ValueError('rings need at least 3 points')
+				for lng, lat in points:
+					if not (-180 <= lng <= 180 and -90 <= lat <= 90):
+						raise ValueError('polygon is off the map')
+				rings.append(points)
+
+				for index in range(len(points)):
+					x1, y1 = points[index - 1]
+					x2, y2 = points[index]
+					if y1 <= y2:
+						low, high = (x1, y1), (x2, y2)
+					else:
+						low, high = (x2, y2), (x1, y1)
+					slope = high[1] > low[1] and (high[0] - low[0]) / (high[1] - low[1]) or 0.0
+					self.edges.append((low[1], high[1], low[0], slope, len(self.parts), x1, y1, x2, y2, min(x1, x2), max(x1, x2)))
+
+			if not rings:
+				raise ValueError('parts need an outer ring')
+			self.parts.append(rings)
+
+		if not self.parts:
+			raise ValueError('polygon is empty')
+
+		points = [point for part in self.parts for ring in part for point in ring]
+		self.west = min([lng for lng, lat in points])
+		self.south = min([lat for lng, lat in points])
+		self.east = max([lng for lng, lat in points])
+		self.north = max([lat for lng, lat in points])
+
+		# plans of the same polygon are the same
+		self.key = hashlib.md5(repr(self.parts)).hexdigest()
+
+		# each band lists the edges reaching into it
+		self.bands = [[] for band in range(max(1, min(self.max_bands, len(self.edges))))]
+		self.band_height = (self.north - self.south) / len(self.bands) or 1.0
+		for edge in self.edges:
+			for band in range(self.band(edge[0]), self.band(edge[1]) + 1):
+				self.bands[band].append(edge)
+
+
+	# GeoJSON Polygon or MultiPolygon geometry, a Feature of one, or the coordinates of a Polygon
+	def from_geojson(cls, geometry):
+		if isinstance(geometry, dict):
+			if geometry.get('type') == 'Feature':
+				geometry = geometry.get('geometry') or {}
+			if geometry.get('type') == 'Polygon':
+				return cls([geometry.get('coordinates') or []])
+			if geometry.get('type') == 'MultiPolygon':
+				return cls(geometry.get('coordinates') or [])
+			raise ValueError('polygon is a GeoJSON Polygon or MultiPolygon')
+		if isinstance(geometry, list):
+			return cls([geometry])
+		raise ValueError('polygon is a GeoJSON Polygon or MultiPolygon')
+	from_geojson = classmethod(from_geojson)
+
+
+	# list of (west, south, east, north), each a part
+	def from_boxes(cls, boxes):
+		parts = []
+		for west, south, east, north in boxes:
+			if south > north:
+				raise ValueError('box south of its north')
+			if west > east:
+				# across the dateline, either side of it
+				spans = [(west, 180.0), (-180.0, east)]
+			else:
+				spans = [(west, east)]
+			for west, east in spans:
+				parts.append([[(west, south), (east, south), (east, north), (west, north)]])
+		return cls(parts)
+	from_boxes = classmethod(from_boxes)
+
+
+	def bbox(self):
+		return (self.west, self.south, self.east, self.north)
+
+
+	# index of the band holding lat
+	def band(self, lat):
+		return max(0, min(len(self.bands) - 1, int((lat - self.south) / self.band_height)))
+
+
+	# the edges reaching into the lats south to north, and maybe some others
+	def edges_between(self, south, north):
+		first, last = self.band(south), self.band(north)
+		if first == last:
+			return self.bands[first]
+		return [edge for edge in self.edges if edge[0] <= north and edge[1] >= south]
+
+
+	# true if the point is inside any part
+	def contains(self, lng, lat):
+		if lng < self.west or lng > self.east or lat < self.south or lat > self.north:
+			return False
+
+		crossed = [False] * len(self.parts)
+		for south, north, x, slope, part, x1, y1, x2, y2, west, east in self.bands[self.band(lat)]:
+			if south <= lat < north and lng < x + (lat - south) * slope:
+				crossed[part] = not crossed[part]
+		return True in crossed
+
+
+	# INSIDE, OUTSIDE or, where an edge crosses it, BOUNDARY of the polygon for a cell (west, south, east, north)
+	def classify(self, west, south, east, north):
+		return self.crossed((west, south, east, north), self.edges_between(south, north))[0]
+
+
+	# how a cell lies, as classify, and which of edges cross it: only those can cross the cells inside it
+	def crossed(self, cell, edges):
+		west, south, east, north = cell
+		if east < self.west or west > self.east or north < self.south or south > self.north:
+			return OUTSIDE, []
+
+		corners = ((west, south), (east, south), (east, north), (west, north))
+		crossing = []
+		for edge in edges:
+			if edge[10] < west or edge[9] > east or edge[1] < south or edge[0] > north:
+				continue
+
+			# the edge misses the cell if every corner is on the same side of it
+			x1, y1, x2, y2 = edge[5:9]
+			sides = [(x2 - x1) * (y - y1) - (y2 - y1) * (x - x1) for x, y in corners]
+			if min(sides) <= 0 <= max(sides):
+				crossing.append(edge)
+		if crossing:
+			return BOUNDARY, crossing
+
+		# no edge crosses the cell, so it is all on the side of its centre
+		if self.contains((west + east) / 2, (south + north) / 2):
+			return INSIDE, []
+		return OUTSIDE, []
+
+
+	# geohash key ranges [lo, hi) holding every hash inside, from at most max_cells cells of up to max_chars characters
+	# merged to at most max_ranges ranges
+	def cover(self, max_ranges=16, max_cells=256, max_chars=12):
+		# the finest cells over the bbox that leave room to split
+		prefixes = geohash.finest_cells(self.bbox(), max(1, max_cells / 8), max_chars)
+
+		# cells kept as they are, and boundary cells to split, coarsest first, with the edges crossing them
+		covered = []
+		boundary = []
+		for prefix in prefixes:
+			cell = geohash.cell_bbox(prefix)
+			kind, edges = self.crossed(cell, self.edges_between(cell[1], cell[3]))
+			if kind == INSIDE:
+				covered.append(prefix)
+			elif kind == BOUNDARY:
+				boundary.append((prefix, edges))
+
+		index = 0
+		while index < len(boundary):
+			prefix, edges = boundary[index]
+			index += 1
+			if len(prefix) >= max_chars:
+				covered.append(prefix)
+				continue
+
+			children = []
+			for char in geohash.Geohash.BASE_32:
+				kind, crossing = self.crossed(geohash.cell_bbox(prefix + char), edges)
+				if kind != OUTSIDE:
+					children.append((prefix + char, kind, crossing))
+
+			# no room to split: this cell and those after it stay as they are
+			if len(covered) + len(boundary) - index + len(children) > max_cells:
+				covered.append(prefix)
+				covered += [cell[0] for cell in boundary[index:]]
+				break
+
+			for child, kind, crossing in children:
+				if kind == INSIDE:
+					covered.append(child)
+				else:
+					boundary.append((child, crossing))
+
+		return geohash.merge_cells(covered, max_ranges)
+
+
+# a Polygon from a GeoJSON geometry as a string
+def parse(text):
+	try:
+		geometry = json.loads(text)
+	except ValueError:
+		raise ValueError('polygon is not JSON')
+	return Polygon.from_geojson(geometry)
+
+# a Polygon from boxes "west, south, east, north; west, south, east, north"
+def parse_boxes(text):
+	try:
+		boxes = [map(float, box.split(',')) for box in text.split(';') if box.strip()]
+	except ValueError:
+		raise ValueError('boxes are "west, south, east, north; ..."')
+	if not boxes or [box for box in boxes if len(box) != 4]:
+		raise ValueError('boxes are "west, south, east, north; ..."')
+	return Polygon.from_boxes(boxes)
@@ -0,0 +1,148 @@
+"""
+Per-request tracing for ffGeoSearch
+
+A Trace collects timings, as total seconds and count per name, and
+counters over one request, and hands itself to its sinks when finished.
+NULL_TRACE does nothing at all, so that instrumented code costs a couple
+of empty method calls when tracing is off; start samples between the two.
+
+>>> trace = start([recent, LogSink()], rate=0.01)
+>>> started = trace.begin()
+>>> ...
+>>> trace.end('plan', started)
+>>> trace.count('rows_fetched', 100)
+>>> trace.finish()
+
+Sinks have an emit(trace) method:
+
+RingBuffer - the last size traces, in process
+LogSink - one log line per trace
+HeaderSink - the line as a response header
+"""
+
+import time, random, logging, threading
+
+# timings and counters of one request
+class Trace(object):
+
+	enabled = True
+
+	def __init__(self, sinks=(), name='search'):
+		self.sinks = list(sinks)
+		self.name = name
+		self.started = time.time()
+		self.total = None
+		self.timings = {}
+		self.counters = {}
+
+	def begin(self):
+		return time.time()
+
+	# add the time since started, as returned by begin, to name
+	def end(self, name, started):
+		timing = self.timings.setdefault(name, [0.0, 0])
+		timing[0] += time.time() - started
+		timing[1] += 1
+
+	# add seconds measured elsewhere to name
+	def timing(self, name, seconds, count=1):
+		timing = self.timings.setdefault(name, [0.0, 0])
+		timing[0] += seconds
+		timing[1] += count
+
+	def count(self, name, value=1):
+		self.counters[name] = self.counters.get(name, 0) + value
+
+	def finish(self):
+		self.total = time.time() - self.started
+		for sink in self.sinks:
+			sink.emit(self)
+
+	def as_dict(self):
+		return {
+			'name' : self.name,
+			'started' : self.started,
+			'total_ms' : self.total is not None and 1000 * self.total or None,
+			'timings_ms' : dict([(name, (1000 * seconds, count)) for name, (seconds, count) in self.timings.items()]),
+			'counters' : dict(self.counters)
+		}
+
+	# one line: total, then name=ms/count for timings and name=value for counters
+	def __str__(self):
+		parts = ['%s total=%.1fms' % (self.name, 1000 * (self.total or time.time() - self.started))]
+		parts += ['%s=%.1fms/%d' % (name, 1000 * self.timings[name][0], self.timings[name][1]) for name in sorted(self.timings)]
+		parts += ['%s=%s' % (name, self.counters[name]) for name in sorted(self.counters)]
+		return ' '.join(parts)
+
+
+# stands in for a Trace when tracing is off
+class NullTrace(object):
+
+	enabled = False
+
+	def begin(self):
+		return None
+
+	def end(self, name, started):
+		pass
+
+	def timing(self, name, seconds, count=1):
+		pass
+
+	def count(self, name, value=1):
+		pass
+
+	def finish(self):
+		pass
+
+NULL_TRACE = NullTrace()
+
+# a Trace for rate of the requests, NULL_TRACE for the rest
+def start(sinks, rate=1.0, name='search'):
+	if sinks and (rate >= 1 or random.random() < rate):
+		return Trace(sinks, name)
+	return NULL_TRACE
+
+
+# the last size traces, newest last
+class RingBuffer(object):
+
+	def __init__(self, size=100):
+		self.size = size
+		self.traces = []
+		self.lock = threading.Lock()
+
+	def emit(self, trace):
+		self.lock.acquire()
+		try:
+			self.traces.append(trace.as_dict())
+			del self.traces[:-self.size]
+		finally:
+			self.lock.release()
+
+	def recent(self):
+		self.lock.acquire()
+		try:
+			return list(self.traces)
+		finally:
+			self.lock.release()
+
+
+class LogSink(object):
+
+	def __init__(self, level=logging.INFO):
+		self.level = level
+
+	def emit(self, trace):
+		logging.log(self.level, 'trace %s', trace)
+
+
+# sets the trace line as a header, e.g. of a webapp response
+class HeaderSink(object):
+
+	def __init__(self, headers, name='X-FF-Trace'):
+		self.headers = headers
+		self.name = name
+
+	def emit(self, trace):
+		self.headers[self.name] = str(trace)
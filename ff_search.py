@@ -2,7 +2,6 @@ from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
-from django.utils import simplejson
 import logging, os, string, urllib, random
 
 # geohash from http://mappinghacks.com/code/geohash.py.txt
@@ -11,12 +10,41 @@ import geohash
 # faultline friendly geo search
 import ffGeoSearch
 
-# sample datamodel
+# nearest markers to a point
+import ffNearSearch
+
+# prefix counts kept alongside the markers
+import ffBackend
+
+# response writers
+import ffOutput
+
+# bulk loading
+import ffIngest
+
+# per-process cache in front of memcache, shared by every request this instance serves
+from asynctools import LocalCache
+local_cache = LocalCache(max_bytes=8 << 20, time=60)
+
+# the last traces this instance recorded
+import ffTrace
+recent_traces = ffTrace.RingBuffer(100)
+
+# set to 'geocode' to store and scan one integer Morton code per marker instead of the geohash and geostring strings
+# markers already loaded need loading again
+CODE_COLUMN = None
+
+# or 'hilbert' to order markers by a Hilbert curve, with fewer and tighter ranges per viewport
+CURVE = 'z'
+
+# sample datamodel; markers have either geohash and geostring, geocode, or hilbert, see CODE_COLUMN and CURVE
 class ffMarker(db.Model):
 	lat = db.FloatProperty(required=True)
 	lng = db.FloatProperty(required=True)
-	geohash = db.StringProperty(required=True)
-	geostring = db.StringProperty(required=True)
+	geohash = db.StringProperty()
+	geostring = db.StringProperty()
+	geocode = db.IntegerProperty()
+	hilbert = db.StringProperty()
 
 # sample spatial query handler
 class SpatialQueryHandler(webapp.RequestHandler):
@@ -27,6 +55,14 @@ class SpatialQueryHandler(webapp.RequestHandler):
 		# bounding box standard is west, south, east, north
 		if 'bbox' in self.request.arguments():
 			kwargs['bbox'] = self.request.get('bbox')
+			
+		# or a GeoJSON Polygon or MultiPolygon geometry, e.g. a delivery zone
+		if 'polygon' in self.request.arguments():
+			kwargs['polygon'] = self.request.get('polygon')
+			
+		# or several boxes "west, south, east, north; west, south, east, north"
+		if 'boxes' in self.request.arguments():
+			kwargs['boxes'] = self.request.get('boxes')
 
 		# 0 = off, 1 = on, 2 = double
 		if 'correction' in self.request.arguments():
@@ -38,71 +74,149 @@ class SpatialQueryHandler(webapp.RequestHandler):
 		if 'border' in self.request.arguments():
 			kwargs['border'] = float(self.request.get('border'))
 		
+		# counts per geohash cell instead of markers, for zoomed out views, at most 1000 cells as one batch get takes
+		if 'aggregate' in self.request.arguments():
+			kwargs['aggregate'] = min(1000, int(self.request.get('aggregate')))
+		
+		# drop markers outside the bbox unless asked not to
+		kwargs['filter'] = self.request.get('filter', default_value='on') == 'on'
+		
+		# share the limit between boxes, filtering each as its query completes
+		kwargs['merge'] = self.request.get('merge', default_value='on') == 'on'
+		kwargs['concurrency'] = 4
+		
 		kwargs['cache_ttl'] = 300
+		kwargs['local_cache'] = local_cache
+		kwargs['single_flight'] = True
+		kwargs['stale_ttl'] = 60
+		
+		# keys first, then only the markers returned; needs markers loaded with geohash key names
+		if self.request.get('two_phase', default_value='off') == 'on':
+			kwargs['two_phase'] = True
+			kwargs['entity_cache'] = local_cache
+		
+		# 'tiles' to cache per geohash tile rather than per rounded bbox
+		if 'quantize' in self.request.arguments():
+			kwargs['quantize'] = self.request.get('quantize')
 		
 		if self.request.get('logging', default_value='off') == 'on':
 			kwargs['logging'] = True
 		
+		# the next page of an earlier response with the same arguments
+		if 'cursor' in self.request.arguments():
+			kwargs['cursor'] = self.request.get('cursor')
+			
+		# after a pan, only the markers outside the bbox the client already has
+		if 'previous' in self.request.arguments():
+			kwargs['previous'] = self.request.get('previous')
+		
+		# trace a sample of searches, and any asked for with trace=on in a response header
+		if self.request.get('trace', default_value='off') == 'on':
+			trace = ffTrace.Trace([recent_traces, ffTrace.LogSink(), ffTrace.HeaderSink(self.response.headers)])
+		else:
+			trace = ffTrace.start([recent_traces, ffTrace.LogSink()], rate=0.01)
+		kwargs['trace'] = trace
+		kwargs['code_column'] = CODE_COLUMN
+		kwargs['curve'] = CURVE
+		
 		# initialize search
-		geo = ffGeoSearch.ffGeoSearch(**kwargs)
+		try:
+			geo = ffGeoSearch.ffGeoSearch(**kwargs)
+		except ValueError, e:
+			self.error(400)
+			self.response.out.write(str(e))
+			return
 	
 		# execute search
 		geo.search('SELECT * FROM ffMarker')
+		
+		started = trace.begin()
 
-		# collect results in an object
-		features = []
-		for result in geo.results:
-			features.append({
-				'type' : 'Feature',
-				'geometry' : {
-					'type' : 'Point',
-					'coordinates' : [result['lng'], result['lat']]
-				},
-				'properties' : {
-					'geohash' : result['geohash']
-				}
-			})
+		# columnar is compact binary for clients that can decode it, see ffOutput.read_columnar
+		if self.request.get('format', default_value='geojson') == 'columnar' and not geo.aggregate:
+			self.response.headers['Content-Type'] = 'application/octet-stream'
+			if geo.next_cursor:
+				self.response.headers['X-Cursor'] = geo.next_cursor
+			ffOutput.write_columnar(self.response.out, geo.results)
 			
-		# convert to geojson	
-		obj = {
-			'type' : 'FeatureCollection',
-			'features' : features
-		}
-		if len(geo.log):
-			obj['log'] = geo.log
+		else:
+			self.response.headers['Content-Type'] = 'application/json'
+
+			# serialise geojson a feature at a time into the buffered response
+			ffOutput.write_geojson(self.response.out, geo.results, geo.log, self.request.get("callback"), geo.next_cursor)
+			
+		trace.end('serialize', started)
+		trace.finish()
 		
-		self.response.headers['Content-Type'] = 'application/json'
+	# polygons can be too long for a url
+	post = get
 
-		callback = self.request.get("callback")
-		if callback:
-			self.response.out.write(callback + ' && ' + callback)
+# markers nearest a point, nearest first, with their distance in metres
+class NearQueryHandler(webapp.RequestHandler):
+	def get(self):
+	
+		kwargs = {}
+	
+		# point is lng, lat
+		if 'point' in self.request.arguments():
+			kwargs['point'] = self.request.get('point')
+		
+		# parsed by ffNearSearch, so that bad values are a 400
+		if 'limit' in self.request.arguments():
+			kwargs['limit'] = self.request.get('limit')
 		
-		self.response.out.write('(' + simplejson.dumps(obj) + ')')
+		# metres
+		if 'radius' in self.request.arguments():
+			kwargs['radius'] = self.request.get('radius')
+		
+		if self.request.get('logging', default_value='off') == 'on':
+			kwargs['logging'] = True
+		
+		if self.request.get('trace', default_value='off') == 'on':
+			trace = ffTrace.Trace([recent_traces, ffTrace.LogSink(), ffTrace.HeaderSink(self.response.headers)], name='near')
+		else:
+			trace = ffTrace.start([recent_traces, ffTrace.LogSink()], rate=0.01, name='near')
+		kwargs['trace'] = trace
+		kwargs['code_column'] = CODE_COLUMN
+		
+		try:
+			if CURVE != 'z':
+				raise ValueError('near searches need markers keyed by geohash')
+			near = ffNearSearch.ffNearSearch(**kwargs)
+		except ValueError, e:
+			self.error(400)
+			self.response.out.write(str(e))
+			return
+		
+		near.search('SELECT * FROM ffMarker')
+		
+		started = trace.begin()
+		self.response.headers['Content-Type'] = 'application/json'
+		ffOutput.write_geojson(self.response.out, near.results, near.log, self.request.get("callback"))
+		trace.end('serialize', started)
+		trace.finish()
 
-# add 100 random markers
-# you will need to call this a few times using /load_sample_data if you want to experiment with ffMarker entities
+# add random markers, 100 or ?count=, up to 5000 a call
+# for real datasets load files with ffIngest.py from the command line
 class LoadSampleData(webapp.RequestHandler):
 	def get(self):
 		
-		inserts = []
-		for sample in range(1, 100):
-			lat = float(random.randint(-800, 800)/10)
-			lng = float(random.randint(-1800, 1800)/10)
-			
-			marker = ffMarker(
-				lat = lat,
-				lng = lng,
-				geohash = str(geohash.Geohash((lng, lat))),
-				geostring = str(geohash.Geostring((lng, lat)))
-			)
+		count = min(5000, int(self.request.get('count', default_value='100')))
+		records = [{
+			'lat' : random.randint(-800, 800) / 10.0,
+			'lng' : random.randint(-1800, 1800) / 10.0
+		} for sample in range(count)]
 		
-			inserts.append(marker)				
-
-		if (len(inserts)):
-			db.put(inserts)
+		# no threads on App Engine, so one put at a time
+		ingester = ffIngest.Ingester(ffBackend.DatastoreBackend('SELECT * FROM ffMarker', code_column=CODE_COLUMN, curve=CURVE), batch_size=ffIngest.MAX_BATCH_SIZE, concurrency=1)
+		ingester.run(records)
+		
+		self.response.headers['Content-Type'] = 'text/plain'
+		self.response.out.write(ingester.report())
 	
 application = webapp.WSGIApplication([
 	('/ff_search.json', SpatialQueryHandler),
+	('/ff_near.json', NearQueryHandler),
 	('/load_sample_data', LoadSampleData)
 ], debug=True)
 
@@ -110,4 +224,4 @@ def main():
 	run_wsgi_app(application)
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
\ No newline at end of file
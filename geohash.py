@@ -75,6 +75,98 @@ True
 >>> hash.bbox()
 (-1.40625, 51.328125, 0.0, 52.03125)
 
+Underneath, both string classes print a Morton code, the integer made
+by interleaving longitude and latitude bits:
+
+>>> code = morton((-0.25,51.5),depth=8)
+>>> code
+31467L
+>>> int(str(hash),2) == code
+True
+>>> deinterleave(code,8)
+(127L, 201L)
+
+Whole columns of points can be encoded and decoded in one pass, with
+the same answers as the classes:
+
+>>> hashes, strings = encode_many([-0.25, 0.25], [51.5, 52.5], depth=8)
+>>> [str(h) for h in hashes]
+['gcph', 'u120']
+>>> str(strings[0]) == str(Geostring((-0.25,51.5),depth=8))
+True
+>>> minx, miny, maxx, maxy = decode_many(hashes)
+>>> (minx[0], miny[0], maxx[0], maxy[0]) == Geohash(str(hashes[0])).bbox()
+True
+
+A geohash is also an integer, which sorts in the same order:
+
+>>> Geohash('gcpu').code()
+503482L
+>>> str(Geohash.from_code(503482, 4))
+'gcpu'
+
+A bounding box can be covered by a few ranges of geohash keys:
+
+>>> cover((-0.5, 51.3, 0.3, 51.7), max_ranges=4)
+[('gcpeu', 'gcph0'), ('gcpsh', 'gcpyq'), ('u105b', 'u105z'), ('u10h0', 'u10np')]
+>>> 'gcpeu' < str(Geohash((-0.25, 51.5))) < 'gcpyq'
+True
+
+or listed cell by cell at a given precision:
+
+>>> cells((-0.5, 51.3, 0.3, 51.7), 3)
+['gcp', 'u10']
+
+or at the finest precision giving no more than so many cells:
+
+>>> finest_cells((-0.5, 51.3, 0.3, 51.7), 4)
+['gcp', 'u10']
+
+or ring by ring around a cell, for nearest neighbour searches, with
+longitude wrapping at the dateline:
+
+>>> ring('gcpu', 0)
+['gcpu']
+>>> ring('gcpu', 1)
+['gcpe', 'gcpg', 'gcps', 'gcpt', 'gcpv', 'u105', 'u10h', 'u10j']
+>>> ring('b', 1)
+['8', '9', 'c', 'x', 'z']
+
+Cells of any length merge into key ranges, as for a covering that is
+coarse inside a shape and fine along its edges:
+
+>>> merge_cells(['gcpv', 'gcpu', 'gcpy', 'u10'])
+[('gcpu', 'gcpw'), ('gcpy', 'gcpz'), ('u100', 'u110')]
+>>> cell_bbox('gcp')
+(-1.40625, 50.625, 0.0, 52.03125)
+
+For an integer column, the Morton code of 62 bits of each point fits a
+signed 64 bit integer, and key ranges become exact ranges of codes:
+
+>>> code = hash_code('gcpufr3cnxf6q')
+>>> code == morton((-0.25, 51.5), depth=31)
+True
+>>> code_hash(code)
+'gcpufr3cnxf6h'
+>>> lo, hi = prefix_range('gcpu')
+>>> lo <= code < hi
+True
+>>> code_range('gcpeu', 'gcph0') == (prefix_range('gcpeu')[0], prefix_range('gcpgz')[1])
+True
+
+Hilbert keys visit the same cells along a curve without faultlines, with
+the same API:
+
+>>> hash = Hilbert((-0.25, 51.5))
+>>> str(hash)
+'eyzgdq6nymt7s'
+>>> hash.bbox(4)
+(-0.351563, 51.328125, 0.0, 51.503906)
+>>> str(hash + Hilbert((-0.3, 51.45)))
+'eyzg'
+>>> hilbert_cover((-0.5, 51.3, 0.3, 51.7), max_ranges=4)
+[('eyz88', 'eyz8d'), ('eyzcn', 'eyzhd'), ('eyzmn', 'eyzms'), ('k10gn', 'k10nd')]
+
 Some degenerate cases:
 
 >>> west = Geostring("0")
@@ -89,17 +181,93 @@ Some degenerate cases:
 (-180.0, -90.0, 180.0, 90.0)
 """
 
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# integer codec
+#
+# the classes below are thin wrappers around a Morton code: longitude and
+# latitude are scaled to integers, their bits interleaved with magic-number
+# spreading, and the result printed through lookup tables, either as 0/1
+# characters (Geostring) or as base 32 (Geohash).
+
+_BASE_32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# 8 bits -> '01..' string, 10 bits -> two base 32 characters
+_BITS_8 = ["".join([str(n>>(7-i)&1) for i in range(8)]) for n in range(256)]
+_BASE_32_PAIRS = [a+b for a in _BASE_32 for b in _BASE_32]
+_BASE_32_DECODE = dict([(c,n) for n,c in enumerate(_BASE_32)])
+
+def _spread (n):
+    """spread the low 32 bits of n out to the even bits of a 64 bit word"""
+    n &= 0xFFFFFFFFL
+    n = (n | (n << 16)) & 0x0000FFFF0000FFFFL
+    n = (n | (n << 8))  & 0x00FF00FF00FF00FFL
+    n = (n | (n << 4))  & 0x0F0F0F0F0F0F0F0FL
+    n = (n | (n << 2))  & 0x3333333333333333L
+    n = (n | (n << 1))  & 0x5555555555555555L
+    return n
+
+def _squash (n):
+    """gather the even bits of the low 64 bits of n, undoing _spread"""
+    n &= 0x5555555555555555L
+    n = (n | (n >> 1))  & 0x3333333333333333L
+    n = (n | (n >> 2))  & 0x0F0F0F0F0F0F0F0FL
+    n = (n | (n >> 4))  & 0x00FF00FF00FF00FFL
+    n = (n | (n >> 8))  & 0x0000FFFF0000FFFFL
+    n = (n | (n >> 16)) & 0xFFFFFFFFL
+    return n
+
+def interleave (x, y, bits=32):
+    """interleave two bits-wide integers, x taking the higher bit of each pair"""
+    code = 0L
+    for shift in range(0, bits, 32):
+        code |= (_spread(x >> shift) << 1 | _spread(y >> shift)) << (shift*2)
+    return code
+
+def deinterleave (code, bits=32):
+    """split a Morton code back into its bits-wide x and y integers"""
+    x = y = 0L
+    for shift in range(0, bits, 32):
+        chunk = code >> (shift*2)
+        x |= _squash(chunk >> 1) << shift
+        y |= _squash(chunk) << shift
+    return x, y
+
+def morton ((x,y), bound=(-180,-90,180,90), depth=32):
+    """Morton code of a point: 2*depth interleaved bits, longitude first"""
+    mask = (1L << depth) - 1
+    x = long((x-bound[0])/float(bound[2]-bound[0]) * (1L << depth)) & mask
+    y = long((y-bound[1])/float(bound[3]-bound[1]) * (1L << depth)) & mask
+    return interleave(x, y, depth)
+
+def _code_to_bits (code, nbits):
+    pad = -nbits % 8
+    code <<= pad
+    return "".join([_BITS_8[code >> i & 0xFF]
+                        for i in range(nbits+pad-8, -1, -8)])[:nbits]
+
+def _code_to_base32 (code, nbits):
+    chars = (nbits + 4) / 5
+    pairs = (chars + 1) / 2
+    code <<= pairs*10 - nbits
+    return "".join([_BASE_32_PAIRS[code >> i & 0x3FF]
+                        for i in range(pairs*10-10, -1, -10)])[:chars]
+
+def _base32_to_code (hash):
+    code = 0L
+    for c in hash:
+        # unknown characters decode as 11111, as BASE_32.find() == -1 did
+        code = code << 5 | _BASE_32_DECODE.get(c, 31)
+    return code
+
 class Geostring (object):
-    def _to_bits (cls,f,depth=32):
-        f *= (1L << depth)
-        return [(long(f) >> (depth-i)) & 1 for i in range(1,depth+1)]
-    _to_bits = classmethod(_to_bits)
-
-    def bitstring (cls,(x,y),bound=(-180,-90,180,90),depth=32):
-        x = cls._to_bits((x-bound[0])/float(bound[2]-bound[0]),depth)
-        y = cls._to_bits((y-bound[1])/float(bound[3]-bound[1]),depth)
-        bits = reduce(lambda x,y:x+list(y), zip(x,y), [])
-        return "".join(map(str,bits))
+    def bitstring (cls,coord,bound=(-180,-90,180,90),depth=32):
+        return _code_to_bits(morton(coord,bound,depth), depth*2)
     bitstring = classmethod(bitstring)
 
     def __init__ (self, data, bound=(-180,-90,180,90), depth=32):
@@ -116,19 +284,20 @@ class Geostring (object):
         return self.hash
 
     def _to_bbox (self, bits):
-        depth = len(bits)/2
-        minx = miny = 0.0
+        return self._code_to_bbox(bits and int(bits,2) or 0L, len(bits))
+
+    def _code_to_bbox (self, code, nbits):
+        # with an odd number of bits the last one belongs to x
+        depth = nbits/2
+        xbits = nbits - depth
+        x, y = deinterleave(code << (xbits-depth), xbits)
+        minx = x / float(1L << xbits)
+        miny = y / float(1L << xbits)
         maxx = maxy = 1.0
-        for i in range(depth+1):
-            try:
-                minx += float(bits[i*2])/(2L<<i)
-                miny += float(bits[i*2+1])/(2L<<i)
-            except IndexError:
-                pass
         if depth:
             maxx = minx + 1.0/(2L<<(depth-1))
             maxy = miny + 1.0/(2L<<(depth-1))
-        elif len(bits) == 1:
+        elif nbits == 1:
             # degenerate case
             maxx = min(minx + .5, 1.0)
         minx, maxx = [self.origin[0]+x*self.size[0] for x in (minx,maxx)] 
@@ -179,20 +348,467 @@ class Geoindex (Geostring):
     __add__ = union
 
 class Geohash (Geostring):
-    BASE_32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+    BASE_32 = _BASE_32
 
     def bitstring (cls,coord,bound=(-180,-90,180,90),depth=32):
-        bits = Geostring.bitstring(coord,bound,depth)
-        hash = ""
-        for i in range(0,len(bits),5):
-            m = sum([int(n)<<(4-j) for j,n in enumerate(bits[i:i+5])])
-            hash += cls.BASE_32[m]
-        return hash
+        return _code_to_base32(morton(coord,bound,depth), depth*2)
     bitstring = classmethod(bitstring)
 
     def bbox (self,prefix=None):
         if not prefix: prefix=len(self.hash)
-        bits = [[n>>(4-i)&1 for i in range(5)]
-                    for n in map(self.BASE_32.find, self.hash[:prefix])]
-        bits = reduce(lambda x,y:x+y, bits, [])
-        return self._to_bbox(bits)
+        hash = self.hash[:prefix]
+        return self._code_to_bbox(_base32_to_code(hash), len(hash)*5)
+
+    def code (self):
+        """the hash as an integer of 5 bits per character"""
+        return _base32_to_code(self.hash)
+
+    def from_code (cls,code,chars,bound=(-180,-90,180,90),depth=32):
+        """the Geohash of chars characters whose code() is code"""
+        return cls(_code_to_base32(code, chars*5),bound,depth)
+    from_code = classmethod(from_code)
+
+# batch codec
+#
+# encode_many() and decode_many() give the same answers as the classes
+# above for whole columns at once.  With numpy the bit twiddling runs as
+# array operations and the columns come back as numpy arrays; without it
+# they are lists of strings and array('d') bounding box columns.
+
+def encode_many (lngs, lats, depth=32, bound=(-180,-90,180,90)):
+    """geohash and geostring columns for parallel lng and lat columns"""
+    if numpy is not None and depth <= 32:
+        return _encode_many_numpy(lngs, lats, depth, bound)
+    codes = [morton(p,bound,depth) for p in zip(lngs,lats)]
+    hashes = [_code_to_base32(code, depth*2) for code in codes]
+    strings = [_code_to_bits(code, depth*2) for code in codes]
+    if numpy is not None:
+        return numpy.array(hashes), numpy.array(strings)
+    return hashes, strings
+
+def decode_many (hashes, bound=(-180,-90,180,90)):
+    """minx, miny, maxx, maxy columns for a column of geohashes"""
+    if numpy is not None:
+        return _decode_many_numpy(hashes, bound)
+    cell = Geohash("", bound)
+    minx, miny, maxx, maxy = [array('d') for i in range(4)]
+    for hash in hashes:
+        box = cell._code_to_bbox(_base32_to_code(hash), len(hash)*5)
+        minx.append(box[0]); miny.append(box[1])
+        maxx.append(box[2]); maxy.append(box[3])
+    return minx, miny, maxx, maxy
+
+def _spread_numpy (n):
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        n = (n | (n << numpy.uint64(shift))) & numpy.uint64(mask)
+    return n
+
+def _encode_many_numpy (lngs, lats, depth, bound):
+    mask = numpy.int64((1L << depth) - 1)
+    scale = float(1L << depth)
+    axes = []
+    for values, lo, hi in ((lngs, bound[0], bound[2]), (lats, bound[1], bound[3])):
+        # float arithmetic as in morton(), truncating toward zero like long()
+        f = (numpy.asarray(values, 'd') - lo) / float(hi - lo) * scale
+        axes.append((f.astype(numpy.int64) & mask).astype(numpy.uint64))
+    code = _spread_numpy(axes[0]) << numpy.uint64(1) | _spread_numpy(axes[1])
+
+    nbits = depth*2
+    chars = (nbits + 4) / 5
+    digits = numpy.empty((len(code), chars), numpy.uint8)
+    for i in range(chars):
+        # the last character is padded with zero bits on the right
+        shift = nbits - 5*(i+1)
+        if shift >= 0:
+            digits[:,i] = code >> numpy.uint64(shift) & numpy.uint64(31)
+        else:
+            digits[:,i] = code << numpy.uint64(-shift) & numpy.uint64(31)
+    alphabet = numpy.frombuffer(_BASE_32, numpy.uint8)
+    hashes = alphabet[digits].view('S%d' % chars).ravel()
+
+    shifts = numpy.arange(nbits-1, -1, -1).astype(numpy.uint64)
+    bits = (code[:,None] >> shifts & numpy.uint64(1)).astype(numpy.uint8)
+    strings = (bits + ord('0')).view('S%d' % nbits).ravel()
+    return hashes, strings
+
+def _decode_many_numpy (hashes, bound):
+    hashes = numpy.asarray(hashes, 'S')
+    lengths = numpy.char.str_len(hashes)
+    columns = numpy.zeros((4, len(hashes)))
+    lookup = numpy.empty(256, numpy.uint64)
+    lookup.fill(31)
+    lookup[numpy.frombuffer(_BASE_32, numpy.uint8)] = numpy.arange(32)
+
+    cell = Geohash("", bound)
+    for length in numpy.unique(lengths):
+        rows = numpy.nonzero(lengths == length)[0]
+        nbits = int(length)*5
+        depth = nbits/2
+        xbits = nbits - depth
+        if xbits > 53:
+            # beyond float precision; let the scalar path define the answer
+            for row in rows:
+                hash = hashes[row]
+                columns[:,row] = cell._code_to_bbox(_base32_to_code(hash), nbits)
+            continue
+
+        chars = numpy.frombuffer(hashes[rows].tostring(), numpy.uint8)
+        chars = lookup[chars.reshape(len(rows), hashes.itemsize)[:,:length]]
+        x = numpy.zeros(len(rows), numpy.uint64)
+        y = numpy.zeros(len(rows), numpy.uint64)
+        one = numpy.uint64(1)
+        for i in range(nbits):
+            bit = chars[:,i/5] >> numpy.uint64(4-i%5) & one
+            if i % 2:
+                y = y << one | bit
+            else:
+                x = x << one | bit
+
+        minx = x / float(1L << xbits)
+        miny = y / float(1L << depth)
+        if depth:
+            maxx = minx + 1.0/(1L<<depth)
+            maxy = miny + 1.0/(1L<<depth)
+        else:
+            maxx = maxy = numpy.ones(len(rows))
+        columns[0,rows] = cell.origin[0] + minx*cell.size[0]
+        columns[1,rows] = cell.origin[1] + miny*cell.size[1]
+        columns[2,rows] = cell.origin[0] + maxx*cell.size[0]
+        columns[3,rows] = cell.origin[1] + maxy*cell.size[1]
+
+    # round() per value, as numpy.round can land on the other side of a tie
+    return tuple([numpy.array([round(v,6) for v in column.tolist()])
+                    for column in columns])
+
+# cells and covering
+#
+# a geohash prefix of n characters names one cell of a grid with
+# 5n - 5n/2 longitude bits and 5n/2 latitude bits, and every hash that
+# starts with it sorts into one contiguous key range.  cover() picks the
+# set of such ranges that covers a bbox with the least area fetched.
+
+def _cell_code (x, y, nbits):
+    """Morton code of grid cell (x, y) at a precision of nbits"""
+    xbits = nbits - nbits/2
+    return interleave(x, y << (xbits - nbits/2), xbits) >> (xbits*2 - nbits)
+
+def _cell_xy (code, nbits):
+    """grid cell (x, y) of an nbits Morton code, undoing _cell_code"""
+    xbits = nbits - nbits/2
+    x, y = deinterleave(code << (xbits*2 - nbits), xbits)
+    return x, y >> (xbits - nbits/2)
+
+def _cell_index (v, lo, hi, bits):
+    n = long((v-lo)/float(hi-lo) * (1L << bits))
+    return max(0, min(n, (1L << bits) - 1))
+
+def _cover_codes (bbox, nbits, bound, max_cells):
+    """sorted Morton codes of the cells touching bbox, None if too many"""
+    west, south, east, north = bbox
+    if west > east:
+        # across the dateline, cover both sides
+        boxes = [(west, south, bound[2], north), (bound[0], south, east, north)]
+    else:
+        boxes = [bbox]
+    xbits, ybits = nbits - nbits/2, nbits/2
+    codes = {}
+    for west, south, east, north in boxes:
+        x0 = _cell_index(west, bound[0], bound[2], xbits)
+        x1 = _cell_index(east, bound[0], bound[2], xbits)
+        y0 = _cell_index(south, bound[1], bound[3], ybits)
+        y1 = _cell_index(north, bound[1], bound[3], ybits)
+        if len(codes) + (x1-x0+1)*(y1-y0+1) > max_cells:
+            return None
+        for x in range(x0, x1+1):
+            for y in range(y0, y1+1):
+                codes[_cell_code(x, y, nbits)] = True
+    codes = codes.keys()
+    codes.sort()
+    return codes
+
+def _merge_runs (codes, max_ranges):
+    """[lo, hi) runs of consecutive codes, bridging the smallest gaps
+    until there are no more than max_ranges of them"""
+    runs = []
+    for code in codes:
+        if runs and runs[-1][1] == code:
+            runs[-1][1] = code + 1
+        else:
+            runs.append([code, code + 1])
+    return _bridge_runs(runs, max_ranges)
+
+def _bridge_runs (runs, max_ranges):
+    """sorted [lo, hi) runs with the smallest gaps between them bridged
+    until there are no more than max_ranges of them"""
+    if len(runs) > max_ranges:
+        gaps = [(runs[i+1][0] - runs[i][1], i) for i in range(len(runs)-1)]
+        gaps.sort()
+        bridged = dict([(i, True) for gap, i in gaps[:len(runs)-max_ranges]])
+        merged = runs[:1]
+        for i in range(1, len(runs)):
+            if i-1 in bridged:
+                merged[-1][1] = runs[i][1]
+            else:
+                merged.append(runs[i])
+        runs = merged
+    return [tuple(run) for run in runs]
+
+def cover (bbox, max_ranges=8, bound=(-180,-90,180,90), max_chars=12, max_cells=256):
+    """geohash key ranges [lo, hi) that between them hold every hash in bbox
+
+    Every precision up to max_chars characters is tried, and the one whose
+    ranges (merged down to max_ranges) cover the least area wins.  The
+    upper bound of a range that runs to the end of the keyspace is "~".
+    """
+    # the whole world as a single range is the fallback
+    best = (1.0, 0, [(0, 1)])
+    for chars in range(1, max_chars+1):
+        nbits = chars*5
+        codes = _cover_codes(bbox, nbits, bound, max_cells)
+        if codes is None:
+            break
+        runs = _merge_runs(codes, max(1, max_ranges))
+        area = sum([hi - lo for lo, hi in runs]) / float(1L << nbits)
+        if area < best[0]:
+            best = (area, nbits, runs)
+    area, nbits, runs = best
+    return [(_code_to_base32(lo, nbits),
+             hi >> nbits and "~" or _code_to_base32(hi, nbits)) for lo, hi in runs]
+
+def cells (bbox, chars, bound=(-180,-90,180,90), max_cells=256):
+    """geohash prefixes of chars characters touching bbox, in key order,
+    or None if there are more than max_cells of them"""
+    codes = _cover_codes(bbox, chars*5, bound, max_cells)
+    if codes is None:
+        return None
+    return [_code_to_base32(code, chars*5) for code in codes]
+
+def finest_cells (bbox, max_cells, max_chars=12, bound=(-180,-90,180,90)):
+    """geohash prefixes touching bbox, in key order, of as many characters
+    as give no more than max_cells of them, up to max_chars; single
+    characters however many of those there are"""
+    prefixes = cells(bbox, 1, bound, max_cells=32)
+    for chars in range(2, max_chars + 1):
+        finer = cells(bbox, chars, bound, max_cells)
+        if finer is None:
+            break
+        prefixes = finer
+    return prefixes
+
+def cell_bbox (hash, bound=(-180,-90,180,90)):
+    """(west, south, east, north) of the cell hash names, from its bits,
+    as wide as it is for an odd number of bits too, unlike Geohash.bbox()"""
+    nbits = len(hash)*5
+    xbits, ybits = nbits - nbits/2, nbits/2
+    x, y = _cell_xy(_base32_to_code(hash), nbits)
+    width = (bound[2] - bound[0]) / float(1L << xbits)
+    height = (bound[3] - bound[1]) / float(1L << ybits)
+    return (bound[0] + x*width, bound[1] + y*height,
+            bound[0] + (x+1)*width, bound[1] + (y+1)*height)
+
+def merge_cells (prefixes, max_ranges=None):
+    """geohash key ranges [lo, hi) that between them hold every hash under
+    any of prefixes, which may be of different lengths
+
+    Neighbouring and nested cells make one range, and with max_ranges the
+    smallest gaps are bridged until there are no more than that.  Bounds
+    are as long as the longest prefix; the upper bound of a range that runs
+    to the end of the keyspace is "~".
+    """
+    if not prefixes:
+        return []
+    nbits = max([len(prefix) for prefix in prefixes])*5
+    spans = []
+    for prefix in prefixes:
+        shift = nbits - len(prefix)*5
+        code = _base32_to_code(prefix)
+        spans.append((code << shift, (code + 1) << shift))
+    spans.sort()
+    runs = []
+    for lo, hi in spans:
+        if runs and lo <= runs[-1][1]:
+            runs[-1][1] = max(runs[-1][1], hi)
+        else:
+            runs.append([lo, hi])
+    if max_ranges:
+        runs = _bridge_runs(runs, max(1, max_ranges))
+    return [(_code_to_base32(lo, nbits),
+             hi >> nbits and "~" or _code_to_base32(hi, nbits)) for lo, hi in runs]
+
+def ring (hash, radius):
+    """geohash cells of len(hash) characters radius cells away from hash,
+    the square ring around it, in key order; longitude wraps at the
+    dateline and the ring stops at the poles"""
+    nbits = len(hash)*5
+    xbits, ybits = nbits - nbits/2, nbits/2
+    x, y = _cell_xy(_base32_to_code(hash), nbits)
+    cells = {}
+    for dy in range(-radius, radius+1):
+        if not 0 <= y + dy < 1L << ybits:
+            continue
+        if abs(dy) == radius:
+            steps = range(-radius, radius+1)
+        else:
+            steps = [-radius, radius]
+        for dx in steps:
+            cells[_cell_code((x + dx) % (1L << xbits), y + dy, nbits)] = True
+    codes = cells.keys()
+    codes.sort()
+    return [_code_to_base32(code, nbits) for code in codes]
+
+def range_size (lo, hi):
+    """number of len(lo) character cells in the key range [lo, hi)"""
+    nbits = len(lo)*5
+    if hi == "~":
+        return (1L << nbits) - _base32_to_code(lo)
+    return _base32_to_code(hi) - _base32_to_code(lo)
+
+# integer keys
+#
+# a Morton code of 2*depth bits is a single integer column, and at the
+# default depth of 31 fits a signed 64 bit one such as the datastore's.
+# Geohash key ranges map onto ranges of codes: exactly for cell prefixes of
+# up to 2*depth/5 characters, and for longer keys, such as bbox corners, to
+# the least range of codes that holds every point in the key range.
+
+# bits of a geohash key of 13 characters, the longest encode gives
+_KEY_BITS = 65
+
+def _key_value (key):
+    """a geohash key as a _KEY_BITS integer, padded out with '0'; a trailing
+    '~' stands for the end of the prefix before it, as in cover()"""
+    if key.endswith("~"):
+        prefix = key.rstrip("~")
+        return (_base32_to_code(prefix) + 1) << (_KEY_BITS - len(prefix)*5)
+    key = key[:_KEY_BITS/5]
+    return _base32_to_code(key) << (_KEY_BITS - len(key)*5)
+
+def hash_code (hash, depth=31):
+    """Morton code of 2*depth bits of the point with this geohash, the
+    same as morton() of the point"""
+    return _key_value(hash) >> (_KEY_BITS - depth*2)
+
+def code_hash (code, depth=31):
+    """geohash of a Morton code of 2*depth bits, undoing hash_code"""
+    return _code_to_base32(code, depth*2)
+
+def code_range (lo, hi, depth=31):
+    """[lo, hi) of Morton codes of 2*depth bits for the geohash key range
+    [lo, hi), holding the code of every point whose geohash is in it"""
+    shift = _KEY_BITS - depth*2
+    return _key_value(lo) >> shift, -(-_key_value(hi) >> shift)
+
+def prefix_range (prefix, depth=31):
+    """[lo, hi) of Morton codes of 2*depth bits under a geohash prefix"""
+    return code_range(prefix, prefix + "~", depth)
+
+# Hilbert curve
+#
+# the same square cells as a geohash of an even number of bits, visited
+# in an order where each cell shares an edge with the one before, so there
+# are no faultlines: a bbox is covered by fewer, tighter key ranges.
+# Hilbert keys are printed in base 32 like geohashes and a prefix of them
+# is still a cell, a square or, for an odd number of bits, half of one.
+
+def _hilbert_index (x, y, order):
+    """position of cell (x, y) along the curve through a 2**order grid"""
+    index = 0L
+    for level in range(order-1, -1, -1):
+        rx = x >> level & 1
+        ry = y >> level & 1
+        index |= ((3*rx) ^ ry) << (level*2)
+        # rotate the quadrant so that the curve through it starts at its corner
+        if not ry:
+            if rx:
+                x = ~x
+                y = ~y
+            x, y = y, x
+    return index
+
+def _hilbert_cell (index, order):
+    """cell (x, y) of a 2**order grid at a position along the curve, undoing _hilbert_index"""
+    x = y = 0L
+    for level in range(order):
+        rx = index >> (level*2+1) & 1
+        ry = (index >> (level*2) ^ rx) & 1
+        side = (1L << level) - 1
+        if not ry:
+            if rx:
+                x = side - x
+                y = side - y
+            x, y = y, x
+        x |= rx << level
+        y |= ry << level
+    return x, y
+
+def hilbert ((x,y), bound=(-180,-90,180,90), depth=32):
+    """Hilbert index of a point: 2*depth bits, two per level of the curve"""
+    mask = (1L << depth) - 1
+    x = long((x-bound[0])/float(bound[2]-bound[0]) * (1L << depth)) & mask
+    y = long((y-bound[1])/float(bound[3]-bound[1]) * (1L << depth)) & mask
+    return _hilbert_index(x, y, depth)
+
+class Hilbert (Geostring):
+    def bitstring (cls,coord,bound=(-180,-90,180,90),depth=32):
+        return _code_to_base32(hilbert(coord,bound,depth), depth*2)
+    bitstring = classmethod(bitstring)
+
+    def bbox (self,prefix=None):
+        if not prefix: prefix=len(self.hash)
+        hash = self.hash[:prefix]
+        return self._code_to_bbox(_base32_to_code(hash), len(hash)*5)
+
+    def _code_to_bbox (self, code, nbits):
+        # an odd number of bits is half a cell: the two cells it could go on to
+        order = (nbits + 1)/2
+        spare = order*2 - nbits
+        cells = [_hilbert_cell(code << spare | n, order) for n in range(1 << spare)]
+        size = float(1L << order)
+        minx = min([x for x, y in cells]) / size
+        miny = min([y for x, y in cells]) / size
+        maxx = (max([x for x, y in cells]) + 1) / size
+        maxy = (max([y for x, y in cells]) + 1) / size
+        minx, maxx = [self.origin[0]+x*self.size[0] for x in (minx,maxx)]
+        miny, maxy = [self.origin[1]+y*self.size[1] for y in (miny,maxy)]
+        return tuple([round(x,6) for x in minx, miny, maxx, maxy])
+
+def hilbert_cover (bbox, max_ranges=8, bound=(-180,-90,180,90), max_chars=12, max_cells=256):
+    """Hilbert key ranges [lo, hi) that between them hold every key in bbox,
+    chosen as by cover(), over square cells of up to max_chars characters"""
+    west, south, east, north = bbox
+    if west > east:
+        boxes = [(west, south, bound[2], north), (bound[0], south, east, north)]
+    else:
+        boxes = [bbox]
+    best = (1.0, 0, [(0, 1)])
+    for order in range(1, max_chars*5/2 + 1):
+        cells = {}
+        for west, south, east, north in boxes:
+            x0 = _cell_index(west, bound[0], bound[2], order)
+            x1 = _cell_index(east, bound[0], bound[2], order)
+            y0 = _cell_index(south, bound[1], bound[3], order)
+            y1 = _cell_index(north, bound[1], bound[3], order)
+            if len(cells) + (x1-x0+1)*(y1-y0+1) > max_cells:
+                cells = None
+                break
+            for x in range(x0, x1+1):
+                for y in range(y0, y1+1):
+                    cells[_hilbert_index(x, y, order)] = True
+        if cells is None:
+            break
+        codes = cells.keys()
+        codes.sort()
+        runs = _merge_runs(codes, max(1, max_ranges))
+        area = sum([hi - lo for lo, hi in runs]) / float(1L << order*2)
+        if area < best[0]:
+            best = (area, order*2, runs)
+    area, nbits, runs = best
+    return [(_code_to_base32(lo, nbits),
+             hi >> nbits and "~" or _code_to_base32(hi, nbits)) for lo, hi in runs]
+
+def hilbert_range_size (lo, hi):
+    """share of the keyspace in the key range [lo, hi), as a float"""
+    top = 1L << _KEY_BITS
+    return ((hi == "~" and top or _key_value(hi)) - _key_value(lo)) / float(top)
@@ -0,0 +1,181 @@
+"""
+CachedMultiTask over LocalCache, as the stand-in for memcache, and scans of
+a MemoryBackend that counts them
+
+Usage: python -m unittest discover tests
+"""
+
+import time, threading, cPickle, unittest
+
+import util
+from asynctools import CachedMultiTask, LocalCache, LocalTask
+from ffBackend import MemoryBackend
+
+# a MemoryBackend counting its scans, each of them taking delay seconds
+class CountingBackend(MemoryBackend):
+
+	def __init__(self, points, delay=0):
+		MemoryBackend.__init__(self, points)
+		self.delay = delay
+		self.scans = 0
+		self.counting = threading.Lock()
+
+	def scan(self, lo, hi, limit):
+		self.counting.acquire()
+		try:
+			self.scans += 1
+		finally:
+			self.counting.release()
+		time.sleep(self.delay)
+		return MemoryBackend.scan(self, lo, hi, limit)
+
+# a LocalCache whose first read misses, as a read landing just before another runner sets the key
+class LateCache(LocalCache):
+
+	def __init__(self):
+		LocalCache.__init__(self)
+		self.reads = 0
+
+	def get_multi(self, keys, namespace=None):
+		self.reads += 1
+		if self.reads == 1:
+			return {}
+		return LocalCache.get_multi(self, keys, namespace)
+
+# run a runner in each of count threads at once, returning the runners and their results
+def concurrently(count, make_runner):
+	runners = [make_runner() for i in range(count)]
+	results = [None] * count
+	start = threading.Event()
+
+	def run(index):
+		start.wait()
+		runners[index].run()
+		results[index] = runners[index][0].get_result()
+
+	threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+	for thread in threads:
+		thread.start()
+	start.set()
+	for thread in threads:
+		thread.join()
+	return runners, results
+
+class CachedTest(unittest.TestCase):
+
+	def setUp(self):
+		self.backend = CountingBackend(util.points(20000), delay=0.2)
+		self.memcache = LocalCache()
+		self.rows = MemoryBackend.scan(self.backend, 'u', 'v', 100)
+
+	def runner(self, **kwargs):
+		return CachedMultiTask([self.backend.scan_task('u', 'v', 100)], memcache=self.memcache, codec=self.backend.codec, **kwargs)
+
+class CacheHitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.calls = 0
+
+	def scan(self, lo, hi):
+		self.calls += 1
+		return []
+
+	def run_tasks(self, memcache, local_cache=None):
+		tasks = [LocalTask(self.scan, lo, lo + 'z', cache_key='scan=%s' % lo) for lo in ('a', 'b')]
+		runner = CachedMultiTask(tasks, memcache=memcache, local_cache=local_cache)
+		runner.run()
+		self.assertEqual([task.get_result() for task in tasks], [[], []])
+		return runner
+
+	# a cached empty result is a hit, in either tier
+	def test_empty_result(self):
+		memcache = LocalCache()
+		self.run_tasks(memcache)
+		runner = self.run_tasks(memcache)
+		self.assertEqual(self.calls, 2)
+		self.assertEqual(runner.stats['memcache_hits'], 2)
+
+		local_cache = LocalCache()
+		self.run_tasks(memcache, local_cache)
+		runner = self.run_tasks(memcache, local_cache)
+		self.assertEqual(self.calls, 2)
+		self.assertEqual(runner.stats['local_hits'], 2)
+
+class SingleFlightTest(CachedTest):
+
+	# of concurrent runners missing the same key, one scans and the others wait for its result
+	def test_concurrent_misses(self):
+		runners, results = concurrently(8, lambda: self.runner(single_flight=True, wait=5, poll=0.01))
+		self.assertEqual(self.backend.scans, 1)
+		self.assertEqual(results, [self.rows] * 8)
+
+	# a runner winning the lock after another has set the key and let go takes the result rather than scanning
+	def test_lock_won_after_set(self):
+		self.memcache = LateCache()
+		self.runner().run()
+		self.memcache.reads = 0
+
+		runner = self.runner(single_flight=True)
+		runner.run()
+		self.assertEqual(self.backend.scans, 1)
+		self.assertEqual(runner.stats['coalesced'], 1)
+		self.assertEqual(runner[0].get_result(), self.rows)
+
+class StaleTest(CachedTest):
+
+	# a stale entry is served as it is while exactly one runner refreshes it
+	def test_one_refresh(self):
+		self.runner(time=0.05, stale_time=60).run()
+		time.sleep(0.1)
+
+		runners, results = concurrently(8, lambda: self.runner(time=300, stale_time=60))
+		self.assertEqual(self.backend.scans, 2)
+		self.assertEqual(results, [self.rows] * 8)
+		self.assertEqual(sum([runner.stats['stale_hits'] + runner.stats['memcache_hits'] for runner in runners]), 7)
+
+		runner = self.runner(time=300, stale_time=60)
+		runner.run()
+		self.assertEqual(self.backend.scans, 2)
+		self.assertEqual(runner.stats['memcache_hits'], 1)
+
+class LocalCacheTest(unittest.TestCase):
+
+	# the least recently used go once the pickled size of all entries passes max_bytes
+	def test_eviction_by_size(self):
+		value = 'x' * 1000
+		size = len(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+		cache = LocalCache(max_bytes=size * 3 + size / 2)
+		for key in ('a', 'b', 'c'):
+			cache.set_multi({key : value})
+		cache.get_multi(['a'])
+		cache.set_multi({'d' : value})
+		self.assertEqual(sorted(cache.get_multi(['a', 'b', 'c', 'd']).keys()), ['a', 'c', 'd'])
+		self.assertEqual(cache.evictions, 1)
+		self.assertEqual(cache.bytes, size * 3)
+
+		# too big to keep at all
+		self.assertEqual(cache.set_multi({'e' : value * 4}), ['e'])
+		self.assertEqual(len(cache), 3)
+
+class CodecTest(CachedTest):
+
+	# rows come back from the cache as they were scanned, and memcache holds them packed
+	def test_round_trip(self):
+		codec = self.backend.codec
+		self.failUnless(self.rows)
+		self.assertEqual(codec.decode(codec.encode(self.rows)), self.rows)
+		self.assertEqual(codec.decode(codec.encode([])), [])
+		self.assertEqual(codec.decode(cPickle.dumps(self.rows)), None)
+
+		keys = self.backend.scan_keys('u', 'v', 100)
+		self.assertEqual(self.backend.keys_codec.decode(self.backend.keys_codec.encode(keys)), [dict(key, key=str(key['key'])) for key in keys])
+
+		self.runner().run()
+		runner = self.runner()
+		runner.run()
+		self.assertEqual(self.backend.scans, 1)
+		self.assertEqual(runner[0].get_result(), self.rows)
+		self.failUnless(isinstance(self.memcache.get_multi([runner[0].cache_key]).values()[0], str))
+
+if __name__ == '__main__':
+	unittest.main()
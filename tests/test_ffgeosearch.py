@@ -0,0 +1,218 @@
+"""
+ffGeoSearch over MemoryBackend, checked against brute force
+
+Usage: python -m unittest discover tests
+"""
+
+import random, unittest
+
+import util
+import ffPolygon
+import ffTrace
+from asynctools import LocalCache
+from ffGeoSearch import ffGeoSearch
+
+class TileLimitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.backend = util.backend(200000)
+
+	# small limits spread over more tiles than there are markers to return
+	def test_small_limits(self):
+		for bbox in [(-30.3, 10.1, -2.7, 29.9), (100.1, -5.2, 100.9, -4.6)]:
+			in_view = len([1 for point in self.points if util.inside(bbox, point)])
+			for merge in (False, True):
+				for limit in (1, 2, 5, 10, 50, 100):
+					geo = ffGeoSearch(bbox=util.bbox_text(bbox), limit=limit, backend=self.backend, quantize='tiles', filter=True, merge=merge)
+					geo.search()
+					self.assertEqual(len(geo.results), min(limit, in_view), (bbox, merge, limit))
+					self.failIf([1 for point in util.positions(geo.results) if not util.inside(bbox, point)])
+
+class MergeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.backend = util.backend(200000)
+
+	# merged, a search tops up until it has the limit or every marker in view
+	def test_fills_limit(self):
+		random.seed(3)
+		for trial in range(30):
+			west, south, span = random.uniform(-179, 150), random.uniform(-80, 60), 10 ** random.uniform(0, 1.5)
+			bbox = (west, south, min(179.9, west + span), min(89.9, south + span / 2))
+			in_view = len([1 for point in self.points if util.inside(bbox, point)])
+			for kwargs in ({}, {'cover' : 8}, {'quantize' : 'tiles'}):
+				for limit in (100, 1000):
+					geo = ffGeoSearch(bbox=util.bbox_text(bbox), limit=limit, backend=self.backend, filter=True, merge=True, **kwargs)
+					geo.search()
+					self.assertEqual(len(geo.results), min(limit, in_view), (bbox, kwargs, limit))
+
+class CorrectionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.hashes = util.hashes(self.points)
+		self.backend = util.backend(200000)
+
+	# every marker in view that a query fetches is returned, once, though the boxes queried are nudged and split
+	def test_fetched_in_view(self):
+		random.seed(7)
+		bboxes = [(-154.71, 13.95, -148.39, 17.12), (44.016651752118975, -46.961853309680365, 44.77323898342396, -46.583559694027876)]
+		for trial in range(20):
+			west, south, span = random.uniform(-179, 170), random.uniform(-80, 70), 10 ** random.uniform(-0.5, 1.2)
+			bboxes.append((west, south, min(179.9, west + span), min(89.9, south + span / 2)))
+
+		for bbox in bboxes:
+			for correction in (1, 2):
+				for two_phase in (False, True):
+					geo = ffGeoSearch(bbox=util.bbox_text(bbox), limit=100000, backend=self.backend, filter=True, correction=correction, two_phase=two_phase)
+					geo.search()
+					fetched = [point for point in self.points if util.inside(bbox, point)
+						and [1 for box in geo.boxes if box['sw_geohash'] <= self.hashes[point] < box['ne_geohash']]]
+					self.assertEqual(sorted(util.positions(geo.results)), sorted(fetched), (bbox, correction, two_phase))
+
+class CacheRoundTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.backend = util.backend(200000)
+
+	# cached, the bbox is rounded for the cache key, but results are those of the bbox asked for
+	def test_requested_bbox(self):
+		random.seed(5)
+		for trial in range(20):
+			west, south, span = random.uniform(-179, 170), random.uniform(-80, 70), 10 ** random.uniform(-0.5, 1.2)
+			bbox = (west, south, min(179.9, west + span), min(89.9, south + span / 2))
+			in_view = sorted([point for point in self.points if util.inside(bbox, point)])
+			
+			# as ff_search.py searches, and with a cover that reaches every marker in the box planned
+			for kwargs in ({'merge' : True, 'concurrency' : 4, 'single_flight' : True, 'stale_ttl' : 60}, {'cover' : 8}):
+				geo = ffGeoSearch(bbox=util.bbox_text(bbox), limit=100000, backend=self.backend, filter=True, cache_ttl=300, memcache=LocalCache(), **kwargs)
+				geo.search()
+				results = sorted(util.positions(geo.results))
+				self.failIf([1 for point in results if not util.inside(bbox, point)], (bbox, kwargs))
+				if 'cover' in kwargs:
+					self.assertEqual(results, in_view, (bbox, kwargs))
+
+class TwoPhaseTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.backend = util.backend(200000)
+
+	# candidates outside the bbox are dropped before the get, filter or not
+	def test_without_filter(self):
+		for bbox in [(-30.3, 10.1, -2.7, 29.9), (100.1, -5.2, 100.9, -4.6), (-0.7, -1.3, 0.4, 0.2)]:
+			for correction in (0, 1):
+				geo = ffGeoSearch(bbox=util.bbox_text(bbox), limit=200, backend=self.backend, two_phase=True, correction=correction)
+				geo.search()
+				self.failUnless(geo.results, bbox)
+				self.failIf([1 for point in util.positions(geo.results) if not util.inside(bbox, point)], (bbox, correction))
+
+class CursorTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.backend = util.backend(200000)
+
+	# paging by next_cursor returns every marker in view, once, however the bbox is planned
+	def test_pages(self):
+		random.seed(4)
+		for trial in range(10):
+			west, south, span = random.uniform(-179, 150), random.uniform(-80, 60), 10 ** random.uniform(0, 1.2)
+			bbox = (west, south, min(179.9, west + span), min(89.9, south + span / 2))
+			in_view = sorted([point for point in self.points if util.inside(bbox, point)])
+			for kwargs in ({}, {'merge' : True}, {'cover' : 8}, {'cover' : 8, 'merge' : True}, {'quantize' : 'tiles'}, {'two_phase' : True}):
+				results, cursor = [], None
+				for page in range(500):
+					geo = ffGeoSearch(bbox=util.bbox_text(bbox), limit=100, backend=self.backend, filter=True, cursor=cursor, **kwargs)
+					geo.search()
+					results += util.positions(geo.results)
+					cursor = geo.next_cursor
+					if not cursor:
+						break
+				self.assertEqual(sorted(results), in_view, (bbox, kwargs))
+
+class PreviousTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.backend = util.backend(200000)
+
+	# given the bbox before a pan, a merged search returns just the markers it brought into view
+	def test_exposed(self):
+		random.seed(4)
+		for trial in range(20):
+			west, south, span = random.uniform(-170, 150), random.uniform(-70, 60), 10 ** random.uniform(0, 1.2)
+			previous = (west, south, west + span, south + span / 2)
+			dx, dy = random.uniform(-0.6, 0.6) * span, random.uniform(-0.3, 0.3) * span
+			bbox = (previous[0] + dx, previous[1] + dy, previous[2] + dx, previous[3] + dy)
+			exposed = sorted([point for point in self.points if util.inside(bbox, point) and not util.inside(previous, point)])
+			for kwargs in ({}, {'cover' : 8}, {'two_phase' : True}):
+				geo = ffGeoSearch(bbox=util.bbox_text(bbox), previous=util.bbox_text(previous), limit=100000, backend=self.backend, filter=True, merge=True, **kwargs)
+				geo.search()
+				self.assertEqual(sorted(util.positions(geo.results)), exposed, (bbox, previous, kwargs))
+
+class PolygonTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(200000)
+		self.backend = util.backend(200000)
+
+	# a polygon, or a set of boxes, returns every marker inside it and no other
+	def test_inside(self):
+		random.seed(6)
+		for trial in range(10):
+			lng, lat, size = random.uniform(-150, 150), random.uniform(-60, 60), 10 ** random.uniform(-0.3, 1)
+			ring = [[lng + size * x, lat + size * y] for x, y in ((0, 0), (1, -0.5), (2, 0.3), (1.2, 1.5), (0.3, 0.8), (0, 0))]
+			polygon = '{"type": "Polygon", "coordinates": [%s]}' % ring
+			zone = ffPolygon.parse(polygon)
+			boxes = [(lng, lat, lng + size, lat + size / 2), (lng + 2 * size, lat - size, lng + 2.5 * size, lat)]
+			for kwargs in ({}, {'merge' : True}, {'cover' : 4}):
+				geo = ffGeoSearch(polygon=polygon, limit=100000, backend=self.backend, **kwargs)
+				geo.search()
+				self.assertEqual(sorted(util.positions(geo.results)), sorted([point for point in self.points if zone.contains(*point)]), (polygon, kwargs))
+
+				geo = ffGeoSearch(boxes=';'.join([util.bbox_text(box) for box in boxes]), limit=100000, backend=self.backend, **kwargs)
+				geo.search()
+				self.assertEqual(sorted(util.positions(geo.results)), sorted([point for point in self.points if [1 for box in boxes if util.inside(box, point)]]), (boxes, kwargs))
+
+	def test_bad_polygon(self):
+		for kwargs in ({'polygon' : '{"type": "Point", "coordinates": [0, 0]}'}, {'polygon' : 'nowhere'}, {'boxes' : '1,2,3'}):
+			self.assertRaises(ValueError, ffGeoSearch, limit=100, backend=self.backend, **kwargs)
+
+class PlanMemoTest(unittest.TestCase):
+
+	def setUp(self):
+		self.backend = util.backend(200000)
+		self.plans = ffGeoSearch.plans
+
+	def tearDown(self):
+		ffGeoSearch.plans = self.plans
+
+	def search(self, bbox, **kwargs):
+		trace = ffTrace.Trace()
+		geo = ffGeoSearch(bbox=util.bbox_text(bbox), limit=500, backend=self.backend, filter=True, trace=trace, **kwargs)
+		geo.search()
+		return geo, trace.counters.get('plans_cached', 0)
+
+	# a box planned before is planned from the memo, to the same boxes and results as planning it again
+	def test_same_plan(self):
+		for kwargs in ({}, {'correction' : 1}, {'cover' : 8}, {'quantize' : 'tiles'}):
+			for bbox in [(-30.3, 10.1, -2.7, 29.9), (-154.71, 13.95, -148.39, 17.12)]:
+				ffGeoSearch.plans = None
+				fresh, cached = self.search(bbox, **kwargs)
+				self.assertEqual(cached, 0)
+
+				ffGeoSearch.plans = LocalCache()
+				first, cached = self.search(bbox, **kwargs)
+				self.assertEqual(cached, 0)
+				second, cached = self.search(bbox, **kwargs)
+				self.assertEqual(cached, 1, (bbox, kwargs))
+				for geo in (first, second):
+					self.assertEqual(geo.boxes, fresh.boxes, (bbox, kwargs))
+					self.assertEqual(util.positions(geo.results), util.positions(fresh.results), (bbox, kwargs))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,62 @@
+"""
+ffIngest into MemoryBackend: markers and prefix counts after loading
+
+Usage: python -m unittest discover tests
+"""
+
+import unittest
+
+import util
+import geohash
+from ffBackend import MemoryBackend
+from ffIngest import Ingester
+
+class ReloadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.records = [{'id' : str(i), 'lng' : lng, 'lat' : lat} for i, (lng, lat) in enumerate(util.points(2000))]
+
+	def load(self, backend, records):
+		Ingester(backend, batch_size=50, concurrency=4, counts_every=500, id='id').run(records)
+
+	def assertSameCounts(self, backend, once):
+		self.assertEqual(len(backend), len(once))
+		counts = backend.prefix_counts(backend.counts.keys())
+		self.assertEqual(sorted(counts.keys()), sorted(once.counts.keys()))
+		for prefix, count in once.counts.items():
+			got = counts[prefix]
+			self.assertEqual(got[0], count[0], prefix)
+			self.assertAlmostEqual(got[1], count[1], 6)
+			self.assertAlmostEqual(got[2], count[2], 6)
+
+	# loading the same records again replaces markers and counts alike
+	def test_reload(self):
+		for curve in ('z', 'hilbert'):
+			once = MemoryBackend(curve=curve)
+			self.load(once, self.records)
+			self.assertEqual(len(once), len(self.records))
+
+			twice = MemoryBackend(curve=curve)
+			self.load(twice, self.records)
+			self.load(twice, self.records)
+			self.assertSameCounts(twice, once)
+
+	# and so do repeats within one load, in one batch or several
+	def test_repeats(self):
+		once = MemoryBackend()
+		self.load(once, self.records)
+
+		repeated = MemoryBackend()
+		self.load(repeated, self.records[:1000] + self.records[990:1010] + self.records[1000:] + self.records[5:7] * 3)
+		self.assertSameCounts(repeated, once)
+
+	# a marker loaded again at a new position has a new key name, and leaves the old one as it was
+	def test_moved(self):
+		backend = MemoryBackend()
+		self.load(backend, [{'id' : 'a', 'lng' : 10, 'lat' : 10}])
+		self.load(backend, [{'id' : 'a', 'lng' : 20, 'lat' : 20}])
+		self.assertEqual(len(backend), 2)
+		self.assertEqual(sum([count[0] for count in backend.prefix_counts(list(geohash.Geohash.BASE_32)).values()]), 2)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,36 @@
+"""
+ffNearSearch over MemoryBackend, checked against brute force
+
+Usage: python -m unittest discover tests
+"""
+
+import random, unittest
+
+import util
+from ffNearSearch import ffNearSearch, haversine
+
+class NearSearchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.points = util.points(20000, 11)
+		self.backend = util.backend(20000, 11)
+
+	def test_nearest(self):
+		random.seed(11)
+		for i in range(20):
+			lng, lat = random.uniform(-180, 180), random.uniform(-90, 90)
+			limit = random.choice([1, 10, 100])
+			radius = random.choice([None, 500000.0])
+			near = ffNearSearch(point='%r,%r' % (lng, lat), limit=limit, radius=radius, backend=self.backend)
+			near.search()
+
+			distances = sorted([haversine(lng, lat, point[0], point[1]) for point in self.points])
+			wanted = [distance for distance in distances[:limit] if radius is None or distance <= radius]
+			self.assertEqual([round(distance, 3) for distance in wanted], [round(result['distance'], 3) for result in near.results])
+
+	def test_bad_limit(self):
+		for limit in (0, -1, '0', 'ten'):
+			self.assertRaises(ValueError, ffNearSearch, point='0,0', limit=limit, backend=self.backend)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,48 @@
+"""
+ffOutput writers on the results of searches of either curve
+
+Usage: python -m unittest discover tests
+"""
+
+import unittest
+from StringIO import StringIO
+
+import util
+import geohash
+import ffOutput
+from ffGeoSearch import ffGeoSearch
+
+try:
+	import json
+except ImportError:
+	import simplejson as json
+
+class OutputTest(unittest.TestCase):
+
+	def search(self, curve):
+		geo = ffGeoSearch(bbox='-5,45,5,55', limit=100, backend=util.backend(2000, 3, (-10, 40, 10, 60), curve), filter=True, curve=curve)
+		geo.search()
+		self.failUnless(geo.results)
+		return geo
+
+	def test_geojson(self):
+		for curve in ('z', 'hilbert'):
+			geo = self.search(curve)
+			out = StringIO()
+			ffOutput.write_geojson(out, geo.results, geo.log, None, geo.next_cursor)
+			collection = json.loads(out.getvalue()[1:-1])
+			self.assertEqual(len(collection['features']), len(geo.results))
+			for feature in collection['features']:
+				lng, lat = feature['geometry']['coordinates']
+				self.assertEqual(feature['properties']['geohash'], str(geohash.Geohash((lng, lat))))
+
+	def test_columnar(self):
+		for curve in ('z', 'hilbert'):
+			geo = self.search(curve)
+			out = StringIO()
+			ffOutput.write_columnar(out, geo.results)
+			markers = ffOutput.read_columnar(out.getvalue())
+			self.assertEqual(sorted([marker['geohash'] for marker in markers]), sorted([result['geohash'] for result in geo.results]))
+
+if __name__ == '__main__':
+	unittest.main()
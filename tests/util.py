@@ -0,0 +1,49 @@
+"""
+Shared setup of the tests: the package on sys.path, and random markers in a
+MemoryBackend, made once per run for every test asking for the same ones
+
+Usage: python -m unittest discover tests
+"""
+
+import os, sys, random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geohash
+from ffBackend import MemoryBackend
+
+WORLD = (-180, -90, 180, 90)
+
+_points = {}
+_backends = {}
+
+# count (lng, lat) points uniform over bbox, the same for the same arguments
+def points(count, seed=7, bbox=WORLD):
+	key = (count, seed, bbox)
+	if key not in _points:
+		generator = random.Random(seed)
+		west, south, east, north = bbox
+		_points[key] = [(generator.uniform(west, east), generator.uniform(south, north)) for i in range(count)]
+	return _points[key]
+
+# a MemoryBackend of those points, shared between tests: searches only read it
+def backend(count, seed=7, bbox=WORLD, curve='z'):
+	key = (count, seed, bbox, curve)
+	if key not in _backends:
+		_backends[key] = MemoryBackend(points(count, seed, bbox), curve=curve)
+	return _backends[key]
+
+# dict of point to its geohash
+def hashes(points):
+	return dict(zip(points, [str(hash) for hash in geohash.encode_many([point[0] for point in points], [point[1] for point in points])[0]]))
+
+# bbox as the bbox argument of a search
+def bbox_text(bbox):
+	return '%r,%r,%r,%r' % tuple(bbox)
+
+def inside(bbox, point):
+	west, south, east, north = bbox
+	return west <= point[0] <= east and south <= point[1] <= north
+
+# (lng, lat) of each result
+def positions(results):
+	return [(result['lng'], result['lat']) for result in results]